@@ -0,0 +1,550 @@
+"""
+Асинхронный вариант ETL на asyncpg и AsyncElasticsearch.
+
+Producer, Enricher и Merger здесь - асинхронные генераторы с той же логикой,
+что и в main.py. Все загрузчики работают в одном процессе и одном потоке,
+но запросы к Postgres и bulk запросы к ES разных загрузчиков выполняются
+одновременно, а внутри загрузчика чтение следующей пачки идёт параллельно
+с отправкой предыдущих (до bulk.thread_count bulk запросов одновременно).
+
+Перестройка индексов, режим CDC и аренда загрузчиков в Redis есть только
+в синхронном варианте (main.py).
+
+Запуск: python3 async_main.py
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+
+import asyncpg
+import backoff
+from dotenv import load_dotenv
+from elasticsearch import AsyncElasticsearch
+from elasticsearch import exceptions as elastic_exceptions
+from elasticsearch.helpers import async_bulk
+from psycopg2 import sql
+
+from main import (
+    INDEX_SCHEMES,
+    ElasticRequester,
+    Enricher,
+    Merger,
+    Producer,
+    conf,
+    filter_actions,
+    log_load_stats,
+    make_state_storage,
+)
+from modules import sql_queries
+from modules.data_representation import (
+    FilmWork, FilmWorkGenres, FilmWorkNested, FilmWorkPersons, Genre, NestedRecord, Person, row_loader
+)
+from modules.hash_store import ContentHashStore
+from modules.state_control import State
+
+
+def compile_query(query: sql.Composable) -> Tuple[str, List[str]]:
+    """
+    Преобразование запроса psycopg2 с именованными placeholder'ами в запрос asyncpg
+    с нумерованными параметрами ($1, $2, ...). Возвращает текст запроса и имена
+    параметров в порядке номеров. Подстановка списка в "IN {placeholder}"
+    заменяется на "= ANY($n)": asyncpg передаёт список как массив
+    """
+    parts, names = [], []
+
+    def walk(item: sql.Composable) -> None:
+        if isinstance(item, sql.Composed):
+            for sub_item in item.seq:
+                walk(sub_item)
+        elif isinstance(item, sql.SQL):
+            parts.append(item.string)
+        elif isinstance(item, sql.Identifier):
+            parts.append(".".join('"' + name.replace('"', '""') + '"' for name in item.strings))
+        elif isinstance(item, sql.Placeholder):
+            if item.name not in names:
+                names.append(item.name)
+            param = f"${names.index(item.name) + 1}"
+            text = parts[-1].rstrip() if parts else ""
+            if text.upper().endswith(" IN"):
+                parts[-1] = text[:-2] + "= ANY("
+                param += ")"
+            parts.append(param)
+        elif isinstance(item, sql.Literal):
+            if item.wrapped is None:
+                parts.append("NULL")
+            else:
+                parts.append("'" + str(item.wrapped).replace("'", "''") + "'")
+        else:
+            raise TypeError(f"Неподдерживаемая часть запроса: {item!r}")
+
+    walk(query)
+    return "".join(parts), names
+
+
+def as_datetime(value: Any) -> Any:
+    """Состояние из JSON хранится строкой, а asyncpg принимает только datetime"""
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+class AsyncPostgres:
+    """Пул соединений asyncpg. json декодируется в объекты Python, uuid - в строки"""
+
+    def __init__(self, dsl: dict, max_size: int = 10) -> None:
+        self.dsl = dsl
+        self.max_size = max_size
+        self.pool: Optional[asyncpg.Pool] = None
+
+    @staticmethod
+    async def init_connection(connection: asyncpg.Connection) -> None:
+        for type_name in ("json", "jsonb"):
+            await connection.set_type_codec(
+                type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+            )
+        await connection.set_type_codec(
+            "uuid", encoder=str, decoder=str, schema="pg_catalog", format="text"
+        )
+
+    async def connect(self) -> None:
+        self.pool = await asyncpg.create_pool(
+            database=self.dsl["dbname"],
+            host=self.dsl["host"],
+            port=self.dsl["port"],
+            user=self.dsl["user"],
+            password=self.dsl["password"],
+            max_size=self.max_size,
+            init=self.init_connection,
+        )
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    async def query(self, query: sql.Composable, params: dict) -> List[asyncpg.Record]:
+        text, names = compile_query(query)
+        return await self.pool.fetch(text, *(params[name] for name in names))
+
+    async def stream(self, query: sql.Composable, params: dict, itersize: int) -> AsyncIterator[asyncpg.Record]:
+        """Чтение результата серверным курсором по itersize строк"""
+        text, names = compile_query(query)
+        async with self.pool.acquire() as connection, connection.transaction():
+            async for record in connection.cursor(text, *(params[name] for name in names), prefetch=itersize):
+                yield record
+
+
+# Ошибки соединения, после которых прерванную выборку нужно повторить
+PG_CONNECTION_ERRORS = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError)
+
+
+def records_to(data_class: type, records: List[asyncpg.Record]) -> list:
+    if not records:
+        return []
+    load = row_loader(data_class, list(records[0].keys()))
+    return [load(record) for record in records]
+
+
+class AsyncProducer(Producer):
+    """
+    Асинхронный Producer: те же параметры и то же смещение по offset_by,
+    только вместо PostgresConnection передаётся AsyncPostgres
+    """
+
+    async def extract(self) -> list:
+        return records_to(self.data_class, await self.pg_connection.query(self.sql_query, self.sql_values))
+
+    async def extract_stream(self) -> AsyncIterator[list]:
+        chunk, load = [], None
+        async for record in self.pg_connection.stream(self.sql_query, self.sql_values, self.itersize):
+            if load is None:
+                load = row_loader(self.data_class, list(record.keys()))
+            chunk.append(load(record))
+            if len(chunk) == self.itersize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    async def generator(self) -> AsyncIterator[list]:
+        while True:
+            produced = 0
+            try:
+                if self.itersize is not None:
+                    async for result in self.extract_stream():
+                        produced += len(result)
+                        yield self.produce(result)
+                else:
+                    result = await self.extract()
+                    if result:
+                        produced = len(result)
+                        yield self.produce(result)
+            except PG_CONNECTION_ERRORS as err:
+                # Выборка повторяется с последней выданной строки (ключ offset_by, key_field)
+                logging.error(f"Error reading from postgres: {err}")
+                await asyncio.sleep(1)
+                continue
+            if produced == 0:
+                break
+
+
+class AsyncEnricher(AsyncProducer, Enricher):
+    """Асинхронный Enricher: выборка по ключу (updated_at, id) для каждой пачки из producer"""
+
+    async def generator(self) -> AsyncIterator[list]:
+        async for pr in self.producer.generator():
+            self.update_sql_value(self.enrich_by, list(pr))
+            self.move_key(self.start_updated_at, self.start_id)
+            while True:
+                result = await self.extract()
+                if len(result) == 0:
+                    break
+                self.move_key(result[-1].updated_at, result[-1].id)
+                if self.produce_field is not None:
+                    yield [getattr(rows, self.produce_field) for rows in result]
+                else:
+                    yield result
+                if len(result) < self.sql_values["limit"]:
+                    break
+
+
+class AsyncMerger(AsyncProducer, Merger):
+    """Асинхронный Merger: копит id из enricher и выбирает данные по set_limit штук"""
+
+    async def _get_result_(self) -> list:
+        self.update_sql_value(self.produce_by, list(self.unique_produce_by))
+        return await self.extract()
+
+    async def generator(self) -> AsyncIterator[list]:
+        async for en in self.enricher.generator():
+            self.unique_produce_by = self.unique_produce_by.union(set(en))
+            if len(self.unique_produce_by) <= self.set_limit:
+                continue
+            yield await self._get_result_()
+            self.unique_produce_by.clear()
+        if len(self.unique_produce_by) != 0:
+            yield await self._get_result_()
+            self.unique_produce_by.clear()
+
+
+class AsyncNestedUpdater:
+    """Асинхронный NestedUpdater (см. main.py)"""
+
+    def __init__(
+        self, pg: AsyncPostgres, producer: AsyncProducer, sql_query: sql.Composable, fields: dict, name_key: str
+    ) -> None:
+        self.pg = pg
+        self.producer = producer
+        self.sql_query = sql_query
+        self.fields = fields
+        self.name_key = name_key
+
+    async def generator(self) -> AsyncIterator[List[FilmWorkNested]]:
+        async for records in self.producer.generator():
+            names = {str(record.id): record.name for record in records}
+            links = await self.pg.query(self.sql_query, {"data_ids": list(names)})
+            films = {}
+            for link in links:
+                field = self.fields.get(link["role"])
+                # Роли, которых нет в документе фильма, пропускаются, как и при полной сборке фильма
+                if field is None:
+                    continue
+                films.setdefault(link["fw_id"], []).append(
+                    {"field": field, "uuid": link["id"], "name": names[link["id"]]}
+                )
+            yield [FilmWorkNested(fw_id, entries, self.name_key) for fw_id, entries in films.items()]
+
+
+class AsyncElasticLoader:
+    """
+    Загрузка пачек в ES через AsyncElasticsearch. Для сборки действий используются
+    статические методы ElasticRequester, для пропуска неизменившихся документов -
+    то же хранилище хэшей
+    """
+
+    def __init__(self, client: AsyncElasticsearch, hash_store: Optional[ContentHashStore] = None) -> None:
+        self.client = client
+        self.hash_store = hash_store
+
+    @backoff.on_exception(backoff.expo, elastic_exceptions.ConnectionError, max_time=conf.backoff.max_time)
+    async def bulk(self, actions: List[dict], to_index: str) -> None:
+        if not actions:
+            return
+        await async_bulk(
+            self.client,
+            actions,
+            index=to_index,
+            chunk_size=conf.bulk.chunk_size,
+            max_chunk_bytes=conf.bulk.max_chunk_bytes,
+        )
+
+    async def load(
+        self,
+        batches: AsyncIterator[list],
+        watermark: Callable[[], Any],
+        state: State,
+        state_field: str,
+        to_index: str,
+        id_key: str,
+        make_actions: Optional[Callable[[list], List[dict]]] = None,
+        skip_unchanged: bool = False,
+    ) -> int:
+        """
+        Аналог load_to_elastic: пока отправляются bulk запросы (не больше bulk.thread_count
+        одновременно), читаются следующие пачки. Значение состояния пачки записывается,
+        когда выполнены bulk запросы этой пачки и всех предыдущих
+        """
+        if make_actions is None:
+            make_actions = lambda objects: ElasticRequester.build_actions(objects, "update", id_key, upsert=True)
+        started = time.monotonic()
+        loaded = 0
+        skipped = {"docs": 0, "bytes": 0}
+        # (задача bulk запроса, значение состояния, хэши документов) для каждой пачки
+        in_flight = deque()
+
+        async def commit_head() -> None:
+            nonlocal loaded
+            task, upd_at, hashes, count = in_flight.popleft()
+            await task
+            if self.hash_store is not None:
+                await asyncio.to_thread(self.hash_store.remember, to_index, hashes)
+            state.set_state(state_field, upd_at)
+            loaded += count
+
+        try:
+            async for objects in batches:
+                upd_at = watermark()
+                # Хэширование и обращения к хранилищу хэшей (SQLite/Redis) блокируют,
+                # поэтому выполняются в пуле потоков, а не в цикле событий
+                actions, hashes = await asyncio.to_thread(
+                    filter_actions, self.hash_store, to_index, make_actions(objects), skip_unchanged, skipped
+                )
+                task = asyncio.create_task(self.bulk(actions, to_index))
+                in_flight.append((task, upd_at, hashes, len(actions)))
+                while len(in_flight) >= conf.bulk.thread_count or (in_flight and in_flight[0][0].done()):
+                    await commit_head()
+            while in_flight:
+                await commit_head()
+        finally:
+            # При ошибке незавершённые запросы отменяются, их пачки будут загружены при следующем запуске
+            for task, *_ in in_flight:
+                task.cancel()
+
+        log_load_stats(f"{state_field} -> {to_index}", loaded, time.monotonic() - started, skipped)
+        return loaded
+
+
+async def fw_producer(
+    pg: AsyncPostgres, loader: AsyncElasticLoader, state: State, limit: int, itersize: Optional[int]
+) -> int:
+    """Выгрузка таблицы film_work"""
+    producer = AsyncProducer(
+        pg,
+        sql_query=sql_queries.fw_full_sql_query(),
+        sql_values={"updated_at": as_datetime(state.get_state("film_work_upd_at")), "sql_limit": limit},
+        data_class=FilmWork,
+        offset_by="updated_at",
+        itersize=itersize,
+        key_field="fw_id",
+    )
+    return await loader.load(
+        producer.generator(),
+        lambda: producer.last_upd_at,
+        state,
+        state_field="film_work_upd_at",
+        to_index="movies",
+        id_key="fw_id",
+        skip_unchanged=True,
+    )
+
+
+async def persons_or_genres_producer(
+    pg: AsyncPostgres, loader: AsyncElasticLoader, state: State, limit: int, itersize: Optional[int], data_type: str
+) -> int:
+    """Обновление персон/жанров в документах фильмов"""
+    dispatch = {
+        "person": {
+            "state_field": "person_upd_at",
+            "table_name": "person",
+            "related_table": "person_film_work",
+            "related_id": "person_id",
+            "dataclass": FilmWorkPersons,
+            "sql_query": sql_queries.fw_persons_sql_query(),
+            "name_column": "full_name",
+            "role_column": "role",
+            "fields": {"actor": "actors", "writer": "writers", "director": "directors"},
+        },
+        "genre": {
+            "state_field": "genre_upd_at",
+            "table_name": "genre",
+            "related_table": "genre_film_work",
+            "related_id": "genre_id",
+            "dataclass": FilmWorkGenres,
+            "sql_query": sql_queries.fw_genres_sql_query(),
+            "name_column": "name",
+            "role_column": None,
+            "fields": {None: "genre"},
+        },
+    }[data_type]
+    updated_at = as_datetime(state.get_state(dispatch["state_field"]))
+
+    if conf.etl.nested_updates == "script":
+        producer = AsyncProducer(
+            pg,
+            sql_query=sql_queries.nested_changed_sql(dispatch["table_name"], dispatch["name_column"]),
+            sql_values={"updated_at": updated_at, "limit": itersize or limit},
+            data_class=NestedRecord,
+            offset_by="updated_at",
+            key_field="id",
+        )
+        updater = AsyncNestedUpdater(
+            pg,
+            producer,
+            sql_query=sql_queries.nested_links_sql(
+                dispatch["related_table"], dispatch["related_id"], dispatch["role_column"], list(dispatch["fields"])
+            ),
+            fields=dispatch["fields"],
+            name_key=dispatch["name_column"],
+        )
+        batches = updater.generator()
+        make_actions = ElasticRequester.build_script_actions
+    else:
+        producer = AsyncProducer(
+            pg,
+            sql_query=sql_queries.nested_pre_sql(dispatch["table_name"]),
+            sql_values={"updated_at": updated_at, "limit": limit},
+            offset_by="updated_at",
+            produce_field="id",
+            key_field="id",
+        )
+        enricher = AsyncEnricher(
+            pg,
+            producer=producer,
+            sql_query=sql_queries.nested_fw_ids_sql(dispatch["related_table"], dispatch["related_id"]),
+            sql_values={"limit": itersize or limit},
+            enrich_by="data_ids",
+            produce_field="id",
+        )
+        merger = AsyncMerger(
+            pg,
+            enricher=enricher,
+            sql_query=dispatch["sql_query"],
+            sql_values={},
+            produce_by="filmwork_ids",
+            set_limit=100,
+            data_class=dispatch["dataclass"],
+        )
+        batches = merger.generator()
+        make_actions = None
+
+    return await loader.load(
+        batches,
+        lambda: producer.last_upd_at,
+        state,
+        state_field=dispatch["state_field"],
+        to_index="movies",
+        id_key="fw_id",
+        make_actions=make_actions,
+    )
+
+
+async def full_producer(
+    pg: AsyncPostgres,
+    loader: AsyncElasticLoader,
+    state: State,
+    limit: int,
+    itersize: Optional[int],
+    data_class: type,
+    sql_query: sql.Composable,
+    state_field: str,
+    to_index: str,
+) -> int:
+    """Выгрузка таблиц person/genre в индексы persons/genres"""
+    producer = AsyncProducer(
+        pg,
+        sql_query=sql_query,
+        sql_values={"updated_at": as_datetime(state.get_state(state_field)), "limit": limit},
+        data_class=data_class,
+        offset_by="updated_at",
+        itersize=itersize,
+        key_field="id",
+    )
+    return await loader.load(
+        producer.generator(),
+        lambda: producer.last_upd_at,
+        state,
+        state_field=state_field,
+        to_index=to_index,
+        id_key="id",
+        skip_unchanged=True,
+    )
+
+
+async def run_periodically(name: str, job: Callable[[], Any], interval: int, state: State) -> None:
+    """Аналог Scheduler для задачи в цикле событий"""
+    while True:
+        try:
+            await job()
+        except Exception:
+            logging.exception(f"Ошибка в загрузчике {name}")
+        finally:
+            state.flush()
+        await asyncio.sleep(interval)
+
+
+async def main(pg_dsl: dict, elastic_host: str, elastic_port: int) -> None:
+    if conf.state.storage == "redis":
+        raise ValueError("Асинхронный ETL не поддерживает общее состояние в Redis, используйте main.py")
+    # Индексы создаются синхронным клиентом, как и в main.py
+    hash_store = ContentHashStore(conf.etl.hash_store) if conf.etl.hash_store else None
+    esr = ElasticRequester([elastic_host], port=elastic_port, bulk_settings=conf.bulk, hash_store=hash_store)
+    for index_name, index_scheme in INDEX_SCHEMES.items():
+        esr.handle_index(index_name, index_scheme())
+
+    state = State(make_state_storage(conf.state), flush_interval=conf.state.flush_interval)
+    # У каждого загрузчика одновременно открыт не больше чем один курсор и один запрос
+    pg = AsyncPostgres(pg_dsl, max_size=10)
+    await pg.connect()
+    client = AsyncElasticsearch(hosts=[f"{elastic_host}:{elastic_port}"], maxsize=conf.bulk.thread_count * 5)
+    loader = AsyncElasticLoader(client, hash_store)
+
+    limit, itersize = conf.sql_settings.limit, conf.sql_settings.itersize
+    loaders = {
+        "film_work": lambda: fw_producer(pg, loader, state, limit, itersize),
+        "film_work_persons": lambda: persons_or_genres_producer(pg, loader, state, limit, itersize, "person"),
+        "film_work_genres": lambda: persons_or_genres_producer(pg, loader, state, limit, itersize, "genre"),
+        "persons": lambda: full_producer(
+            pg, loader, state, limit, itersize, Person, sql_queries.person_sql(), "persons_full_upd_at", "persons"
+        ),
+        "genres": lambda: full_producer(
+            pg, loader, state, limit, itersize, Genre, sql_queries.genre_sql(), "genres_full_upd_at", "genres"
+        ),
+    }
+    try:
+        await asyncio.gather(
+            *(
+                run_periodically(name, job, conf.etl.intervals.get(name, conf.etl.time_interval), state)
+                for name, job in loaders.items()
+            )
+        )
+    finally:
+        state.flush()
+        await client.close()
+        await pg.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(message)s")
+    logging.info("Начало работы (async)")
+
+    load_dotenv()
+    pg_dsl = {"dbname": os.environ.get("ETL_DB_NAME"), "port": os.environ.get("ETL_DB_PORT"),
+              "host": os.environ.get("ETL_DB_HOST"), "password": os.environ.get("ETL_DB_PASSWD"),
+              "user": os.environ.get("ETL_DB_USER")}
+
+    asyncio.run(main(pg_dsl, os.environ.get("ETL_ES_HOST"), int(os.environ.get("ETL_ES_PORT"))))
@@ -4,25 +4,41 @@
 # Моя версия python 3.8.10
 from __future__ import annotations
 
+import argparse
+import atexit
+import copy
 import dataclasses
 import datetime
+import itertools
 import logging
 import os
+import random
+import select
+import threading
 import time
-from typing import Optional, Iterator, List, Tuple, Any
+from collections import deque
+from typing import Optional, Iterator, List, Tuple, Any, Callable, Dict
 
 import backoff
 import psycopg2
+import redis
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch, helpers
 from elasticsearch import exceptions as elastic_exceptions
-from psycopg2.extras import DictCursor
-from psycopg2.sql import SQL
+from psycopg2.extras import DictCursor, NamedTupleCursor
+from psycopg2.sql import SQL, Identifier
 
 from modules import sql_queries
-from modules.config import Config
-from modules.data_representation import FilmWork, BaseRecord, FilmWorkPersons, FilmWorkGenres, Person, Genre
-from modules.state_control import State, JsonFileStorage
+from modules.config import Config, BulkConfig, StateConfig, ShardingConfig
+from modules.hash_store import ContentHashStore
+from modules.pipeline import Pipeline
+from modules.scheduler import Scheduler
+from modules.data_representation import (
+    FilmWork, BaseRecord, FilmWorkPersons, FilmWorkGenres, FilmWorkNested, NestedRecord, Person, Genre, row_loader
+)
+from modules.state_control import (
+    State, BaseStorage, JsonFileStorage, SqliteStorage, RedisStorage, RedisLease, LeaseGroup, LeaseLost
+)
 import modules.index_schem as index_schemes
 # Считывание конфига происходит здесь, т.к.
 # иначе не передать параметры в декоратор @backoff:
@@ -41,6 +57,8 @@ class PostgresConnection:
         self.connection_opts = connection_opts
         self.connection = None
         self.cursor = None
+        # Счётчик для уникальных имён серверных курсоров
+        self.cursor_ids = itertools.count()
 
     def __enter__(self) -> PostgresConnection:
         self.connect()
@@ -80,6 +98,43 @@ class PostgresConnection:
                 logging.error("Trying to reconnect")
                 self.connect()
 
+    def stream(
+        self,
+        sql_query: SQL,
+        params: Optional[dict] = None,
+        itersize: int = 500,
+        data_class: Optional[type] = None,
+    ) -> Iterator[Any]:
+        """
+        Выполнение запроса через именованный (серверный) курсор.
+        Строки отдаются по одной в виде namedtuple или, если задан data_class, сразу
+        объектами data_class (см. row_loader), а из базы забираются пачками по itersize,
+        поэтому в памяти одновременно находится не больше одной такой пачки, каким бы
+        большим ни был результат запроса.
+
+        Переподключение при ошибке здесь не выполняется: прерванную выборку нужно
+        начинать заново с того места, до которого она была обработана (см. Producer).
+        """
+        cursor = self.connection.cursor(
+            name=f"etl_stream_{next(self.cursor_ids)}",
+            cursor_factory=NamedTupleCursor if data_class is None else None,
+        )
+        cursor.itersize = itersize
+        try:
+            cursor.execute(sql_query, params or ())
+            if data_class is None:
+                yield from cursor
+                return
+            load = None
+            for row in cursor:
+                # У серверного курсора описание колонок появляется только после первого чтения
+                if load is None:
+                    load = row_loader(data_class, [column.name for column in cursor.description])
+                yield load(row)
+        finally:
+            if not self.connection.closed:
+                cursor.close()
+
 
 class Producer:
     """
@@ -100,9 +155,19 @@ class Producer:
        будет возвращаться список значений одного поля этого dataclass. Например, если указать
        produce_field = 'id', то при data_class = FilmWork будет возвращаться список из id
        собранных FilmWork'ов
+     - itersize: опциональный параметр, включающий потоковое чтение. Результат запроса
+       читается через серверный курсор и отдаётся пачками по itersize строк по мере чтения,
+       не дожидаясь, пока будет получен весь результат. Так LIMIT в запросе можно делать
+       большим без роста потребления памяти
+     - key_field: опциональное поле с id строки. Если указано, смещение выполняется по ключу
+       (offset_by, key_field): в sql запросе должен быть placeholder last_id, и строки
+       с одинаковым значением offset_by не пропускаются при продолжении выборки
 
     """
 
+    # id, с которого начинается выборка по ключу
+    start_id = "00000000-0000-0000-0000-000000000000"
+
     def __init__(
         self,
         pg_connection: PostgresConnection,
@@ -111,6 +176,8 @@ class Producer:
         data_class: Optional[dataclasses] = BaseRecord,
         offset_by: str = None,
         produce_field: Optional[str] = None,
+        itersize: Optional[int] = None,
+        key_field: Optional[str] = None,
     ) -> None:
         self.pg_connection = pg_connection
         self.sql_query = sql_query
@@ -118,6 +185,10 @@ class Producer:
         self.data_class = data_class
         self.offset_by = offset_by
         self.produce_field = produce_field
+        self.itersize = itersize
+        self.key_field = key_field
+        if key_field is not None:
+            self.sql_values.setdefault("last_id", self.start_id)
         self.last_upd_at = datetime.datetime.fromtimestamp(0)
 
     def extract(self) -> List[dataclasses]:
@@ -130,9 +201,34 @@ class Producer:
         инициализации класса
         """
         raw_data = self.pg_connection.query(self.sql_query, self.sql_values)
-        dataclasses_data = [self.data_class(**row) for row in raw_data]
+        if not raw_data:
+            return []
+        columns = [column.name for column in self.pg_connection.cursor.description]
+        load = row_loader(self.data_class, columns)
+        dataclasses_data = [load(row) for row in raw_data]
         return dataclasses_data
 
+    def extract_stream(self) -> Iterator[List[dataclasses]]:
+        """
+        Потоковый вариант extract: тот же запрос выполняется через серверный курсор,
+        а результат отдаётся пачками по self.itersize dataclass'ов по мере чтения из базы
+        """
+        rows = self.pg_connection.stream(self.sql_query, self.sql_values, self.itersize, self.data_class)
+        max_age = conf.sql_settings.cursor_max_age
+        opened = time.monotonic()
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.itersize:
+                yield chunk
+                chunk = []
+                # Пока пачка обрабатывается, курсор держит транзакцию открытой
+                if max_age is not None and time.monotonic() - opened > max_age:
+                    rows.close()
+                    return
+        if chunk:
+            yield chunk
+
     def generator(self) -> Iterator[list]:
         """
         Метод, описывающий логику вычитки из базы.
@@ -147,22 +243,68 @@ class Producer:
         После того как по результату проитерируются, будет произведено смещение значения offset,
         подставляемого в sql запрос
         """
+        if self.itersize is not None:
+            yield from self.stream_generator()
+            return
         while True:
             result = self.extract()
             if len(result) == 0:
                 break
-            self.update_sql_value(self.offset_by, getattr(result[-1], self.offset_by))
-            self.last_upd_at = self.sql_values["updated_at"]
-            if self.produce_field is not None:
-                produced_by_field = [
-                    getattr(rows, self.produce_field) for rows in result
-                ]
-                yield produced_by_field
-            else:
-                yield result
-            # Берём последний элемент списка объектов, забираем у него значение из offset_by,
-            # и перезаписываем это значение в sql_value. Таким образом осуществляется сдвиг,
-            # например, по updated_at
+            yield self.produce(result)
+
+    def stream_generator(self) -> Iterator[list]:
+        """
+        Потоковый вариант generator. Каждый запрос к базе читается пачками по itersize строк,
+        и смещение offset_by выполняется после каждой пачки.
+
+        Серверный курсор держит транзакцию открытой, в том числе пока выданные пачки
+        загружаются в ES. Поэтому курсор читается не дольше sql_settings.cursor_max_age
+        секунд: затем он закрывается, транзакция завершается, а запрос повторяется
+        с последней выданной строки. Чтобы при этом не пропустить строки с тем же
+        значением offset_by, потоковое чтение используется вместе с key_field.
+
+        Если чтение прервалось из-за ошибки соединения, запрос повторяется с того же места
+        с экспоненциально растущей паузой. Если за backoff.max_time секунд прочитать
+        ничего не удалось, ошибка пробрасывается
+        """
+        failed_since, attempt = None, 0
+        while True:
+            produced = 0
+            try:
+                for result in self.extract_stream():
+                    produced += len(result)
+                    failed_since = None
+                    yield self.produce(result)
+                self.pg_connection.connection.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+                logging.error(f"Error reading stream from postgres: {err}")
+                if failed_since is None:
+                    failed_since, attempt = time.monotonic(), 0
+                elif time.monotonic() - failed_since > conf.backoff.max_time:
+                    raise
+                time.sleep(min(2 ** attempt, conf.backoff.max_time))
+                attempt += 1
+                if self.pg_connection.connection.closed:
+                    logging.error("Trying to reconnect")
+                    self.pg_connection.connect()
+                continue
+            if produced == 0:
+                break
+
+    def produce(self, result: List[dataclasses]) -> list:
+        """
+        Смещение offset по полученной пачке и подготовка пачки к выдаче
+        """
+        # Берём последний элемент списка объектов, забираем у него значение из offset_by,
+        # и перезаписываем это значение в sql_value. Таким образом осуществляется сдвиг,
+        # например, по updated_at
+        self.update_sql_value(self.offset_by, getattr(result[-1], self.offset_by))
+        if self.key_field is not None:
+            self.update_sql_value("last_id", getattr(result[-1], self.key_field))
+        self.last_upd_at = self.sql_values["updated_at"]
+        if self.produce_field is not None:
+            return [getattr(rows, self.produce_field) for rows in result]
+        return result
 
     def update_sql_value(self, key: str, value: any) -> None:
         """Метод для обновления значения по ключу в
@@ -178,36 +320,41 @@ class Enricher(Producer):
     - enrich_by: Имя placeholder'а в sql запросе, в который будет подставляться результат
       работы сборщика первого уровня (Producer);
 
-    Нарезка на пачки данных в Enricher осуществляется иначе, чем в Producer.
-    Здесь для запросов применяется OFFSET, placeholder под который обязательно должен быть в sql
-    запросе, передаваемом Enricher'у.
+    Нарезка на пачки данных в Enricher осуществляется по ключу (updated_at, id):
+    в sql запросе, передаваемом Enricher'у, обязательно должны быть placeholder'ы
+    updated_at и last_id, в которые подставляются значения из последней строки
+    предыдущей пачки. В отличие от OFFSET, стоимость такого запроса не зависит от
+    номера пачки.
     """
 
+    # updated_at, с которого начинается выборка (id - Producer.start_id)
+    start_updated_at = datetime.datetime.fromisoformat("1970-01-01T00:00:00.000000+00:00")
+
     def __init__(
         self, *args, producer: Producer, enrich_by: str = None, **kwargs
     ) -> None:
         self.producer = producer
         self.enrich_by = enrich_by
-        self.offset = 0
         super().__init__(*args, **kwargs)
 
     def generator(self) -> Iterator[list]:
-        if self.sql_values.get("offset") is None:
-            raise ValueError("У enricher должен быть OFFSET")
         # Итерация по генератору из Producer.
         for pr in self.producer.generator():
+            # Здесь вносится изменение в словарь с подстановками в sql запрос:
+            # имени placeholder'а теперь соответствует tuple со значениями,
+            # по которым осуществится выборка (например, подставляется в WHERE IN).
+            # Tuple используется, т.к. psycopg2 при подстановке в sql запрос корректно
+            # преобразует его в перечисленные через запятую значения.
+            self.update_sql_value(self.enrich_by, tuple(pr))
+            # Сбор данных второго уровня по каждой пачке из сборщика первого уровня
+            # начинается сначала.
+            self.move_key(self.start_updated_at, self.start_id)
             while True:
-                # Здесь вносится изменение в словарь с подстановками в sql запрос:
-                # имени placeholder'а теперь соответствует tuple со значениями,
-                # по которым осуществится выборка (например, подставляется в WHERE IN).
-                # Tuple используется, т.к. psycopg2 при подстановке в sql запрос корректно
-                # преобразует его в перечисленные через запятую значения.
-                self.update_sql_value(self.enrich_by, tuple(pr))
                 result = self.extract()
                 if len(result) == 0:
                     break
-                # Увеличение OFFSET для следующего запроса.
-                self.move_offset()
+                # Сдвиг ключа на последнюю полученную строку для следующего запроса.
+                self.move_key(result[-1].updated_at, result[-1].id)
                 if self.produce_field is not None:
                     enriched_by_field = [
                         getattr(rows, self.produce_field) for rows in result
@@ -215,20 +362,17 @@ class Enricher(Producer):
                     yield enriched_by_field
                 else:
                     yield result
-            # Сбор данных второго уровня по результатам пачки данных из сборщика первого уровня закончен.
-            # Следовательно, необходимо сбросить offset, чтобы на следующей итерации сбор второго уровня
-            # начинать сначала.
-            self.update_sql_value("offset", 0)
+                # Неполная пачка - значит, данных больше нет, лишний запрос не нужен
+                if len(result) < self.sql_values["limit"]:
+                    break
 
-    def move_offset(self) -> None:
+    def move_key(self, updated_at: datetime.datetime, last_id: Any) -> None:
         """
-        Функция сдвига OFFSET'а. Берёт старое значение и прибавляет к нему значение лимита.
-        Изменение заносятся в словарь, который используется для подстановки значений в sql
-        запрос.
+        Функция сдвига ключа выборки. Изменения заносятся в словарь,
+        который используется для подстановки значений в sql запрос.
         """
-        new_offset = self.sql_values["offset"] + self.sql_values["limit"]
-        self.update_sql_value("offset", new_offset)
-        self.offset = new_offset
+        self.update_sql_value("updated_at", updated_at)
+        self.update_sql_value("last_id", last_id)
 
 
 class Merger(Producer):
@@ -292,6 +436,70 @@ class Merger(Producer):
             self.unique_produce_by.clear()
 
 
+class NestedUpdater:
+    """
+    Инкрементальная денормализация персон/жанров в документы фильмов.
+
+    Вместо пересборки всех персон (жанров) каждого затронутого фильма через Merger,
+    для каждой пачки изменённых записей из producer по таблице связей выясняется,
+    в каких фильмах и в каких ролях они участвуют. Для каждого фильма выдаётся
+    FilmWorkNested - только изменённые вложенные записи, которые обновляются
+    в документе скриптом (см. ElasticRequester.build_script_actions).
+    Producer должен выдавать NestedRecord
+
+    Скрипт не удаляет записи: связи, удалённые из person_film_work/genre_film_work,
+    убирает из документа загрузчик film_work - изменение связей обновляет updated_at
+    фильма (триггер touch_film_work в db_schema.sql), и фильм пересобирается целиком
+    """
+
+    def __init__(
+        self,
+        pg_connection: PostgresConnection,
+        producer: Producer,
+        sql_query: SQL,
+        fields: dict,
+        name_key: str,
+    ) -> None:
+        self.pg_connection = pg_connection
+        self.producer = producer
+        self.sql_query = sql_query
+        # Поле документа фильма по роли из таблицы связей
+        self.fields = fields
+        self.name_key = name_key
+
+    def generator(self) -> Iterator[List[FilmWorkNested]]:
+        for records in self.producer.generator():
+            names = {str(record.id): record.name for record in records}
+            links = self.pg_connection.query(self.sql_query, {"data_ids": tuple(names)})
+            films = {}
+            for link in links:
+                field = self.fields.get(link["role"])
+                # Роли, которых нет в документе фильма, пропускаются, как и при полной сборке фильма
+                if field is None:
+                    continue
+                films.setdefault(link["fw_id"], []).append(
+                    {"field": field, "uuid": link["id"], "name": names[link["id"]]}
+                )
+            yield [FilmWorkNested(fw_id, entries, self.name_key) for fw_id, entries in films.items()]
+
+
+class RetryingBulkClient:
+    """
+    Клиент ES для helpers.parallel_bulk: каждый bulk запрос при ошибке соединения
+    повторяется с backoff, как make_bulk_request. Повтор безопасен - действия идемпотентны
+    """
+
+    def __init__(self, client: Elasticsearch) -> None:
+        self.client = client
+        self.transport = client.transport
+
+    @backoff.on_exception(
+        backoff.expo, elastic_exceptions.ConnectionError, max_time=conf.backoff.max_time
+    )
+    def bulk(self, *args, **kwargs) -> dict:
+        return self.client.bulk(*args, **kwargs)
+
+
 class ElasticRequester:
     """
     Класс работы с Elasticsearch.
@@ -300,14 +508,29 @@ class ElasticRequester:
     Имеет метод для преобразования списка dataclass в bulk запрос.
     Каждый dataclass должен иметь метод elastic_format, возвращающий
     словарь с именами полей, соотвествующими mapping'у индекса
+
+    hash_store - хранилище хэшей загруженных документов, позволяющее
+    не отправлять неизменившиеся документы (см. load_to_elastic)
     """
 
-    def __init__(self, ip: List[str], port: int) -> None:
+    def __init__(
+        self,
+        ip: List[str],
+        port: int,
+        bulk_settings: Optional[BulkConfig] = None,
+        hash_store: Optional[ContentHashStore] = None,
+    ) -> None:
         self.ip = ip
         self.port = port
-        self.elastic_instance = Elasticsearch(self.ip, port=self.port)
+        self.bulk_settings = bulk_settings or BulkConfig()
+        self.hash_store = hash_store
+        self.elastic_instance = Elasticsearch(self.ip, port=self.port, maxsize=self.bulk_settings.thread_count)
         self.bulk_request = []
 
+    def remember_hashes(self, to_index: str, hashes: Dict[str, bytes]) -> None:
+        if self.hash_store is not None:
+            self.hash_store.remember(to_index, hashes)
+
     def prepare_bulk(
         self,
         objects: List[dataclasses],
@@ -315,25 +538,98 @@ class ElasticRequester:
         id_key: Optional[str] = "id",
         upsert: Optional[bool] = False,
     ) -> None:
-        self.bulk_request.clear()
+        self.bulk_request = self.build_actions(objects, action, id_key, upsert)
+
+    @staticmethod
+    def build_actions(
+        objects: List[dataclasses],
+        action: str,
+        id_key: Optional[str] = "id",
+        upsert: Optional[bool] = False,
+    ) -> List[dict]:
+        """
+        Преобразование списка dataclass в список действий bulk запроса.
+        В отличие от prepare_bulk не меняет состояние объекта, поэтому может
+        выполняться параллельно с отправкой предыдущего bulk запроса
+        """
+        actions = []
         for obj in objects:
             elastic_doc = obj.elastic_format()
             doc_id = getattr(obj, id_key)
             req = {"_op_type": action, "_id": doc_id, "doc": elastic_doc}
+            if action == "update":
+                # Один документ movies могут одновременно обновлять разные загрузчики
+                req["retry_on_conflict"] = 3
             if upsert:
                 req["doc_as_upsert"] = True
-            self.bulk_request.append(req)
+            actions.append(req)
+        return actions
+
+    @staticmethod
+    def build_script_actions(objects: List[FilmWorkNested], id_key: Optional[str] = "fw_id") -> List[dict]:
+        """
+        Действия частичного обновления документов скриптом. Если документа ещё нет,
+        скрипт выполняется на пустом документе (scripted_upsert), как и doc_as_upsert в build_actions
+        """
+        return [
+            {
+                "_op_type": "update",
+                "_id": getattr(obj, id_key),
+                "retry_on_conflict": 3,
+                "script": obj.elastic_script(),
+                "scripted_upsert": True,
+                "upsert": {},
+            }
+            for obj in objects
+        ]
 
     @backoff.on_exception(
         backoff.expo, elastic_exceptions.ConnectionError, max_time=conf.backoff.max_time
     )
-    def make_bulk_request(self, to_index: str) -> Tuple[int, int | List[Any]]:
-        if len(self.bulk_request) == 0:
+    def make_bulk_request(self, to_index: str, actions: Optional[List[dict]] = None) -> Tuple[int, int | List[Any]]:
+        if actions is None:
+            actions = self.bulk_request
+        if len(actions) == 0:
             logging.error("Bulk request empty")
             return 0, 0
-        res = helpers.bulk(self.elastic_instance, self.bulk_request, index=to_index)
+        res = helpers.bulk(self.elastic_instance, actions, index=to_index)
         return res
 
+    def stream_bulk(self, actions: Iterator[dict], to_index: str) -> Iterator[Tuple[bool, dict]]:
+        """
+        Потоковая отправка действий в ES. Действия забираются из генератора по мере
+        готовности, нарезаются на bulk запросы по chunk_size действий / max_chunk_bytes байт
+        и отправляются параллельно в thread_count потоков.
+
+        Для каждого действия в порядке их поступления возвращается пара (успех, ответ ES).
+        Ошибки отдельных документов не прерывают загрузку, а возвращаются в этих парах.
+        bulk запрос, не выполненный из-за ошибки соединения, повторяется с backoff
+        """
+        return helpers.parallel_bulk(
+            RetryingBulkClient(self.elastic_instance),
+            actions,
+            index=to_index,
+            thread_count=self.bulk_settings.thread_count,
+            chunk_size=self.bulk_settings.chunk_size,
+            max_chunk_bytes=self.bulk_settings.max_chunk_bytes,
+            queue_size=self.bulk_settings.queue_size,
+            raise_on_error=False,
+        )
+
+    @backoff.on_exception(
+        backoff.expo, elastic_exceptions.ConnectionError, max_time=conf.backoff.max_time
+    )
+    def delete_documents(self, doc_ids: List[str], to_index: str) -> None:
+        """Удаление документов по id. Отсутствующие в индексе документы пропускаются"""
+        actions = [{"_op_type": "delete", "_id": doc_id} for doc_id in doc_ids]
+        if self.hash_store is not None:
+            self.hash_store.forget(to_index, doc_ids)
+        _, errors = helpers.bulk(self.elastic_instance, actions, index=to_index, raise_on_error=False)
+        for error in errors:
+            result = error["delete"]
+            if result.get("status") != 404:
+                logging.error(f"Документ {result.get('_id')} не удалён из {to_index}: {result.get('error')}")
+
     def check_index_exists(self, index_name: str):
         if self.elastic_instance.indices.exists(index=index_name):
             return True
@@ -341,9 +637,239 @@ class ElasticRequester:
             return False
 
     def handle_index(self, index_name: str, index_struct: dict, force=False):
+        """
+        Создание индекса, если его нет. Данные хранятся в версионном индексе
+        index_name_vN, а index_name - псевдоним (alias) на него: так индекс можно
+        перестроить без простоя (см. reindex)
+        """
         if not self.check_index_exists(index_name) or force:
-            self.elastic_instance.indices.create(index=index_name, body=index_struct)
+            self.switch_alias(index_name, self.create_index_version(index_name, index_struct))
+            if self.hash_store is not None:
+                self.hash_store.forget_index(index_name)
+
+    def index_versions(self, alias: str) -> List[str]:
+        """Версии индекса alias_vN по возрастанию N"""
+        indices = self.elastic_instance.indices.get(index=f"{alias}_v*")
+        return sorted(indices, key=lambda name: int(name.rsplit("_v", 1)[1]))
+
+    def create_index_version(self, alias: str, index_struct: dict, settings: Optional[dict] = None) -> str:
+        """Создание следующей версии индекса alias. settings дополняют настройки из index_struct"""
+        versions = self.index_versions(alias)
+        version = int(versions[-1].rsplit("_v", 1)[1]) + 1 if versions else 1
+        index_name = f"{alias}_v{version}"
+        body = copy.deepcopy(index_struct)
+        body["settings"].update(settings or {})
+        self.elastic_instance.indices.create(index=index_name, body=body)
+        logging.info(f"Создан индекс {index_name}")
+        return index_name
+
+    def switch_alias(self, alias: str, index_name: str) -> None:
+        """
+        Атомарное переключение alias на index_name. Прежние версии индекса удаляются
+        в том же запросе. Если alias занят обычным индексом (созданным до перехода
+        на версионные индексы), он тоже удаляется
+        """
+        actions = [{"add": {"index": index_name, "alias": alias}}]
+        if self.check_index_exists(alias) and not self.elastic_instance.indices.exists_alias(name=alias):
+            actions.append({"remove_index": {"index": alias}})
+        for old_index in self.index_versions(alias):
+            if old_index != index_name:
+                actions.append({"remove_index": {"index": old_index}})
+        self.elastic_instance.indices.update_aliases(body={"actions": actions})
+        logging.info(f"{alias} переключен на {index_name}")
+
+    def index_replicas(self, index_name: str, default: int = 1) -> int:
+        """Количество реплик индекса (или индекса, на который указывает alias)"""
+        if not self.check_index_exists(index_name):
+            return default
+        settings = self.elastic_instance.indices.get_settings(index=index_name, name="index.number_of_replicas")
+        return int(next(iter(settings.values()))["settings"]["index"]["number_of_replicas"])
+
+    def update_index_settings(self, index_name: str, settings: dict) -> None:
+        self.elastic_instance.indices.put_settings(index=index_name, body={"index": settings})
+
+    def forcemerge(self, index_name: str) -> None:
+        """Слияние индекса в один сегмент. Выполняется долго, поэтому с увеличенным таймаутом"""
+        self.elastic_instance.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=3600)
+
+
+
+def load_to_elastic(
+    batches: Iterator[list],
+    watermark: Callable[[], Any],
+    elastic_requester: ElasticRequester,
+    state: State,
+    state_field: str,
+    to_index: str,
+    id_key: str,
+    make_actions: Optional[Callable[[list], List[dict]]] = None,
+    skip_unchanged: bool = False,
+    stop: Optional[threading.Event] = None,
+) -> int:
+    """
+    Конвейерная загрузка пачек dataclass'ов в индекс to_index.
+
+    Чтение из Postgres, подготовка bulk запроса и его отправка выполняются
+    одновременно: при bulk.streaming - через parallel_bulk (см. stream_to_elastic),
+    иначе - конвейером Pipeline с очередями etl.pipeline_queue_size.
+    watermark вызывается сразу после получения пачки и возвращает значение состояния,
+    соответствующее этой пачке. В state оно записывается только после того,
+    как bulk запрос с этой пачкой выполнен.
+    make_actions превращает пачку в действия bulk запроса, по умолчанию -
+    upsert документов (ElasticRequester.build_actions).
+
+    Если у elastic_requester есть хранилище хэшей, то при skip_unchanged документы,
+    содержимое которых не изменилось с прошлой загрузки, не отправляются. Действия
+    без skip_unchanged (частичные обновления) сбрасывают хэши своих документов.
+
+    stop устанавливается, если загрузчик потерял аренду (см. leased_job): тогда загрузка
+    прерывается с LeaseLost, и state после этого не меняется.
+    Возвращает количество загруженных документов
+    """
+    started = time.monotonic()
+    loaded = 0
+    skipped = {"docs": 0, "bytes": 0}
+    if make_actions is None:
+        make_actions = lambda objects: elastic_requester.build_actions(objects, "update", id_key, upsert=True)
+
+    def prepare(objects: list) -> Tuple[List[dict], Dict[str, bytes]]:
+        """Действия пачки и хэши документов, которые нужно запомнить после загрузки"""
+        return filter_actions(elastic_requester.hash_store, to_index, make_actions(objects), skip_unchanged, skipped)
+
+    def extract() -> Iterator[Tuple[list, Any]]:
+        for objects in batches:
+            yield objects, watermark()
+
+    def transform(batch: Tuple[list, Any]) -> Tuple[List[dict], Dict[str, bytes], Any]:
+        objects, upd_at = batch
+        return (*prepare(objects), upd_at)
+
+    def load(batch: Tuple[List[dict], Dict[str, bytes], Any]) -> None:
+        nonlocal loaded
+        actions, hashes, upd_at = batch
+        check_lease(stop)
+        if actions:
+            elastic_requester.make_bulk_request(to_index=to_index, actions=actions)
+            elastic_requester.remember_hashes(to_index, hashes)
+        check_lease(stop)
+        state.set_state(state_field, upd_at)
+        loaded += len(actions)
+
+    if elastic_requester.bulk_settings.streaming:
+        loaded = stream_to_elastic(batches, watermark, elastic_requester, state, state_field, to_index, prepare, stop)
+    else:
+        Pipeline(conf.etl.pipeline_queue_size).run(extract(), transform, load)
+
+    log_load_stats(f"{state_field} -> {to_index}", loaded, time.monotonic() - started, skipped)
+    return loaded
+
+
+def check_lease(stop: Optional[threading.Event]) -> None:
+    """Прерывание загрузки, если загрузчик потерял аренду"""
+    if stop is not None and stop.is_set():
+        raise LeaseLost("Аренда загрузчика потеряна, загрузка прервана")
+
+
+def filter_actions(
+    hash_store: Optional[ContentHashStore],
+    to_index: str,
+    actions: List[dict],
+    skip_unchanged: bool,
+    skipped: dict,
+) -> Tuple[List[dict], Dict[str, bytes]]:
+    """
+    Отбрасывание действий с неизменившимися документами (при skip_unchanged) или сброс
+    хэшей документов, которые меняются частично. Возвращает действия и хэши, которые
+    нужно запомнить после загрузки. Счётчики пропущенных документов и байт копятся в skipped
+    """
+    if hash_store is None:
+        return actions, {}
+    if not skip_unchanged:
+        hash_store.forget(to_index, (action["_id"] for action in actions))
+        return actions, {}
+    changed, hashes, skipped_bytes = hash_store.filter_changed(to_index, actions)
+    skipped["docs"] += len(actions) - len(changed)
+    skipped["bytes"] += skipped_bytes
+    return changed, hashes
+
+
+def log_load_stats(phase: str, loaded: int, elapsed: float, skipped: dict) -> None:
+    if loaded:
+        log_rate(phase, loaded, elapsed)
+    if skipped["docs"]:
+        logging.info(f"{phase}: без изменений пропущено {skipped['docs']} документов, {skipped['bytes']} байт")
+
 
+def log_rate(phase: str, loaded: int, elapsed: float) -> None:
+    """Логирование скорости загрузки"""
+    logging.info(f"{phase}: {loaded} документов за {elapsed:.1f} с ({loaded / max(elapsed, 1e-6):.0f} док/с)")
+
+
+def stream_to_elastic(
+    batches: Iterator[list],
+    watermark: Callable[[], Any],
+    elastic_requester: ElasticRequester,
+    state: State,
+    state_field: str,
+    to_index: str,
+    prepare: Callable[[list], Tuple[List[dict], Dict[str, bytes]]],
+    stop: Optional[threading.Event] = None,
+) -> int:
+    """
+    Потоковая загрузка пачек dataclass'ов в индекс to_index через ElasticRequester.stream_bulk.
+    prepare превращает пачку в действия и хэши документов (см. load_to_elastic).
+
+    Действия всех пачек отправляются одним потоком, поэтому для каждой пачки запоминается
+    количество её действий, значение состояния и хэши. Ответы ES приходят в порядке отправки:
+    когда подтверждены все действия пачки, её хэши запоминаются, а значение записывается в state.
+
+    Если ES не принял хотя бы один документ, следующие пачки уже не отправляются, а state
+    остаётся на последней полностью подтверждённой пачке. Когда ответы на отправленные действия
+    получены, выбрасывается BulkIndexError, как и при загрузке без потока: следующий запуск
+    загрузчика начнёт с пачки с ошибкой и отправит её документы повторно.
+    Так же, но с LeaseLost, загрузка прерывается, когда установлен stop (см. load_to_elastic)
+    """
+    # [количество неподтверждённых действий, значение состояния, хэши, были ли ошибки] для каждой пачки
+    pending = deque()
+    errors = []
+
+    def actions() -> Iterator[dict]:
+        for objects in batches:
+            if errors or (stop is not None and stop.is_set()):
+                return
+            batch_actions, hashes = prepare(objects)
+            pending.append([len(batch_actions), watermark(), hashes, False])
+            yield from batch_actions
+
+    def commit_done() -> None:
+        while pending and pending[0][0] == 0 and not pending[0][3]:
+            if stop is not None and stop.is_set():
+                return
+            _, upd_at, hashes, _ = pending.popleft()
+            elastic_requester.remember_hashes(to_index, hashes)
+            state.set_state(state_field, upd_at)
+
+    loaded = 0
+    for ok, info in elastic_requester.stream_bulk(actions(), to_index):
+        commit_done()
+        # Пачки с ошибками остаются в очереди, поэтому ответ относится к первой пачке,
+        # в которой ещё есть неподтверждённые действия
+        batch = next(batch for batch in pending if batch[0] > 0)
+        if ok:
+            loaded += 1
+        else:
+            _, result = info.popitem()
+            errors.append(result)
+            batch[3] = True
+            logging.error(f"Документ {result.get('_id')} не загружен в {to_index}: {result.get('error')}")
+        batch[0] -= 1
+        commit_done()
+    commit_done()
+    logging.info(f"Загружено в {to_index}: {loaded}, ошибок: {len(errors)}")
+    check_lease(stop)
+    if errors:
+        raise helpers.BulkIndexError(f"{len(errors)} документов не загружено в {to_index}", errors)
+    return loaded
 
 
 def fw_producer(
@@ -351,37 +877,54 @@ def fw_producer(
     elastic_requester: ElasticRequester,
     state: State,
     limit: int,
-):
+    itersize: Optional[int] = None,
+    shard: Optional[int] = None,
+    shard_count: Optional[int] = None,
+    to_index: str = "movies",
+    stop: Optional[threading.Event] = None,
+) -> int:
     """
-    Выгрузка таблицы film_work
+    Выгрузка таблицы film_work.
+    Если задан shard, выгружаются только фильмы этого шарда (из shard_count),
+    и у шарда свой ключ в state
     """
-    logging.info("Запуск выгрузки film_work")
-    # Считывание updated_at из state файла
-    updated_at = state.get_state("film_work_upd_at")
+    logging.info("Запуск выгрузки film_work" + ("" if shard is None else f", шард {shard}"))
+    sql_values = {"sql_limit": limit}
+    state_field = "film_work_upd_at"
+    if shard is not None:
+        sql_values.update(shard=shard, shard_count=shard_count)
+        state_field = f"film_work_upd_at:{shard}"
+    # Считывание updated_at из state файла. Шард, который ещё не выгружался,
+    # начинает с общего состояния film_work
+    sql_values["updated_at"] = state.get_state(state_field, state.get_state("film_work_upd_at"))
 
     film_work_producer = Producer(
         pg_connection,
-        sql_query=sql_queries.fw_full_sql_query(),
-        sql_values={"updated_at": updated_at, "sql_limit": limit},
+        sql_query=sql_queries.fw_full_sql_query(sharded=shard is not None),
+        sql_values=sql_values,
         data_class=FilmWork,
         offset_by="updated_at",
+        itersize=itersize,
+        key_field="fw_id",
     )
 
-    # Итерация по данным из базы
-    # Загрузчик film_work_producer возвращает для работы
-    # список dataclass'ов
-    for film_work_objects in film_work_producer.generator():
-
-        # Подготовка bulk запроса. Список с dataclass'ами передаётся в
-        # ElasticRequester для форматирования
-        elastic_requester.prepare_bulk(
-            film_work_objects, "update", "fw_id", upsert=True
-        )
-        res = elastic_requester.make_bulk_request(to_index="movies")
-        # запись в state_file последнего успешно записанного значения updated_at
-        state.set_state("film_work_upd_at", film_work_producer.last_upd_at)
+    # Загрузчик film_work_producer возвращает для работы списки dataclass'ов,
+    # которые форматируются в bulk запросы и отправляются в ES. После каждого
+    # запроса в state_file записывается последнее успешно записанное значение updated_at
+    loaded = load_to_elastic(
+        film_work_producer.generator(),
+        lambda: film_work_producer.last_upd_at,
+        elastic_requester,
+        state,
+        state_field=state_field,
+        to_index=to_index,
+        id_key="fw_id",
+        stop=stop,
+        skip_unchanged=True,
+    )
 
     logging.info("Выгрузка film_work завершена")
+    return loaded
 
 
 def persons_or_genres_producer(
@@ -390,7 +933,10 @@ def persons_or_genres_producer(
     state: State,
     limit: int,
     data_type: str,
-):
+    itersize: Optional[int] = None,
+    to_index: str = "movies",
+    stop: Optional[threading.Event] = None,
+) -> int:
     """
     Выгрузка таблицы person\genre
     """
@@ -402,6 +948,9 @@ def persons_or_genres_producer(
             "related_id": "person_id",
             "dataclass": FilmWorkPersons,
             "sql_query": sql_queries.fw_persons_sql_query(),
+            "name_column": "full_name",
+            "role_column": "role",
+            "fields": {"actor": "actors", "writer": "writers", "director": "directors"},
         },
         "genre": {
             "state_field": "genre_upd_at",
@@ -410,6 +959,9 @@ def persons_or_genres_producer(
             "related_id": "genre_id",
             "dataclass": FilmWorkGenres,
             "sql_query": sql_queries.fw_genres_sql_query(),
+            "name_column": "name",
+            "role_column": None,
+            "fields": {None: "genre"},
         },
     }
     if dispatcher.get(data_type) is None:
@@ -420,6 +972,41 @@ def persons_or_genres_producer(
     logging.info(f"Запуск выгрузки {data_type}")
     updated_at = state.get_state(dispatcher[data_type]["state_field"])
 
+    if conf.etl.nested_updates == "script":
+        # Инкрементальная денормализация: в документы фильмов отправляются
+        # только изменённые персоны/жанры (см. NestedUpdater)
+        dispatch = dispatcher[data_type]
+        pg_producer = Producer(
+            pg_connection,
+            sql_query=sql_queries.nested_changed_sql(dispatch["table_name"], dispatch["name_column"]),
+            sql_values={"updated_at": updated_at, "limit": itersize or limit},
+            data_class=NestedRecord,
+            offset_by="updated_at",
+            key_field="id",
+        )
+        updater = NestedUpdater(
+            pg_connection,
+            pg_producer,
+            sql_query=sql_queries.nested_links_sql(
+                dispatch["related_table"], dispatch["related_id"], dispatch["role_column"], list(dispatch["fields"])
+            ),
+            fields=dispatch["fields"],
+            name_key=dispatch["name_column"],
+        )
+        loaded = load_to_elastic(
+            updater.generator(),
+            lambda: pg_producer.last_upd_at,
+            elastic_requester,
+            state,
+            state_field=dispatch["state_field"],
+            to_index=to_index,
+            id_key="fw_id",
+            make_actions=elastic_requester.build_script_actions,
+            stop=stop,
+        )
+        logging.info(f"Выгрузка {data_type} завершена")
+        return loaded
+
     # Здесь создаются загрузчики трех уровней как в архитектуре ETL: producer, enricher, merger
     # для каждого загрузчика - свой sql запрос
     pg_producer = Producer(
@@ -428,6 +1015,8 @@ def persons_or_genres_producer(
         sql_values={"updated_at": updated_at, "limit": limit},
         offset_by="updated_at",
         produce_field="id",
+        itersize=itersize,
+        key_field="id",
     )
     pg_enricher = Enricher(
         pg_connection,
@@ -435,7 +1024,9 @@ def persons_or_genres_producer(
         sql_query=sql_queries.nested_fw_ids_sql(
             dispatcher[data_type]["related_table"], dispatcher[data_type]["related_id"]
         ),
-        sql_values={"offset": 0, "limit": limit},
+        # При потоковом чтении limit может быть большим, а Enricher читает данные
+        # без потока - поэтому его пачки ограничиваются размером потоковой пачки
+        sql_values={"limit": itersize or limit},
         enrich_by="data_ids",
         produce_field="id",
     )
@@ -452,20 +1043,29 @@ def persons_or_genres_producer(
     # В результате работы этого загрузчика, в ES отправляются только персоны\жанры, остальные данные
     # по фильму не загружаются. Если фильма не было на момент создания, то он будет создан по id, благодаря upsert,
     # но вся остальная информация в него попадёт только на момент работы функции fw_producer (которая была выше)
-    for pgfw_objects in pg_merger.generator():
-
-        elastic_requester.prepare_bulk(pgfw_objects, "update", "fw_id", upsert=True)
-        res = elastic_requester.make_bulk_request(to_index="movies")
-        state.set_state(dispatcher[data_type]["state_field"], pg_producer.last_upd_at)
+    loaded = load_to_elastic(
+        pg_merger.generator(),
+        lambda: pg_producer.last_upd_at,
+        elastic_requester,
+        state,
+        state_field=dispatcher[data_type]["state_field"],
+        to_index=to_index,
+        id_key="fw_id",
+        stop=stop,
+    )
 
     logging.info(f"Выгрузка {data_type} завершена")
+    return loaded
 
 def persons(
     pg_connection: PostgresConnection,
     elastic_requester: ElasticRequester,
     state: State,
     limit: int,
-):
+    itersize: Optional[int] = None,
+    to_index: str = "persons",
+    stop: Optional[threading.Event] = None,
+) -> int:
     """
     Выгрузка таблицы persons
     """
@@ -479,18 +1079,24 @@ def persons(
         sql_values={"updated_at": updated_at, "limit": limit},
         data_class=Person,
         offset_by="updated_at",
+        itersize=itersize,
+        key_field="id",
     )
 
-    for film_work_objects in full_persons_producer.generator():
-
-        elastic_requester.prepare_bulk(
-            film_work_objects, "update", "id", upsert=True
-        )
-        res = elastic_requester.make_bulk_request(to_index="persons")
-        # запись в state_file последнего успешно записанного значения updated_at
-        state.set_state("persons_full_upd_at", full_persons_producer.last_upd_at)
+    loaded = load_to_elastic(
+        full_persons_producer.generator(),
+        lambda: full_persons_producer.last_upd_at,
+        elastic_requester,
+        state,
+        state_field="persons_full_upd_at",
+        to_index=to_index,
+        id_key="id",
+        stop=stop,
+        skip_unchanged=True,
+    )
 
     logging.info("Выгрузка full_persons завершена")
+    return loaded
 
 
 def genres(
@@ -498,7 +1104,10 @@ def genres(
     elastic_requester: ElasticRequester,
     state: State,
     limit: int,
-):
+    itersize: Optional[int] = None,
+    to_index: str = "genres",
+    stop: Optional[threading.Event] = None,
+) -> int:
     """
     Выгрузка таблицы genres
     """
@@ -512,58 +1121,572 @@ def genres(
         sql_values={"updated_at": updated_at, "limit": limit},
         data_class=Genre,
         offset_by="updated_at",
+        itersize=itersize,
+        key_field="id",
+    )
+
+    loaded = load_to_elastic(
+        full_genres_producer.generator(),
+        lambda: full_genres_producer.last_upd_at,
+        elastic_requester,
+        state,
+        state_field="genres_full_upd_at",
+        to_index=to_index,
+        id_key="id",
+        stop=stop,
+        skip_unchanged=True,
     )
 
-    for film_work_objects in full_genres_producer.generator():
+    logging.info("Выгрузка full_genres завершена")
+    return loaded
+
+
+class ChangeConsumer:
+    """
+    Загрузчик в режиме CDC (change data capture).
+
+    Триггеры таблиц контента (см. db_schema.sql) записывают изменённые записи в журнал
+    content.changelog и отправляют уведомление в канал content_changes. ChangeConsumer
+    слушает этот канал и по уведомлению читает новые записи журнала, после чего
+    переиндексирует только затронутые документы: фильмы (в том числе фильмы изменённых
+    персон и жанров), персоны и жанры. Документы удалённых записей удаляются из индексов.
+
+    Обработанные записи удаляются из журнала по своим id, и каждый раз читаются все
+    оставшиеся: отсечки по номеру последней записи нет, потому что транзакции фиксируются
+    не в порядке выдачи id, и запись с меньшим id может появиться в журнале позже.
+    Номер последней обработанной записи сохраняется в state только как признак того,
+    что журнал уже обрабатывался. Если уведомлений нет, журнал всё равно проверяется раз
+    в wait_timeout секунд - на случай потерянного уведомления.
+
+    Записи журнала читаются с блокировкой (FOR UPDATE SKIP LOCKED) до фиксации их удаления,
+    поэтому одну и ту же запись не обработают два экземпляра ETL. При общем состоянии
+    в Redis журнал к тому же обрабатывает только владелец аренды (см. __main__).
+    """
+
+    channel = "content_changes"
+
+    def __init__(
+        self,
+        pg_dsl: dict,
+        elastic_requester: ElasticRequester,
+        state: State,
+        limit: int,
+        wait_timeout: int,
+    ) -> None:
+        self.pg_connection = PostgresConnection(pg_dsl)
+        self.listen_connection = PostgresConnection(pg_dsl)
+        self.elastic_requester = elastic_requester
+        self.state = state
+        self.limit = limit
+        self.wait_timeout = wait_timeout
+
+    def connect(self) -> None:
+        self.pg_connection.connect()
+        self.listen_connection.connect()
+        # Уведомления приходят только вне транзакции
+        self.listen_connection.connection.autocommit = True
+        self.listen_connection.execute(SQL("LISTEN {}").format(Identifier(self.channel)))
+
+    def close(self) -> None:
+        self.pg_connection.close()
+        self.listen_connection.close()
+
+    def run(self, stop: Optional[threading.Event] = None) -> None:
+        """
+        Обработка журнала, пока не установлено событие stop (потеря аренды, см. leased_job).
+        Пачка, обработка которой прервана, остаётся в журнале
+        """
+        logging.info("Запуск загрузки изменений (CDC)")
+        self.connect()
+        try:
+            while stop is None or not stop.is_set():
+                try:
+                    # Канал уже слушается, поэтому изменения, сделанные во время
+                    # обработки, разбудят следующее ожидание
+                    while self.process_changes(stop):
+                        pass
+                    self.state.flush()
+                    self.wait()
+                except psycopg2.OperationalError as err:
+                    logging.error(f"Error connecting to postgres while CDC: {err}")
+                    logging.error("Trying to reconnect")
+                    self.connect()
+                except LeaseLost as err:
+                    logging.error(str(err))
+                    return
+        finally:
+            self.close()
+
+    def wait(self) -> None:
+        """Ожидание уведомления, но не дольше wait_timeout секунд"""
+        connection = self.listen_connection.connection
+        if select.select([connection], [], [], self.wait_timeout) != ([], [], []):
+            connection.poll()
+            connection.notifies.clear()
+
+    def process_changes(self, stop: Optional[threading.Event] = None) -> bool:
+        """
+        Обработка очередной пачки записей журнала.
+        Возвращает True, если пачка была полной и в журнале могут остаться записи
+        """
+        rows = self.pg_connection.query(sql_queries.changelog_sql(), {"limit": self.limit})
+        if len(rows) == 0:
+            self.pg_connection.connection.rollback()
+            return False
 
-        elastic_requester.prepare_bulk(
-            film_work_objects, "update", "id", upsert=True
+        changed = {"film_work": set(), "person": set(), "genre": set()}
+        for row in rows:
+            changed[row["table_name"]].add(row["record_id"])
+        film_ids = (
+            changed["film_work"]
+            | self.related_films("person_film_work", "person_id", changed["person"])
+            | self.related_films("genre_film_work", "genre_id", changed["genre"])
         )
-        res = elastic_requester.make_bulk_request(to_index="genres")
-        # запись в state_file последнего успешно записанного значения updated_at
-        state.set_state("genres_full_upd_at", full_genres_producer.last_upd_at)
+        self.reindex(film_ids, sql_queries.fw_by_ids_sql_query(), "filmwork_ids", FilmWork, "fw_id", "movies")
+        self.reindex(changed["person"], sql_queries.person_by_ids_sql(), "data_ids", Person, "id", "persons")
+        self.reindex(changed["genre"], sql_queries.genre_by_ids_sql(), "data_ids", Genre, "id", "genres")
+
+        # Без аренды пачку не удаляем: транзакция откатится, и записи обработает её владелец
+        check_lease(stop)
+        ids = [row["id"] for row in rows]
+        self.state.set_state("changelog_id", max(ids[-1], self.state.get_state("changelog_id")))
+        self.pg_connection.execute(sql_queries.changelog_cleanup_sql(), {"ids": ids})
+        self.pg_connection.connection.commit()
+        logging.info(
+            f"Обработано изменений: {len(rows)}. Фильмов: {len(film_ids)}, "
+            f"персон: {len(changed['person'])}, жанров: {len(changed['genre'])}"
+        )
+        return len(rows) == self.limit
+
+    def chunks(self, ids: set) -> Iterator[tuple]:
+        ids = list(ids)
+        for start in range(0, len(ids), self.limit):
+            yield tuple(ids[start:start + self.limit])
+
+    def related_films(self, related_table: str, related_id: str, ids: set) -> set:
+        """id фильмов, связанных с персонами/жанрами ids"""
+        films = set()
+        for chunk in self.chunks(ids):
+            rows = self.pg_connection.query(
+                sql_queries.related_fw_ids_sql(related_table, related_id), {"data_ids": chunk}
+            )
+            films.update(row["id"] for row in rows)
+        return films
 
-    logging.info("Выгрузка full_genres завершена")
+    def reindex(
+        self,
+        ids: set,
+        sql_query: SQL,
+        placeholder: str,
+        data_class: dataclasses,
+        id_key: str,
+        to_index: str,
+    ) -> None:
+        """Переиндексация документов ids. Документы, которых больше нет в базе, удаляются"""
+        for chunk in self.chunks(ids):
+            rows = self.pg_connection.query(sql_query, {placeholder: chunk})
+            objects = [data_class(**row) for row in rows]
+            if objects:
+                actions = self.elastic_requester.build_actions(objects, "update", id_key, upsert=True)
+                self.elastic_requester.make_bulk_request(to_index=to_index, actions=actions)
+                if self.elastic_requester.hash_store is not None:
+                    # Документы загружены в обход load_to_elastic: их прежние хэши неактуальны
+                    self.elastic_requester.hash_store.forget(to_index, (action["_id"] for action in actions))
+            found = {str(getattr(obj, id_key)) for obj in objects}
+            deleted = [doc_id for doc_id in chunk if doc_id not in found]
+            if deleted:
+                self.elastic_requester.delete_documents(deleted, to_index)
+
+
+def loader_job(
+    pg_dsl: dict, loader: Callable, elastic_requester: ElasticRequester, state: State, *args, **kwargs
+) -> Callable[..., Any]:
+    """
+    Задача планировщика для загрузчика loader. У каждой задачи своё соединение с Postgres:
+    оно открывается при первом запуске и переиспользуется между запусками
+    """
+    return connection_job(PostgresConnection(pg_dsl), loader, elastic_requester, state, *args, **kwargs)
+
+
+def connection_job(
+    pg_connection: PostgresConnection,
+    loader: Callable,
+    elastic_requester: ElasticRequester,
+    state: State,
+    *args,
+    **kwargs,
+) -> Callable[..., Any]:
+    """
+    Задача для загрузчика loader с соединением pg_connection. Соединение можно отдать
+    нескольким задачам, если они выполняются по очереди (см. sharded_fw_job).
+    stop передаётся загрузчику: установленный stop прерывает загрузку (см. leased_job).
+    В конце каждого запуска накопленное состояние сохраняется на диск
+    """
+
+    def job(stop: Optional[threading.Event] = None) -> Any:
+        if pg_connection.connection is None or pg_connection.connection.closed:
+            pg_connection.connect()
+        try:
+            return loader(pg_connection, elastic_requester, state, *args, stop=stop, **kwargs)
+        finally:
+            state.flush()
+            # Завершаем транзакцию, чтобы соединение не держало её открытой до следующего запуска
+            if not pg_connection.connection.closed:
+                pg_connection.connection.rollback()
+
+    return job
+
+
+def locked_job(job: Callable[..., Any], lock: Any) -> Callable[..., Any]:
+    """Задача, которая выполняется под блокировкой lock (любой контекстный менеджер)"""
+
+    def wrapper(*args, **kwargs) -> Any:
+        with lock:
+            return job(*args, **kwargs)
+
+    return wrapper
+
+
+def lease_group_job(job: Callable[[threading.Event], Any], group: LeaseGroup) -> Callable[..., Any]:
+    """
+    Задача, которая выполняется под арендами group. Потеря любой из них устанавливает
+    то же событие stop, что и потеря аренды самой задачи (см. leased_job): загрузка прерывается
+    """
+
+    def wrapper(stop: Optional[threading.Event] = None) -> Any:
+        stop = stop or threading.Event()
+        with group.hold(stop):
+            return job(stop)
+
+    return wrapper
+
+
+def leased_job(
+    job: Callable[[threading.Event], Any], lease: RedisLease, state: State, wait: bool = False
+) -> Callable[[], None]:
+    """
+    Задача, которая выполняется, только если удалось арендовать её lease:
+    несколько экземпляров ETL не выполняют одну и ту же загрузку одновременно.
+    При wait задача не пропускается, а дожидается, пока другой экземпляр освободит аренду.
+    Перед запуском состояние перечитывается - его мог изменить другой экземпляр.
+    job получает событие, которое устанавливается, если аренду не удалось продлить:
+    загрузку нужно прервать, не сохраняя состояние, - её уже может выполнять другой экземпляр
+    """
+
+    def wrapper() -> None:
+        if wait:
+            lease.acquire_wait()
+        elif not lease.acquire():
+            logging.info(f"{lease.key} арендован другим экземпляром ETL, пропуск")
+            return
+        lost = threading.Event()
+        stop_renewal = lease.keep_alive(lost)
+        try:
+            state.reload()
+            job(lost)
+        finally:
+            stop_renewal.set()
+            lease.release()
+
+    return wrapper
+
+
+def sharded_fw_job(
+    pg_dsl: dict,
+    elastic_requester: ElasticRequester,
+    state: State,
+    redis_client: redis.Redis,
+    sharding: ShardingConfig,
+    limit: int,
+    itersize: Optional[int],
+) -> Callable[[], None]:
+    """
+    Выгрузка film_work по шардам. За один запуск экземпляр ETL обходит все шарды
+    и выгружает те, которые удалось арендовать, так что экземпляры делят шарды
+    между собой и работают параллельно. Обход начинается со случайного шарда,
+    чтобы одновременно запущенные экземпляры не конкурировали за одни и те же шарды.
+    Шарды экземпляр выгружает по очереди, поэтому соединение с Postgres у них общее
+    """
+    pg_connection = PostgresConnection(pg_dsl)
+    shard_jobs = [
+        leased_job(
+            connection_job(
+                pg_connection, fw_producer, elastic_requester, state, limit, itersize, shard, sharding.shard_count
+            ),
+            RedisLease(redis_client, f"film_work:{shard}", sharding.lease_ttl),
+            state,
+        )
+        for shard in range(sharding.shard_count)
+    ]
+
+    def job() -> None:
+        start = random.randrange(sharding.shard_count)
+        for shard_job in shard_jobs[start:] + shard_jobs[:start]:
+            shard_job()
+
+    return job
+
+
+# Загрузчики, которые пишут в movies. Полный документ фильма, собранный загрузчиком film_work
+# до изменения персоны или жанра, не должен перезаписать это изменение, если загрузчик
+# персон/жанров успел записать его раньше. Поэтому загрузчики movies выполняются по очереди
+MOVIES_WRITERS = ("film_work", "film_work_persons", "film_work_genres")
+
+INDEX_SCHEMES = {
+    "movies": index_schemes.movies_index,
+    "persons": index_schemes.persons_index,
+    "genres": index_schemes.genres_index,
+}
+
+# Загрузчики, которые заполняют индекс с нуля: имя загрузчика, функция и ключ в state
+FULL_LOADERS = {
+    "movies": ("film_work", fw_producer, "film_work_upd_at"),
+    "persons": ("persons", persons, "persons_full_upd_at"),
+    "genres": ("genres", genres, "genres_full_upd_at"),
+}
+
+# Загрузчики персон/жанров в документах movies: тип данных (он же таблица) и ключ в state
+NESTED_LOADERS = (("person", "person_upd_at"), ("genre", "genre_upd_at"))
+
+
+def reindex(
+    pg_dsl: dict,
+    elastic_requester: ElasticRequester,
+    aliases: List[str],
+    limit: int,
+    itersize: Optional[int],
+) -> None:
+    """
+    Полная перестройка индексов без простоя.
+
+    Для каждого индекса создаётся новая версия alias_vN без реплик и refresh,
+    и в неё с нуля загружаются данные из Postgres. Затем возвращаются рабочие
+    настройки, индекс сливается в один сегмент, и alias атомарно переключается
+    на новую версию. API всё это время читает прежнюю версию через alias.
+    Изменения, которые работающий ETL записал в прежнюю версию во время перестройки,
+    догружаются повторными запусками загрузчика до и после переключения.
+
+    Изменения персон и жанров не меняют updated_at фильмов, поэтому для movies
+    так же догружаются и они - загрузчиками персон/жанров в фильмах, начиная
+    с состояния таблиц person и genre на момент начала перестройки
+    """
+    for alias in aliases:
+        index_struct = INDEX_SCHEMES[alias]()
+        replicas = elastic_requester.index_replicas(alias)
+        # Отдельное состояние в памяти: загрузка идёт с нуля и не трогает состояние работающего ETL
+        state = State(SqliteStorage(":memory:"))
+        nested = NESTED_LOADERS if alias == "movies" else ()
+        if nested:
+            with PostgresConnection(pg_dsl) as pg_connection:
+                for data_type, state_field in nested:
+                    updated_at = pg_connection.query(sql_queries.max_updated_at_sql(data_type))[0]["updated_at"]
+                    if updated_at is not None:
+                        state.set_state(state_field, updated_at)
+        new_index = elastic_requester.create_index_version(alias, index_struct, index_schemes.bulk_load_settings())
+        _, loader, _ = FULL_LOADERS[alias]
+        jobs = [loader_job(pg_dsl, loader, elastic_requester, state, limit, itersize, to_index=new_index)]
+        jobs += [
+            loader_job(
+                pg_dsl, persons_or_genres_producer, elastic_requester, state, limit, data_type, itersize,
+                to_index=new_index,
+            )
+            for data_type, _ in nested
+        ]
+
+        def run_catch_up() -> None:
+            for job in jobs:
+                job()
+
+        # Загрузка с нуля, затем догрузка изменений, сделанных за время загрузки
+        run_catch_up()
+        run_catch_up()
+        elastic_requester.update_index_settings(new_index, index_schemes.serving_settings(index_struct, replicas))
+        elastic_requester.forcemerge(new_index)
+        elastic_requester.switch_alias(alias, new_index)
+        # Изменения, которые успели попасть только в прежнюю версию до переключения
+        run_catch_up()
+        if elastic_requester.hash_store is not None:
+            # Хэши новой версии записаны под её именем, а работающий ETL пишет через alias:
+            # первые не понадобятся, а вторые описывают прежнюю версию. Сбрасываются оба набора,
+            # и следующий запуск загрузчика сверяет документы с новой версией заново
+            elastic_requester.hash_store.forget_index(new_index)
+            elastic_requester.hash_store.forget_index(alias)
+
+
+def backfill(
+    pg_dsl: dict,
+    elastic_requester: ElasticRequester,
+    state: State,
+    limit: int,
+    itersize: Optional[int],
+    redis_client: Optional[redis.Redis] = None,
+    lease_ttl: int = 60,
+) -> None:
+    """
+    Первичная загрузка при холодном старте: если состояние загрузчика индекса
+    ещё не менялось, индекс на время загрузки переводится в профиль массовой
+    загрузки (без refresh и реплик, асинхронный translog). Когда загрузчик догнал
+    данные в базе, возвращаются рабочие настройки. Дальнейшая инкрементальная
+    загрузка идёт уже с ними.
+
+    Пока первичная загрузка не завершена, в state хранится отметка backfill:alias
+    с рабочим количеством реплик: если загрузка прервалась, при следующем запуске
+    она продолжается в том же профиле.
+
+    При общем состоянии в Redis загрузка выполняется под арендой загрузчика.
+    Экземпляр, который застал аренду занятой, ждёт окончания загрузки: иначе его
+    загрузчики (и шарды film_work) начали бы загрузку с нуля параллельно с ней
+    """
+    for alias, (name, loader, state_field) in FULL_LOADERS.items():
+        if not backfill_needed(state, alias, state_field):
+            continue
+
+        def job(stop: Optional[threading.Event] = None) -> None:
+            # Под арендой состояние перечитано: загрузку мог уже выполнить другой экземпляр
+            if not backfill_needed(state, alias, state_field):
+                return
+            marker = f"backfill:{alias}"
+            replicas = state.get_state(marker)
+            if replicas is None:
+                replicas = elastic_requester.index_replicas(alias)
+                if elastic_requester.hash_store is not None:
+                    # Загрузка с нуля: хэши прежних загрузок не должны её сокращать
+                    elastic_requester.hash_store.forget_index(alias)
+                state.set_state(marker, replicas)
+                state.flush()
+            logging.info(f"Холодный старт {alias}: профиль массовой загрузки")
+            elastic_requester.update_index_settings(alias, index_schemes.bulk_load_settings())
+            started = time.monotonic()
+            try:
+                loaded = loader_job(pg_dsl, loader, elastic_requester, state, limit, itersize)(stop)
+            finally:
+                settings = index_schemes.serving_settings(INDEX_SCHEMES[alias](), replicas)
+                elastic_requester.update_index_settings(alias, settings)
+                logging.info(f"{alias}: рабочий профиль восстановлен")
+            state.set_state(marker, None)
+            state.flush()
+            log_rate(f"Первичная загрузка {alias}", loaded, time.monotonic() - started)
+
+        if redis_client is not None:
+            job = leased_job(job, RedisLease(redis_client, name, lease_ttl), state, wait=True)
+        job()
+
+
+def backfill_needed(state: State, alias: str, state_field: str) -> bool:
+    """Индекс ещё не загружался или его первичная загрузка не завершена"""
+    return state.is_initial(state_field) or state.get_state(f"backfill:{alias}") is not None
+
+
+def make_state_storage(settings: StateConfig, redis_client: Optional[redis.Redis] = None) -> BaseStorage:
+    """
+    Хранилище состояния по настройкам. При переходе с JSON файла на SQLite или Redis
+    состояние переносится из ./state_file, чтобы не начинать загрузку с нуля
+    """
+    if settings.storage == "json":
+        return JsonFileStorage(file_path=settings.path)
+    if settings.storage == "redis":
+        storage = RedisStorage(redis_client)
+    else:
+        storage = SqliteStorage(file_path=settings.path)
+    if not storage.retrieve_state():
+        legacy_state = JsonFileStorage(file_path="./state_file").retrieve_state()
+        if legacy_state:
+            storage.save_state(legacy_state)
+    return storage
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level="INFO")
+    logging.basicConfig(level="INFO", format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
     logging.info("Начало работы")
 
-    while True:
-        load_dotenv()
-        pg_dsl = {"dbname": os.environ.get("ETL_DB_NAME"), "port": os.environ.get("ETL_DB_PORT"),
-                  "host": os.environ.get("ETL_DB_HOST"), "password": os.environ.get("ETL_DB_PASSWD"),
-                  "user": os.environ.get("ETL_DB_USER")}
-
-        elastic_host = os.environ.get("ETL_ES_HOST")
-        elastic_port = int(os.environ.get("ETL_ES_PORT"))
-
-        with PostgresConnection(pg_dsl) as pg_conn:
-            # with PostgresConnection(conf.pg_database.dict()) as pg_conn:
-            # Предполагается, что на момент старта скрипта необходимые index'ы уже созданы
-            esr = ElasticRequester([elastic_host], port=elastic_port)
-            esr.handle_index("movies", index_schemes.movies_index())
-            esr.handle_index("persons", index_schemes.persons_index())
-            esr.handle_index("genres", index_schemes.genres_index())
-
-            # Считывание state файла. При инициализации класса State
-            # отсутствующие необходимые параметры будут заполнены
-            # значениями по умолчанию. Подробнее см state_control.py
-            js_storage = JsonFileStorage(file_path="./state_file")
-            st = State(js_storage)
-
-            # Запуск сборщиков
-            fw_producer(pg_conn, esr, st, conf.sql_settings.limit)
-            persons_or_genres_producer(
-                pg_conn, esr, st, conf.sql_settings.limit, "person"
-            )
-            persons_or_genres_producer(
-                pg_conn, esr, st, conf.sql_settings.limit, "genre"
-            )
-            persons(pg_conn, esr, st, conf.sql_settings.limit)
-            genres(pg_conn, esr, st, conf.sql_settings.limit)
+    load_dotenv()
+    pg_dsl = {"dbname": os.environ.get("ETL_DB_NAME"), "port": os.environ.get("ETL_DB_PORT"),
+              "host": os.environ.get("ETL_DB_HOST"), "password": os.environ.get("ETL_DB_PASSWD"),
+              "user": os.environ.get("ETL_DB_USER")}
 
-        logging.info(f"Синхронизация закончена. Переход в ждущий режим.")
-        logging.info(f"Следующая синхронизация через {conf.etl.time_interval} секунд.")
-        time.sleep(conf.etl.time_interval)
+    elastic_host = os.environ.get("ETL_ES_HOST")
+    elastic_port = int(os.environ.get("ETL_ES_PORT"))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--reindex", nargs="+", choices=list(INDEX_SCHEMES), metavar="INDEX",
+        help="перестроить индексы без простоя и завершить работу",
+    )
+    args = parser.parse_args()
+
+    hash_store = ContentHashStore(conf.etl.hash_store) if conf.etl.hash_store else None
+    esr = ElasticRequester([elastic_host], port=elastic_port, bulk_settings=conf.bulk, hash_store=hash_store)
+    if args.reindex:
+        reindex(pg_dsl, esr, args.reindex, conf.sql_settings.limit, conf.sql_settings.itersize)
+        logging.info("Перестройка индексов завершена")
+        raise SystemExit
+    for index_name, index_scheme in INDEX_SCHEMES.items():
+        esr.handle_index(index_name, index_scheme())
+
+    # Считывание state файла. При инициализации класса State
+    # отсутствующие необходимые параметры будут заполнены
+    # значениями по умолчанию. Подробнее см state_control.py
+    redis_client = None
+    if conf.state.storage == "redis":
+        redis_client = redis.Redis(
+            host=os.environ.get("ETL_REDIS_HOST"), port=int(os.environ.get("ETL_REDIS_PORT", 6379))
+        )
+    st = State(make_state_storage(conf.state, redis_client), flush_interval=conf.state.flush_interval)
+    atexit.register(st.flush)
+
+    # Загрузчики работают параллельно, каждый со своим соединением с Postgres,
+    # своим ключом в state и своим интервалом запуска
+    limit, itersize = conf.sql_settings.limit, conf.sql_settings.itersize
+    loaders = {
+        "film_work": loader_job(pg_dsl, fw_producer, esr, st, limit, itersize),
+        "film_work_persons": loader_job(pg_dsl, persons_or_genres_producer, esr, st, limit, "person", itersize),
+        "film_work_genres": loader_job(pg_dsl, persons_or_genres_producer, esr, st, limit, "genre", itersize),
+        "persons": loader_job(pg_dsl, persons, esr, st, limit, itersize),
+        "genres": loader_job(pg_dsl, genres, esr, st, limit, itersize),
+    }
+    if redis_client is None:
+        movies_lock = threading.Lock()
+        for name in MOVIES_WRITERS:
+            loaders[name] = locked_job(loaders[name], movies_lock)
+    else:
+        # Общее состояние в Redis: можно запускать несколько экземпляров ETL.
+        # Каждый загрузчик в один момент времени выполняет только один экземпляр,
+        # а film_work при заданном shard_count делится между экземплярами по шардам
+        lease_ttl = conf.state.sharding.lease_ttl
+        # Загрузчики персон/жанров в фильмах дожидаются и удерживают аренды film_work
+        # (всех его шардов), поэтому не пересекаются с ним ни в одном из экземпляров ETL.
+        # Шарды film_work между собой по-прежнему загружаются параллельно
+        shard_count = conf.state.sharding.shard_count
+        fw_leases = [f"film_work:{shard}" for shard in range(shard_count)] if shard_count else ["film_work"]
+        for name in ("film_work_persons", "film_work_genres"):
+            leases = LeaseGroup([RedisLease(redis_client, lease, lease_ttl) for lease in fw_leases])
+            loaders[name] = lease_group_job(loaders[name], leases)
+        loaders = {
+            name: leased_job(job, RedisLease(redis_client, name, lease_ttl), st) for name, job in loaders.items()
+        }
+        if conf.state.sharding.shard_count > 0:
+            loaders["film_work"] = sharded_fw_job(
+                pg_dsl, esr, st, redis_client, conf.state.sharding, limit, itersize
+            )
+    backfill(pg_dsl, esr, st, limit, itersize, redis_client, conf.state.sharding.lease_ttl)
+
+    if conf.etl.mode == "cdc":
+        # При первом запуске в режиме CDC журнал изменений ещё пуст: данные, изменённые
+        # до появления триггеров, догружаются обычными загрузчиками
+        if st.get_state("changelog_id") == 0:
+            for job in loaders.values():
+                job()
+        # Журнал изменений заменяет загрузчики по расписанию. Несколько экземпляров ETL
+        # не обрабатывают журнал одновременно: остальные ждут аренду, пока её не освободят
+        consumer = ChangeConsumer(pg_dsl, esr, st, limit, conf.etl.cdc_wait_timeout)
+        cdc_job = consumer.run
+        if redis_client is not None:
+            cdc_job = leased_job(consumer.run, RedisLease(redis_client, "changelog", conf.state.sharding.lease_ttl),
+                                 st, wait=True)
+        while True:
+            cdc_job()
+    else:
+        scheduler = Scheduler()
+        for name, job in loaders.items():
+            scheduler.add(name, job, conf.etl.intervals.get(name, conf.etl.time_interval))
+        scheduler.run()
@@ -3,6 +3,8 @@
 # В данном случае - def parse_config в Config
 # Моя версия python 3.8.10
 from __future__ import annotations
+from typing import Optional, Dict, Literal
+
 import toml
 from pydantic import BaseModel
 
@@ -15,6 +17,12 @@ class PostgresConfig(BaseModel):
 
 class SqlConfig(BaseModel):
     limit: int
+    # Размер пачки при потоковом чтении через серверный курсор.
+    # Если не задан, результат каждого запроса читается целиком
+    itersize: Optional[int] = None
+    # Сколько секунд серверный курсор (и его транзакция) может оставаться открытым,
+    # считая время загрузки уже прочитанных пачек. Затем запрос повторяется с места остановки
+    cursor_max_age: Optional[float] = 60
 
 
 class ElasticConfig(BaseModel):
@@ -26,8 +34,58 @@ class BackoffConfig(BaseModel):
     max_time: int
 
 
+class BulkConfig(BaseModel):
+    # Потоковая отправка действий в ES через helpers.parallel_bulk
+    # вместо одного bulk запроса на пачку
+    streaming: bool = False
+    # Количество потоков (и одновременно выполняющихся bulk запросов)
+    thread_count: int = 4
+    # Ограничения размера одного bulk запроса: по количеству действий и в байтах
+    chunk_size: int = 500
+    max_chunk_bytes: int = 10 * 1024 * 1024
+    # Сколько подготовленных bulk запросов может ждать свободного потока
+    queue_size: int = 4
+
+
 class EtlConfig(BaseModel):
+    # poll - периодический опрос таблиц по updated_at,
+    # cdc - загрузка изменений из журнала content.changelog по уведомлениям Postgres
+    mode: Literal["poll", "cdc"] = "poll"
+    # В режиме cdc: как часто проверять журнал, если уведомлений нет
+    cdc_wait_timeout: int = 5
     time_interval: int
+    # Интервалы запуска отдельных загрузчиков, если они отличаются от time_interval
+    intervals: Dict[str, int] = {}
+    # Размер очередей между стадиями конвейера загрузки.
+    # 0 - стадии выполняются последовательно в одном потоке.
+    # Только при bulk.streaming = false: при потоковой загрузке чтение следующих пачек
+    # и так идёт одновременно с загрузкой, а буфер ограничивает bulk.queue_size
+    pipeline_queue_size: int = 2
+    # Обновление персон и жанров в документах фильмов:
+    # script - только изменённые вложенные записи скриптом (инкрементально),
+    # merge - пересборка всех персон/жанров затронутых фильмов
+    nested_updates: Literal["script", "merge"] = "script"
+    # Файл хранилища хэшей загруженных документов: документы, содержимое которых
+    # не изменилось, повторно не отправляются. Не задан - отправляются все
+    hash_store: Optional[str] = None
+
+
+class ShardingConfig(BaseModel):
+    # Количество шардов film_work, которые делят между собой экземпляры ETL.
+    # 0 - film_work выгружается целиком одним экземпляром
+    shard_count: int = 0
+    # Время аренды загрузчика или шарда, сек. Пока загрузка идёт, аренда продлевается
+    lease_ttl: int = 60
+
+
+class StateConfig(BaseModel):
+    # json - файл с атомарной заменой, sqlite - база SQLite в режиме WAL,
+    # redis - общее состояние для нескольких экземпляров ETL (ETL_REDIS_HOST, ETL_REDIS_PORT)
+    storage: Literal["json", "sqlite", "redis"] = "json"
+    path: str = "./state_file"
+    # Не чаще чем раз в столько секунд состояние сохраняется на диск
+    flush_interval: float = 5
+    sharding: ShardingConfig = ShardingConfig()
 
 
 class Config(BaseModel):
@@ -36,6 +94,8 @@ class Config(BaseModel):
     backoff: BackoffConfig
     sql_settings: SqlConfig
     etl: EtlConfig
+    bulk: BulkConfig = BulkConfig()
+    state: StateConfig = StateConfig()
 
     @classmethod
     def parse_config(cls, file_path: str) -> Config:
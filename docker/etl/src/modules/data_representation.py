@@ -1,50 +1,136 @@
 import datetime
 import uuid
 from dataclasses import dataclass, field, fields
-from typing import List
-
-
-@dataclass
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, List, Optional, Sequence
+
+
+def es_document(rename: Optional[dict] = None, skip: Sequence[str] = ()) -> Callable[[type], type]:
+    """
+    Декоратор dataclass'а, добавляющий метод elastic_format - документ для ES.
+    Соответствие полей dataclass'а полям документа вычисляется один раз для класса,
+    а не при каждом вызове: rename - переименование полей, skip - поля, которых
+    в документе нет
+    """
+
+    def wrap(cls: type) -> type:
+        attrs = [model_field.name for model_field in fields(cls) if model_field.name not in skip]
+        keys = tuple((rename or {}).get(attr, attr) for attr in attrs)
+        values = attrgetter(*attrs)
+        if len(attrs) == 1:
+            # attrgetter с одним полем возвращает значение, а не кортеж
+            single = values
+            values = lambda obj: (single(obj),)
+
+        def elastic_format(self) -> dict:
+            return dict(zip(keys, values(self)))
+
+        cls.elastic_format = elastic_format
+        return cls
+
+    return wrap
+
+
+def row_loader(data_class: type, columns: List[str]) -> Callable[[Sequence], Any]:
+    """
+    Функция сборки объектов data_class из строк курсора с колонками columns.
+    Соответствие колонок полям вычисляется один раз на запрос. Если колонки покрывают
+    первые поля dataclass'а, строка передаётся в конструктор позиционно, без словаря
+    """
+    names = [model_field.name for model_field in fields(data_class)]
+    covered = 0
+    while covered < len(names) and names[covered] in columns:
+        covered += 1
+    if covered == len(columns):
+        order = itemgetter(*(columns.index(name) for name in names[:covered]))
+        if covered == 1:
+            return lambda row: data_class(order(row))
+        return lambda row: data_class(*order(row))
+    return lambda row: data_class(**dict(zip(columns, row)))
+
+
+@dataclass(slots=True)
 class BaseRecord:
     id: uuid.UUID = field(default=None)
     updated_at: datetime.datetime = field(default=None)
 
 
-@dataclass
+@es_document(skip=("fw_id",))
+@dataclass(slots=True)
 class FilmWorkGenres:
     fw_id: uuid.UUID = field(default=None)
     genre: List = field(default_factory=list)
 
-    def elastic_format(self) -> dict:
-        di = {}
-        for model_field in fields(self):
-            f_name = model_field.name
-            if f_name == "fw_id":
-                continue
-            if f_name == "genres":
-                f_name = "genre"
-            di[f_name] = getattr(self, model_field.name)
-        return di
 
-
-@dataclass
+@es_document(skip=("fw_id",))
+@dataclass(slots=True)
 class FilmWorkPersons:
     fw_id: uuid.UUID = field(default=None)
     directors: List = field(default_factory=list)
     actors: List = field(default_factory=list)
     writers: List = field(default_factory=list)
 
-    def elastic_format(self) -> dict:
-        di = {}
-        for model_field in fields(self):
-            f_name = model_field.name
-            if f_name == "fw_id":
-                continue
-            di[f_name] = getattr(self, model_field.name)
-        return di
+
+@dataclass(slots=True)
+class NestedRecord:
+    id: uuid.UUID = field(default=None)
+    name: str = field(default=None)
+    updated_at: datetime.datetime = field(default=None)
+
+
+# Обновление вложенных записей фильма на месте: имя записи с тем же uuid заменяется,
+# отсутствующая запись добавляется. Если ничего не изменилось, документ не переписывается.
+# Удалённые связи скрипт не убирает: фильм с изменёнными связями пересобирается целиком
+# загрузчиком film_work (см. NestedUpdater)
+NESTED_UPDATE_SCRIPT = """
+boolean changed = false;
+for (entry in params.entries) {
+    if (ctx._source[entry.field] == null) {
+        ctx._source[entry.field] = new ArrayList();
+    }
+    boolean found = false;
+    for (item in ctx._source[entry.field]) {
+        if (item.get('uuid') == entry.uuid) {
+            found = true;
+            if (item.get(params.name_key) != entry.name) {
+                item.put(params.name_key, entry.name);
+                changed = true;
+            }
+        }
+    }
+    if (!found) {
+        Map item = new HashMap();
+        item.put('uuid', entry.uuid);
+        item.put(params.name_key, entry.name);
+        ctx._source[entry.field].add(item);
+        changed = true;
+    }
+}
+if (!changed) {
+    ctx.op = 'noop';
+}
+"""
+
+
+@dataclass(slots=True)
+class FilmWorkNested:
+    """Изменённые персоны или жанры одного фильма"""
+    fw_id: uuid.UUID = field(default=None)
+    # Записи вида {"field": "actors", "uuid": ..., "name": ...}
+    entries: List = field(default_factory=list)
+    # Поле с именем во вложенной записи: full_name у персон, name у жанров
+    name_key: str = field(default="full_name")
+
+    def elastic_script(self) -> dict:
+        return {
+            "source": NESTED_UPDATE_SCRIPT,
+            "lang": "painless",
+            "params": {"entries": self.entries, "name_key": self.name_key},
+        }
 
 
-@dataclass
+@es_document(rename={"fw_id": "uuid"}, skip=("updated_at",))
+@dataclass(slots=True)
 class FilmWork:
     fw_id: uuid.UUID = field(default=None)
     imdb_rating: float = field(default=None)
@@ -57,21 +143,9 @@ class FilmWork:
     updated_at: datetime.datetime = field(default=None)
     subscribe_required: bool = field(default=False)
 
-    def elastic_format(self) -> dict:
-        di = {}
-        for model_field in fields(self):
-            f_name = model_field.name
-            if f_name == "genres":
-                f_name = "genre"
-            if f_name == "fw_id":
-                f_name = "uuid"
-            if f_name == "updated_at":
-                continue
-            di[f_name] = getattr(self, model_field.name)
-        return di
-
-
-@dataclass
+
+@es_document(rename={"id": "uuid"}, skip=("updated_at",))
+@dataclass(slots=True)
 class Person:
     id: uuid.UUID = field(default=None)
     full_name: str = field(default=None)
@@ -79,30 +153,10 @@ class Person:
     film_ids: List = field(default_factory=list)
     updated_at: datetime.datetime = field(default=None)
 
-    def elastic_format(self) -> dict:
-        di = {}
-        for model_field in fields(self):
-            f_name = model_field.name
-            if f_name == "id":
-                f_name = "uuid"
-            if f_name == "updated_at":
-                continue
-            di[f_name] = getattr(self, model_field.name)
-        return di
-
-@dataclass
+
+@es_document(rename={"id": "uuid"}, skip=("updated_at",))
+@dataclass(slots=True)
 class Genre:
     id: uuid.UUID = field(default=None)
     name: str = field(default=None)
     updated_at: datetime.datetime = field(default=None)
-
-    def elastic_format(self) -> dict:
-        di = {}
-        for model_field in fields(self):
-            f_name = model_field.name
-            if f_name == "id":
-                f_name = "uuid"
-            if f_name == "updated_at":
-                continue
-            di[f_name] = getattr(self, model_field.name)
-        return di
\ No newline at end of file
@@ -0,0 +1,112 @@
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+
+class ContentHashStore:
+    """
+    Хэши содержимого документов, уже загруженных в ES.
+
+    Для каждого документа (индекс, id) хранится хэш его содержимого. Перед отправкой
+    bulk запроса действия с документами, хэш которых не изменился, отбрасываются:
+    так правка updated_at без изменения индексируемых полей не приводит к повторной
+    индексации. Хэши пачки запоминаются только после того, как ES подтвердил загрузку
+    всех её документов: если ES не принял документ, при повторной загрузке пачка будет
+    отправлена заново, а не пропущена по хэшу.
+
+    Хранилище - SQLite в режиме WAL, одна таблица без rowid.
+    """
+
+    # Количество id в одном запросе к SQLite
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        # Хранилище используют загрузчики и потоки bulk запросов
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "index_name TEXT NOT NULL, doc_id TEXT NOT NULL, hash BLOB NOT NULL, "
+            "PRIMARY KEY (index_name, doc_id)) WITHOUT ROWID"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def serialize(doc: dict) -> bytes:
+        return json.dumps(doc, sort_keys=True, separators=(",", ":"), default=json_default).encode()
+
+    @staticmethod
+    def digest(data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def filter_changed(self, index_name: str, actions: List[dict]) -> Tuple[List[dict], Dict[str, bytes], int]:
+        """
+        Отбрасывание действий с неизменившимися документами ("doc").
+        Возвращает оставшиеся действия, хэши их документов (запоминаются после
+        загрузки, см. remember) и размер отброшенных документов в байтах
+        """
+        hashes = {}
+        sizes = {}
+        for action in actions:
+            data = self.serialize(action["doc"])
+            hashes[str(action["_id"])] = self.digest(data)
+            sizes[str(action["_id"])] = len(data)
+        stored = self.lookup(index_name, list(hashes))
+
+        changed, skipped_bytes = [], 0
+        for action in actions:
+            doc_id = str(action["_id"])
+            if stored.get(doc_id) == hashes[doc_id]:
+                skipped_bytes += sizes[doc_id]
+                del hashes[doc_id]
+            else:
+                changed.append(action)
+        return changed, hashes, skipped_bytes
+
+    def lookup(self, index_name: str, doc_ids: List[str]) -> Dict[str, bytes]:
+        result = {}
+        with self.lock:
+            for start in range(0, len(doc_ids), self.LOOKUP_CHUNK):
+                chunk = doc_ids[start:start + self.LOOKUP_CHUNK]
+                rows = self.connection.execute(
+                    "SELECT doc_id, hash FROM hashes WHERE index_name = ? "
+                    f"AND doc_id IN ({','.join('?' * len(chunk))})",
+                    [index_name, *chunk],
+                )
+                result.update(rows)
+        return result
+
+    def remember(self, index_name: str, hashes: Dict[str, bytes]) -> None:
+        if not hashes:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO hashes (index_name, doc_id, hash) VALUES (?, ?, ?) "
+                "ON CONFLICT (index_name, doc_id) DO UPDATE SET hash = excluded.hash",
+                [(index_name, doc_id, digest) for doc_id, digest in hashes.items()],
+            )
+
+    def forget(self, index_name: str, doc_ids: Iterable[str]) -> None:
+        """Документы изменены в обход хранилища (частичное обновление, удаление)"""
+        rows = [(index_name, str(doc_id)) for doc_id in doc_ids]
+        if not rows:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM hashes WHERE index_name = ? AND doc_id = ?", rows)
+
+    def forget_index(self, index_name: str) -> None:
+        """Индекс создан или загружается заново - прежние хэши к нему не относятся"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM hashes WHERE index_name = ?", (index_name,))
+
+
+def json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    return str(obj)
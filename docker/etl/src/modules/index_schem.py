@@ -44,6 +44,27 @@ def index_settings() -> dict:
     }
     return d
 
+def bulk_load_settings() -> dict:
+    """
+    Настройки индекса на время массовой загрузки: без реплик, без refresh
+    и с асинхронной записью translog
+    """
+    return {
+        "refresh_interval": "-1",
+        "number_of_replicas": 0,
+        "translog.durability": "async",
+    }
+
+
+def serving_settings(index_struct: dict, replicas: int) -> dict:
+    """Рабочие настройки индекса, которые возвращаются после массовой загрузки"""
+    return {
+        "refresh_interval": index_struct["settings"]["refresh_interval"],
+        "number_of_replicas": replicas,
+        "translog.durability": "request",
+    }
+
+
 def movies_index() -> dict:
     mappings = {
         "mappings": {
@@ -81,6 +102,9 @@ def movies_index() -> dict:
                     "type": "text",
                     "analyzer": "ru_en"
                 },
+                "subscribe_required": {
+                    "type": "boolean"
+                },
                 "directors": {
                     "type": "nested",
                     "dynamic": "strict",
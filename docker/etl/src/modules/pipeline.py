@@ -0,0 +1,102 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterator, List, Optional
+
+# Маркер конца данных в очереди
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Конвейер обработки пачек данных.
+
+    Источник (генератор) и каждая стадия работают в своих потоках и связаны
+    очередями ограниченного размера queue_size: пока одна стадия ждёт ответа
+    от Elasticsearch, другая уже читает из Postgres следующую пачку. Если стадия
+    не успевает, очередь перед ней заполняется и предыдущая стадия ждёт (backpressure).
+
+    Каждая стадия получает результат предыдущей и обрабатывает пачки строго по порядку,
+    поэтому последняя стадия может сохранять состояние после каждой пачки.
+    При ошибке в любой стадии конвейер останавливается, а ошибка пробрасывается из run.
+
+    При queue_size = 0 все стадии выполняются последовательно в текущем потоке.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, queue_size: int = 2) -> None:
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.errors: List[BaseException] = []
+
+    def run(self, source: Iterator, *stages: Callable[[Any], Any]) -> None:
+        if self.queue_size == 0:
+            for item in source:
+                for stage in stages:
+                    item = stage(item)
+            return
+
+        self.stop.clear()
+        self.errors.clear()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+        threads = [threading.Thread(target=self._produce, args=(source, queues[0]), daemon=True)]
+        for i, stage in enumerate(stages):
+            out = queues[i + 1] if i + 1 < len(stages) else None
+            threads.append(threading.Thread(target=self._work, args=(stage, queues[i], out), daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def _fail(self, err: BaseException) -> None:
+        logging.error(f"Ошибка в конвейере: {err}")
+        self.errors.append(err)
+        self.stop.set()
+
+    def _put(self, out: queue.Queue, item: Any) -> bool:
+        while not self.stop.is_set():
+            try:
+                out.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, inp: queue.Queue) -> Any:
+        while not self.stop.is_set():
+            try:
+                return inp.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _produce(self, source: Iterator, out: queue.Queue) -> None:
+        try:
+            for item in source:
+                if not self._put(out, item):
+                    break
+            self._put(out, _DONE)
+        except Exception as err:
+            self._fail(err)
+        finally:
+            # Генератор закрывается в том же потоке, в котором работал
+            # (например, чтобы закрыть серверный курсор Postgres)
+            if hasattr(source, "close"):
+                source.close()
+
+    def _work(self, stage: Callable[[Any], Any], inp: queue.Queue, out: Optional[queue.Queue]) -> None:
+        try:
+            while True:
+                item = self._get(inp)
+                if item is _DONE:
+                    if out is not None:
+                        self._put(out, _DONE)
+                    return
+                result = stage(item)
+                if out is not None and not self._put(out, result):
+                    return
+        except Exception as err:
+            self._fail(err)
@@ -0,0 +1,40 @@
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+
+class Scheduler:
+    """
+    Планировщик загрузчиков ETL.
+
+    Каждая задача выполняется в своём потоке и повторяется со своим интервалом,
+    поэтому долгая загрузка одного индекса не задерживает обновление остальных.
+    Ошибка в задаче не останавливает другие: она логируется, и задача повторяется
+    через свой интервал.
+    """
+
+    def __init__(self) -> None:
+        self.jobs: List[Tuple[str, Callable[[], None], int]] = []
+        self.stop = threading.Event()
+
+    def add(self, name: str, job: Callable[[], None], interval: int) -> None:
+        self.jobs.append((name, job, interval))
+
+    def run(self) -> None:
+        threads = [
+            threading.Thread(target=self._loop, args=job, name=job[0], daemon=True)
+            for job in self.jobs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _loop(self, name: str, job: Callable[[], None], interval: int) -> None:
+        while not self.stop.is_set():
+            try:
+                job()
+            except Exception:
+                logging.exception(f"Ошибка загрузчика {name}")
+            logging.info(f"Загрузчик {name}: следующая синхронизация через {interval} секунд.")
+            self.stop.wait(interval)
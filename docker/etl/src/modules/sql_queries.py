@@ -1,15 +1,16 @@
+from typing import List, Optional
+
 from psycopg2 import sql
 
-# Функции sql запросов возвращают SQL объекты с расставленными
-# в необходимых местах именными placeholder'ами
-def fw_full_sql_query() -> sql.SQL:
-    return sql.SQL(
-        """
+# Общие части запросов полной выборки: используются и при выборке по updated_at,
+# и при выборке по списку id (режим CDC)
+FW_FULL_SELECT = """
         SELECT
             fw.id as fw_id,
             fw.rating as imdb_rating,
             fw.title,
             fw.description,
+            COALESCE(fw.subscribe_required, FALSE) AS subscribe_required,
             fw.updated_at,
             JSON_AGG(DISTINCT jsonb_build_object('uuid', g.id, 'name', g.name)) AS "genre",
             JSON_AGG(DISTINCT jsonb_build_object('uuid', p.id, 'full_name', p.full_name)) FILTER (WHERE pfw.role = 'actor') AS actors,
@@ -20,17 +21,61 @@ def fw_full_sql_query() -> sql.SQL:
         LEFT JOIN content.person p ON p.id = pfw.person_id
         LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
         LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.updated_at > {updated_at}
+"""
+
+PERSON_SELECT = """
+        SELECT p.id as id,
+               p.full_name,
+               p.updated_at,
+               JSON_AGG(DISTINCT jsonb_build_object('uuid', pfw.film_work_id, 'role', pfw.role) ) as "role",
+               JSON_AGG(DISTINCT pfw.film_work_id) AS "film_ids"
+        FROM content.person p
+        LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id
+"""
+
+GENRE_SELECT = """
+        SELECT id,
+               name,
+               updated_at
+        FROM content.genre
+"""
+
+
+# Функции sql запросов возвращают SQL объекты с расставленными
+# в необходимых местах именными placeholder'ами
+#
+# Выборки по изменениям идут по ключу (updated_at, id): у нескольких строк может быть
+# одинаковый updated_at, и продолжение строго после последнего updated_at пропустило бы
+# ещё не прочитанные строки с тем же значением
+def fw_full_sql_query(sharded: bool = False) -> sql.SQL:
+    # Шард фильма определяется хэшем его id: каждый экземпляр ETL
+    # выгружает только фильмы арендованных им шардов
+    shard_filter = "AND mod(hashtext(fw.id::text) & 2147483647, {shard_count}) = {shard}" if sharded else ""
+    return sql.SQL(
+        FW_FULL_SELECT + """
+        WHERE (fw.updated_at, fw.id) > ({updated_at}, {last_id}) """ + shard_filter + """
         GROUP BY fw_id, fw.updated_at
-        ORDER BY fw.updated_at
+        ORDER BY fw.updated_at, fw_id
         LIMIT {sql_limit};
         """
     ).format(
         updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         sql_limit=sql.Placeholder(name="sql_limit"),
+        shard_count=sql.Placeholder(name="shard_count"),
+        shard=sql.Placeholder(name="shard"),
     )
 
 
+def fw_by_ids_sql_query() -> sql.SQL:
+    return sql.SQL(
+        FW_FULL_SELECT + """
+        WHERE fw.id IN {filmwork_ids}
+        GROUP BY fw_id, fw.updated_at;
+        """
+    ).format(filmwork_ids=sql.Placeholder(name="filmwork_ids"))
+
+
 def fw_persons_sql_query() -> sql.SQL:
     return sql.SQL(
         """
@@ -68,68 +113,174 @@ def nested_pre_sql(table: str) -> sql.SQL:
         """
         SELECT id, updated_at
         FROM content.{table}
-        WHERE updated_at > {updated_at}
-        ORDER BY updated_at
+        WHERE (updated_at, id) > ({updated_at}, {last_id})
+        ORDER BY updated_at, id
         LIMIT {limit};
     """
     ).format(
         table=sql.Identifier(table),
         updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         limit=sql.Placeholder(name="limit"),
     )
 
 
+# Пачки выбираются по ключу (updated_at, id), а не через OFFSET: следующая пачка
+# начинается сразу после последней строки предыдущей, и стоимость запроса не растёт
+# с номером пачки
 def nested_fw_ids_sql(related_table: str, related_id: str) -> sql.SQL:
     return sql.SQL(
         """
     SELECT fw.id, fw.updated_at
     FROM content.film_work fw
-    LEFT JOIN content.{related_table} rfw ON rfw.film_work_id = fw.id
+    JOIN content.{related_table} rfw ON rfw.film_work_id = fw.id
     WHERE rfw.{related_id} IN {data_name_ids}
-    ORDER BY fw.updated_at
+      AND (fw.updated_at, fw.id) > ({updated_at}, {last_id})
+    ORDER BY fw.updated_at, fw.id
     LIMIT {limit}
-    OFFSET {offset}
     """
     ).format(
         related_table=sql.Identifier(related_table),
         related_id=sql.Identifier(related_id),
         data_name_ids=sql.Placeholder(name="data_ids"),
-        offset=sql.Placeholder(name="offset"),
+        updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         limit=sql.Placeholder(name="limit"),
     )
 
-def person_sql() -> sql.SQL:
+def nested_changed_sql(table: str, name_column: str) -> sql.SQL:
     return sql.SQL(
         """
-        SELECT p.id as id,
-               p.full_name,
-               p.updated_at,
-               JSON_AGG(DISTINCT jsonb_build_object('uuid', pfw.film_work_id, 'role', pfw.role) ) as "role",
-               JSON_AGG(DISTINCT pfw.film_work_id) AS "film_ids"
-        FROM content.person p
-        LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id
-        WHERE p.updated_at > {updated_at}
+        SELECT id, {name_column} AS name, updated_at
+        FROM content.{table}
+        WHERE (updated_at, id) > ({updated_at}, {last_id})
+        ORDER BY updated_at, id
+        LIMIT {limit};
+    """
+    ).format(
+        table=sql.Identifier(table),
+        name_column=sql.Identifier(name_column),
+        updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
+        limit=sql.Placeholder(name="limit"),
+    )
+
+
+# Связи персон/жанров с фильмами. Запрос идёт только по таблице связей
+# (индекс по person_id/genre_id), без агрегации данных фильмов
+def nested_links_sql(
+    related_table: str, related_id: str, role_column: Optional[str] = None, roles: Optional[List[str]] = None
+) -> sql.SQL:
+    # Роль - произвольный текст: связи с ролями, которых нет в документе фильма, не выбираются
+    role_filter = sql.SQL("")
+    if role_column and roles:
+        role_filter = sql.SQL("AND {role} IN ({roles})").format(
+            role=sql.Identifier(role_column), roles=sql.SQL(", ").join(sql.Literal(role) for role in roles)
+        )
+    return sql.SQL(
+        """
+    SELECT film_work_id AS fw_id, {related_id} AS id, {role} AS role
+    FROM content.{related_table}
+    WHERE {related_id} IN {data_name_ids}
+      {role_filter}
+    """
+    ).format(
+        related_table=sql.Identifier(related_table),
+        related_id=sql.Identifier(related_id),
+        role=sql.Identifier(role_column) if role_column else sql.Literal(None),
+        data_name_ids=sql.Placeholder(name="data_ids"),
+        role_filter=role_filter,
+    )
+
+
+def max_updated_at_sql(table: str) -> sql.SQL:
+    return sql.SQL(
+        """
+        SELECT max(updated_at) AS updated_at
+        FROM content.{table}
+        """
+    ).format(table=sql.Identifier(table))
+
+
+def person_sql() -> sql.SQL:
+    return sql.SQL(
+        PERSON_SELECT + """
+        WHERE (p.updated_at, p.id) > ({updated_at}, {last_id})
         GROUP BY p.id, p.updated_at
-        ORDER BY updated_at
+        ORDER BY p.updated_at, p.id
         LIMIT {limit}
         """
     ).format(
         updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         limit=sql.Placeholder(name="limit")
     )
 
 def genre_sql() -> sql.SQL:
     return sql.SQL(
-        """
-        SELECT id,
-               name,
-               updated_at
-        FROM content.genre
-        WHERE updated_at > {updated_at}
-        ORDER BY updated_at
+        GENRE_SELECT + """
+        WHERE (updated_at, id) > ({updated_at}, {last_id})
+        ORDER BY updated_at, id
         LIMIT {limit}
         """
     ).format(
         updated_at=sql.Placeholder(name="updated_at"),
+        last_id=sql.Placeholder(name="last_id"),
         limit=sql.Placeholder(name="limit")
-    )
\ No newline at end of file
+    )
+
+
+def person_by_ids_sql() -> sql.SQL:
+    return sql.SQL(
+        PERSON_SELECT + """
+        WHERE p.id IN {data_ids}
+        GROUP BY p.id, p.updated_at
+        """
+    ).format(data_ids=sql.Placeholder(name="data_ids"))
+
+
+def genre_by_ids_sql() -> sql.SQL:
+    return sql.SQL(
+        GENRE_SELECT + """
+        WHERE id IN {data_ids}
+        """
+    ).format(data_ids=sql.Placeholder(name="data_ids"))
+
+
+def related_fw_ids_sql(related_table: str, related_id: str) -> sql.SQL:
+    return sql.SQL(
+        """
+        SELECT DISTINCT film_work_id AS id
+        FROM content.{related_table}
+        WHERE {related_id} IN {data_ids}
+        """
+    ).format(
+        related_table=sql.Identifier(related_table),
+        related_id=sql.Identifier(related_id),
+        data_ids=sql.Placeholder(name="data_ids"),
+    )
+
+
+# Записи журнала читаются без отсечки по id: bigserial выдаётся при вставке, а транзакции
+# фиксируются в другом порядке, и запись с меньшим id может стать видна позже записи с большим.
+# Прочитанные записи блокируются до конца транзакции, в которой они удаляются: другой
+# экземпляр ETL их пропускает и не обрабатывает повторно
+def changelog_sql() -> sql.SQL:
+    return sql.SQL(
+        """
+        SELECT id, table_name, record_id
+        FROM content.changelog
+        ORDER BY id
+        LIMIT {limit}
+        FOR UPDATE SKIP LOCKED
+        """
+    ).format(limit=sql.Placeholder(name="limit"))
+
+
+def changelog_cleanup_sql() -> sql.SQL:
+    return sql.SQL(
+        """
+        DELETE FROM content.changelog
+        WHERE id = ANY({ids})
+        """
+    ).format(ids=sql.Placeholder(name="ids"))
@@ -1,8 +1,15 @@
 import abc
 import datetime
 import json
+import logging
 import os
-from typing import Any, Optional
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, List, Optional
+
+import redis
 
 
 class EnhancedJSONEncoder(json.JSONEncoder):
@@ -17,6 +24,10 @@ class EnhancedJSONEncoder(json.JSONEncoder):
 
 
 class BaseStorage:
+    # Хранилище умеет сохранять только изменённые ключи. Это нужно, если
+    # одно хранилище используют несколько экземпляров ETL
+    partial_updates = False
+
     @abc.abstractmethod
     def save_state(self, state: dict) -> None:
         """Сохранить состояние в постоянное хранилище"""
@@ -33,8 +44,16 @@ class JsonFileStorage(BaseStorage):
         self.file_path = file_path
 
     def save_state(self, state: dict) -> None:
-        with open(self.file_path, "w") as outfile:
+        """
+        Атомарная запись: состояние пишется во временный файл, который затем
+        заменяет основной. При падении во время записи остаётся прежнее состояние
+        """
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w") as outfile:
             json.dump(state, outfile, cls=EnhancedJSONEncoder)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.file_path)
 
     def retrieve_state(self) -> dict:
         if not os.path.isfile(self.file_path):
@@ -47,15 +66,190 @@ class JsonFileStorage(BaseStorage):
         return data
 
 
+class SqliteStorage(BaseStorage):
+    """
+    Хранение состояния в SQLite в режиме WAL: каждый ключ - отдельная строка,
+    сохранение выполняется одной транзакцией
+    """
+
+    partial_updates = True
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        # Доступ из разных потоков сериализуется блокировкой State
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+
+    def save_state(self, state: dict) -> None:
+        rows = [(key, json.dumps(value, cls=EnhancedJSONEncoder)) for key, value in state.items()]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO state (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                rows,
+            )
+
+    def retrieve_state(self) -> dict:
+        rows = self.connection.execute("SELECT key, value FROM state").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+
+class RedisStorage(BaseStorage):
+    """
+    Хранение состояния в хэше Redis. Общее состояние для нескольких экземпляров ETL:
+    каждый экземпляр сохраняет только изменённые им ключи
+    """
+
+    partial_updates = True
+
+    def __init__(self, client: redis.Redis, key: str = "etl:state") -> None:
+        self.client = client
+        self.key = key
+
+    def save_state(self, state: dict) -> None:
+        if state:
+            mapping = {key: json.dumps(value, cls=EnhancedJSONEncoder) for key, value in state.items()}
+            self.client.hset(self.key, mapping=mapping)
+
+    def retrieve_state(self) -> dict:
+        return {key.decode(): json.loads(value) for key, value in self.client.hgetall(self.key).items()}
+
+
+class RedisLease:
+    """
+    Аренда (lease) ресурса в Redis: пока аренда удерживается, другие экземпляры ETL
+    этот ресурс не обрабатывают. Аренда ограничена по времени ttl, поэтому ресурс
+    упавшего экземпляра освобождается сам. Пока выполняется работа, аренда
+    продлевается в фоновом потоке (см. keep_alive)
+    """
+
+    # Продление и освобождение только своей аренды: значение ключа - токен владельца
+    RENEW_SCRIPT = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("pexpire", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, client: redis.Redis, name: str, ttl: float) -> None:
+        self.client = client
+        self.key = f"etl:lease:{name}"
+        self.ttl_ms = int(ttl * 1000)
+        self.token = uuid.uuid4().hex
+        self._renew = client.register_script(self.RENEW_SCRIPT)
+        self._release = client.register_script(self.RELEASE_SCRIPT)
+
+    def acquire(self) -> bool:
+        return bool(self.client.set(self.key, self.token, nx=True, px=self.ttl_ms))
+
+    def acquire_wait(self, poll_interval: float = 1) -> None:
+        """Ожидание аренды, пока её удерживает другой владелец"""
+        while not self.acquire():
+            time.sleep(poll_interval)
+
+    def renew(self) -> bool:
+        return bool(self._renew(keys=[self.key], args=[self.token, self.ttl_ms]))
+
+    def release(self) -> None:
+        self._release(keys=[self.key], args=[self.token])
+
+    def keep_alive(self, lost: Optional[threading.Event] = None) -> threading.Event:
+        """
+        Запуск фонового продления аренды. Возвращает событие, установка которого
+        останавливает продление. Если продлить аренду не удалось (её мог уже получить
+        другой экземпляр ETL), устанавливается событие lost: работу под арендой нужно прервать
+        """
+        stop = threading.Event()
+
+        def renew_loop() -> None:
+            while not stop.wait(self.ttl_ms / 3000):
+                try:
+                    renewed = self.renew()
+                except redis.RedisError as err:
+                    logging.error(f"Ошибка продления аренды {self.key}: {err}")
+                    renewed = False
+                if not renewed:
+                    logging.error(f"Аренда {self.key} потеряна")
+                    if lost is not None:
+                        lost.set()
+                    return
+
+        threading.Thread(target=renew_loop, name=f"lease-{self.key}", daemon=True).start()
+        return stop
+
+
+class LeaseLost(Exception):
+    """Аренда потеряна во время работы: состояние этой работы сохранять нельзя"""
+
+
+class LeaseGroup:
+    """
+    Блокировка на основе нескольких аренд: при входе дожидается и удерживает все аренды
+    (продлевая их), при выходе освобождает. Аренды берутся в порядке ключей, поэтому
+    владельцы, которые ждут пересекающиеся наборы аренд, не блокируют друг друга навсегда.
+    Если любую из аренд не удалось продлить, устанавливается событие lost (см. hold)
+    """
+
+    def __init__(self, leases: List[RedisLease]) -> None:
+        self.leases = sorted(leases, key=lambda lease: lease.key)
+        self.stops: List[threading.Event] = []
+        self.lost: Optional[threading.Event] = None
+
+    def hold(self, lost: threading.Event) -> "LeaseGroup":
+        """Удержание аренд с событием lost, которое устанавливается при потере любой из них"""
+        self.lost = lost
+        return self
+
+    def __enter__(self) -> "LeaseGroup":
+        if self.lost is None:
+            self.lost = threading.Event()
+        try:
+            for lease in self.leases:
+                lease.acquire_wait()
+                self.stops.append(lease.keep_alive(self.lost))
+        except BaseException:
+            self.release()
+            raise
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+    def release(self) -> None:
+        for stop in self.stops:
+            stop.set()
+        for lease in self.leases[:len(self.stops)]:
+            lease.release()
+        self.stops = []
+        self.lost = None
+
+
 class State:
     """
     Класс для хранения состояния при работе с данными, чтобы постоянно не перечитывать данные с начала.
-    Здесь представлена реализация с сохранением состояния в файл.
+    Изменения накапливаются в памяти и сохраняются в хранилище не чаще, чем раз
+    в flush_interval секунд, а также при вызове flush (например, в конце запуска загрузчика).
+    При падении теряется прогресс не больше чем за flush_interval: эти данные будут
+    загружены повторно, что безопасно, так как загрузка идемпотентна.
     """
 
-    def __init__(self, storage: JsonFileStorage) -> None:
+    def __init__(self, storage: BaseStorage, flush_interval: float = 0) -> None:
         self.storage = storage
+        self.flush_interval = flush_interval
         self.data = {}
+        self.changed = set()
+        self.last_flush = time.monotonic()
+        # Состояние меняют загрузчики из разных потоков
+        self.lock = threading.Lock()
 
         zero_time = datetime.datetime.fromisoformat("1970-01-01T00:00:00.000000+00:00")
 
@@ -65,6 +259,8 @@ class State:
             "genre_upd_at": zero_time,
             "genres_full_upd_at": zero_time,
             "persons_full_upd_at": zero_time,
+            # Последняя обработанная запись журнала изменений (режим CDC)
+            "changelog_id": 0,
         }
 
         self.parse_data()
@@ -74,8 +270,10 @@ class State:
         Функция проверки значений state файла. Валидация происходит на основе
         словаря со значениями по умолчанию. Если по какой-то причине необходимых
         значений нет, то они создаются со значениями по умолчанию.
+        Остальные ключи (например, состояния шардов) загружаются как есть.
         """
         temp_dict = self.storage.retrieve_state()
+        self.data.update(temp_dict)
 
         for key, value in self.default_values.items():
             if temp_dict.get(key) is None:
@@ -85,9 +283,45 @@ class State:
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа"""
-        self.data[key] = value
-        self.storage.save_state(self.data)
+        with self.lock:
+            if self.data.get(key) == value:
+                return
+            self.data[key] = value
+            self.changed.add(key)
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self._save()
+
+    def flush(self) -> None:
+        """Сохранить накопленные изменения"""
+        with self.lock:
+            if self.changed:
+                self._save()
+
+    def reload(self) -> None:
+        """
+        Сохранить накопленные изменения и перечитать состояние из хранилища.
+        Нужно, если хранилище общее и ключ мог изменить другой экземпляр ETL
+        """
+        with self.lock:
+            if self.changed:
+                self._save()
+            self.parse_data()
+
+    def _save(self) -> None:
+        if self.storage.partial_updates:
+            self.storage.save_state({key: self.data[key] for key in self.changed})
+        else:
+            self.storage.save_state(self.data)
+        self.changed.clear()
+        self.last_flush = time.monotonic()
+
+    def is_initial(self, key: str) -> bool:
+        """Значение ключа ещё не менялось и равно значению по умолчанию"""
+        value, default = self.data.get(key), self.default_values.get(key)
+        if isinstance(default, datetime.datetime) and isinstance(value, str):
+            value = datetime.datetime.fromisoformat(value)
+        return value == default
 
-    def get_state(self, key: str) -> Any:
+    def get_state(self, key: str, default: Any = None) -> Any:
         """Получить состояние по определённому ключу"""
-        return self.data.get(key)
+        return self.data.get(key, default)
@@ -0,0 +1,11 @@
+"""
+Модульные тесты ETL. Postgres, Elasticsearch и Redis в них заменены подделками,
+поэтому тесты запускаются без docker: python -m pytest docker/etl/tests
+"""
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+# main.py читает конфиг по пути ../config относительно рабочего каталога
+os.chdir(SRC)
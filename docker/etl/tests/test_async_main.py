@@ -0,0 +1,123 @@
+import asyncio
+import threading
+from typing import Dict, List
+
+import pytest
+from psycopg2 import sql
+
+import async_main
+from async_main import AsyncElasticLoader, compile_query
+from modules import sql_queries
+
+
+class FakeState:
+    def __init__(self) -> None:
+        self.history: List[int] = []
+
+    def set_state(self, key: str, value: int) -> None:
+        self.history.append(value)
+
+
+class FakeHashStore:
+    """Запоминает, в каких потоках к нему обращались"""
+
+    def __init__(self) -> None:
+        self.threads = set()
+        self.remembered: Dict[str, bytes] = {}
+
+    def filter_changed(self, to_index: str, actions: List[dict]):
+        self.threads.add(threading.get_ident())
+        return actions, {action["_id"]: action["_id"].encode() for action in actions}, 0
+
+    def remember(self, to_index: str, hashes: Dict[str, bytes]) -> None:
+        self.threads.add(threading.get_ident())
+        self.remembered.update(hashes)
+
+
+class FakeLoader(AsyncElasticLoader):
+    """bulk запрос пачки выполняется delays[id первого документа] секунд; None - не завершается"""
+
+    def __init__(self, delays: Dict[str, float], failing: set = frozenset(), hash_store=None) -> None:
+        super().__init__(client=None, hash_store=hash_store)
+        self.delays = delays
+        self.failing = failing
+        self.done: List[str] = []
+        self.cancelled: List[str] = []
+
+    async def bulk(self, actions: List[dict], to_index: str) -> None:
+        doc_id = actions[0]["_id"]
+        try:
+            delay = self.delays[doc_id]
+            await (asyncio.sleep(delay) if delay is not None else asyncio.Event().wait())
+        except asyncio.CancelledError:
+            self.cancelled.append(doc_id)
+            raise
+        if doc_id in self.failing:
+            raise RuntimeError(doc_id)
+        self.done.append(doc_id)
+
+
+async def load(loader: FakeLoader, state: FakeState, batches: List[List[str]], skip_unchanged=False) -> int:
+    produced = []
+
+    async def source():
+        for number, batch in enumerate(batches, 1):
+            produced.append(number)
+            yield batch
+
+    return await loader.load(
+        source(),
+        lambda: produced[-1],
+        state,
+        state_field="upd_at",
+        to_index="movies",
+        id_key="id",
+        make_actions=lambda ids: [{"_id": doc_id} for doc_id in ids],
+        skip_unchanged=skip_unchanged,
+    )
+
+
+@pytest.fixture(autouse=True)
+def thread_count(monkeypatch):
+    monkeypatch.setattr(async_main.conf.bulk, "thread_count", 3)
+
+
+def test_compile_query_in_to_any():
+    text, names = compile_query(sql_queries.nested_fw_ids_sql("person_film_work", "person_id"))
+    assert 'WHERE rfw."person_id" = ANY($1)' in text
+    assert "> ($2, $3)" in text and "LIMIT $4" in text
+    assert names == ["data_ids", "updated_at", "last_id", "limit"]
+
+
+def test_compile_query_repeated_placeholder_and_literal():
+    query = sql.SQL("SELECT {a}, {b}, {a}, {none}, {text}").format(
+        a=sql.Placeholder("a"), b=sql.Placeholder("b"), none=sql.Literal(None), text=sql.Literal("it's")
+    )
+    assert compile_query(query) == ("SELECT $1, $2, $1, NULL, 'it''s'", ["a", "b"])
+
+
+def test_state_follows_batch_order():
+    # Пачки завершаются в обратном порядке, но состояние записывается по порядку
+    loader = FakeLoader({"a": 0.03, "b": 0.01, "c": 0}, hash_store=FakeHashStore())
+    state = FakeState()
+    assert asyncio.run(load(loader, state, [["a"], ["b"], ["c"]], skip_unchanged=True)) == 3
+    assert loader.done == ["c", "b", "a"]
+    assert state.history == [1, 2, 3]
+    assert set(loader.hash_store.remembered) == {"a", "b", "c"}
+    # Хранилище хэшей блокирует, поэтому вызывается не из потока цикла событий
+    assert threading.get_ident() not in loader.hash_store.threads
+
+
+def test_failed_bulk_cancels_in_flight():
+    loader = FakeLoader({"a": 0, "b": 0.01, "c": None}, failing={"b"})
+    state = FakeState()
+
+    async def run() -> None:
+        with pytest.raises(RuntimeError):
+            await load(loader, state, [["a"], ["b"], ["c"]])
+        # Отмена доходит до задачи на следующем шаге цикла событий
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert state.history == [1]
+    assert loader.cancelled == ["c"]
@@ -0,0 +1,98 @@
+import datetime
+import threading
+from typing import List
+
+import pytest
+
+import main
+from modules.state_control import SqliteStorage, State
+from test_jobs import FakeLease
+
+LOADED_AT = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakeRequester:
+    hash_store = None
+
+    def __init__(self) -> None:
+        self.settings: List[tuple] = []
+
+    def index_replicas(self, index_name: str) -> int:
+        # После массовой загрузки без восстановления профиля реплик бы уже не было
+        return 0 if self.settings else 2
+
+    def update_index_settings(self, index_name: str, settings: dict) -> None:
+        self.settings.append((index_name, settings["number_of_replicas"]))
+
+
+class FakeLoaders:
+    """Загрузчики первичной загрузки: запоминают загруженные индексы и двигают state"""
+
+    def __init__(self) -> None:
+        self.loaded: List[str] = []
+        self.failing = set()
+
+    def loader_job(self, pg_dsl, alias, elastic_requester, state, *args, **kwargs):
+        def job(stop=None) -> int:
+            self.loaded.append(alias)
+            if alias in self.failing:
+                raise RuntimeError("Postgres недоступен")
+            state.set_state(main.FULL_LOADERS[alias][2], LOADED_AT)
+            return 1
+
+        return job
+
+
+@pytest.fixture
+def loaders(monkeypatch) -> FakeLoaders:
+    fake = FakeLoaders()
+    # Вместо функции загрузчика передаётся имя индекса
+    full_loaders = {alias: (name, alias, field) for alias, (name, _, field) in main.FULL_LOADERS.items()}
+    monkeypatch.setattr(main, "FULL_LOADERS", full_loaders)
+    monkeypatch.setattr(main, "loader_job", fake.loader_job)
+    return fake
+
+
+def test_interrupted_backfill_is_resumed(loaders):
+    state = State(SqliteStorage(":memory:"))
+    requester = FakeRequester()
+    loaders.failing = {"movies"}
+    with pytest.raises(RuntimeError):
+        main.backfill({}, requester, state, 100, None)
+    # Рабочий профиль восстановлен, а отметка о незавершённой загрузке осталась
+    assert requester.settings == [("movies", 0), ("movies", 2)]
+    assert state.get_state("backfill:movies") == 2
+
+    loaders.failing = set()
+    main.backfill({}, requester, state, 100, None)
+    assert loaders.loaded == ["movies", "movies", "persons", "genres"]
+    # Количество реплик - сохранённое при первом запуске
+    assert requester.settings[2:4] == [("movies", 0), ("movies", 2)]
+    assert state.get_state("backfill:movies") is None
+
+    main.backfill({}, requester, state, 100, None)
+    assert len(loaders.loaded) == 4
+
+
+def test_replica_waits_for_running_backfill(loaders, monkeypatch, tmp_path):
+    owners = {}
+    monkeypatch.setattr(
+        main, "RedisLease", lambda client, name, ttl: FakeLease(owners, name, "replica", [])
+    )
+    # Первичную загрузку movies уже выполняет другой экземпляр
+    other = FakeLease(owners, "film_work", "other", [])
+    assert other.acquire()
+    other_state = State(SqliteStorage(str(tmp_path / "state.db")))
+    state = State(SqliteStorage(str(tmp_path / "state.db")))
+    thread = threading.Thread(target=main.backfill, args=({}, FakeRequester(), state, 100, None, object()))
+    thread.start()
+    thread.join(0.05)
+    assert thread.is_alive()
+    assert loaders.loaded == []
+
+    other_state.set_state("film_work_upd_at", LOADED_AT)
+    other_state.flush()
+    other.release()
+    thread.join()
+    # movies загружен другим экземпляром, этот экземпляр загрузил только остальные индексы
+    assert loaders.loaded == ["persons", "genres"]
@@ -0,0 +1,130 @@
+import itertools
+import threading
+from typing import List, Optional
+
+import pytest
+
+from main import ChangeConsumer
+from modules.state_control import LeaseLost
+from modules import sql_queries
+from modules.state_control import SqliteStorage, State
+
+
+class FakeChangelog:
+    """
+    Журнал content.changelog с видимостью как в Postgres: id выдаются при вставке,
+    а читатель видит запись только после фиксации транзакции писателя
+    """
+
+    def __init__(self) -> None:
+        self.ids = itertools.count(1)
+        self.committed: List[dict] = []
+
+    def writer(self) -> "FakeWriter":
+        return FakeWriter(self)
+
+
+class FakeWriter:
+    def __init__(self, changelog: FakeChangelog) -> None:
+        self.changelog = changelog
+        self.rows: List[dict] = []
+
+    def insert(self, table_name: str, record_id: str) -> None:
+        self.rows.append({"id": next(self.changelog.ids), "table_name": table_name, "record_id": record_id})
+
+    def commit(self) -> None:
+        self.changelog.committed.extend(self.rows)
+        self.changelog.committed.sort(key=lambda row: row["id"])
+        self.rows = []
+
+
+class FakeConnection:
+    closed = False
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+
+class FakePostgres:
+    """Соединение ChangeConsumer: выполняет только запросы к журналу"""
+
+    def __init__(self, changelog: FakeChangelog) -> None:
+        self.changelog = changelog
+        self.connection = FakeConnection()
+
+    def query(self, sql_query, params: Optional[dict] = None) -> List[dict]:
+        assert sql_query == sql_queries.changelog_sql()
+        return self.changelog.committed[:params["limit"]]
+
+    def execute(self, sql_query, params: Optional[dict] = None) -> None:
+        assert sql_query == sql_queries.changelog_cleanup_sql()
+        ids = set(params["ids"])
+        self.changelog.committed = [row for row in self.changelog.committed if row["id"] not in ids]
+
+
+def make_consumer(changelog: FakeChangelog, limit: int = 100) -> ChangeConsumer:
+    consumer = ChangeConsumer({}, elastic_requester=None, state=State(SqliteStorage(":memory:")),
+                              limit=limit, wait_timeout=0)
+    consumer.pg_connection = FakePostgres(changelog)
+    consumer.reindexed = []
+    consumer.reindex = lambda ids, *args: consumer.reindexed.extend(sorted(ids))
+    return consumer
+
+
+def test_late_commit_of_smaller_id_is_processed():
+    changelog = FakeChangelog()
+    consumer = make_consumer(changelog)
+    slow, fast = changelog.writer(), changelog.writer()
+    # Медленная транзакция получает меньший id, но фиксируется позже быстрой
+    slow.insert("film_work", "film-slow")
+    fast.insert("film_work", "film-fast")
+    fast.commit()
+
+    while consumer.process_changes():
+        pass
+    assert consumer.reindexed == ["film-fast"]
+
+    slow.commit()
+    while consumer.process_changes():
+        pass
+    assert consumer.reindexed == ["film-fast", "film-slow"]
+    assert changelog.committed == []
+
+
+def test_only_processed_rows_are_deleted():
+    changelog = FakeChangelog()
+    consumer = make_consumer(changelog, limit=2)
+    writer = changelog.writer()
+    for i in range(3):
+        writer.insert("film_work", f"film-{i}")
+    writer.commit()
+
+    # Полная пачка: в журнале могут остаться записи
+    assert consumer.process_changes()
+    assert [row["record_id"] for row in changelog.committed] == ["film-2"]
+    assert not consumer.process_changes()
+    assert changelog.committed == []
+    assert consumer.state.get_state("changelog_id") == 3
+
+
+def test_lost_lease_keeps_batch_in_changelog():
+    changelog = FakeChangelog()
+    consumer = make_consumer(changelog)
+    writer = changelog.writer()
+    writer.insert("film_work", "film-1")
+    writer.commit()
+    lost = threading.Event()
+    # Аренда теряется во время переиндексации пачки
+    consumer.reindex = lambda ids, *args: lost.set()
+    with pytest.raises(LeaseLost):
+        consumer.process_changes(lost)
+    assert [row["record_id"] for row in changelog.committed] == ["film-1"]
+
+    # run завершается, не удаляя пачку: её обработает новый владелец аренды
+    lost.clear()
+    consumer.connect = consumer.close = lambda: None
+    consumer.run(lost)
+    assert [row["record_id"] for row in changelog.committed] == ["film-1"]
@@ -0,0 +1,105 @@
+import datetime
+from typing import List
+
+import pytest
+from elasticsearch import helpers
+
+from main import filter_actions, stream_to_elastic
+from modules.hash_store import ContentHashStore
+from modules.state_control import SqliteStorage, State
+from test_stream_to_elastic import FakeRequester
+
+
+@pytest.fixture
+def store(tmp_path) -> ContentHashStore:
+    return ContentHashStore(str(tmp_path / "hashes.db"))
+
+
+def action(doc_id: str, title: str) -> dict:
+    return {"_op_type": "update", "_id": doc_id, "doc": {"title": title, "updated": datetime.date(2022, 1, 1)}}
+
+
+def load(store: ContentHashStore, index_name: str, actions: List[dict]) -> List[str]:
+    """id отправленных документов; их хэши запоминаются, как после успешной загрузки"""
+    changed, hashes, _ = store.filter_changed(index_name, actions)
+    store.remember(index_name, hashes)
+    return [item["_id"] for item in changed]
+
+
+def test_unchanged_document_skipped(store):
+    assert load(store, "movies", [action("a", "A"), action("b", "B")]) == ["a", "b"]
+    changed, hashes, skipped_bytes = store.filter_changed("movies", [action("a", "A"), action("b", "B")])
+    assert changed == [] and hashes == {}
+    assert skipped_bytes == 2 * len(ContentHashStore.serialize(action("a", "A")["doc"]))
+
+
+def test_changed_document_sent(store):
+    load(store, "movies", [action("a", "A"), action("b", "B")])
+    assert load(store, "movies", [action("a", "A"), action("b", "B2")]) == ["b"]
+    assert load(store, "movies", [action("b", "B2")]) == []
+
+
+def test_hashes_are_per_index(store):
+    load(store, "movies", [action("a", "A")])
+    assert load(store, "persons", [action("a", "A")]) == ["a"]
+
+
+def test_forget(store):
+    load(store, "movies", [action("a", "A"), action("b", "B")])
+    store.forget("movies", ["a"])
+    assert load(store, "movies", [action("a", "A"), action("b", "B")]) == ["a"]
+
+
+def test_forget_index(store):
+    load(store, "movies", [action("a", "A")])
+    load(store, "persons", [action("a", "A")])
+    store.forget_index("movies")
+    assert load(store, "movies", [action("a", "A")]) == ["a"]
+    assert load(store, "persons", [action("a", "A")]) == []
+
+
+def test_filter_actions_skips_unchanged(store):
+    skipped = {"docs": 0, "bytes": 0}
+    actions, hashes = filter_actions(store, "movies", [action("a", "A")], True, skipped)
+    store.remember("movies", hashes)
+    actions, hashes = filter_actions(store, "movies", [action("a", "A"), action("b", "B")], True, skipped)
+    assert [item["_id"] for item in actions] == ["b"]
+    assert list(hashes) == ["b"]
+    assert skipped["docs"] == 1 and skipped["bytes"] > 0
+
+
+def test_filter_actions_partial_update_forgets_hash(store):
+    load(store, "movies", [action("a", "A")])
+    skipped = {"docs": 0, "bytes": 0}
+    script_action = {"_op_type": "update", "_id": "a", "script": {}}
+    actions, hashes = filter_actions(store, "movies", [script_action], False, skipped)
+    assert actions == [script_action] and hashes == {}
+    # Документ изменён частично: следующая полная загрузка отправит его снова
+    assert load(store, "movies", [action("a", "A")]) == ["a"]
+
+
+def test_filter_actions_without_store():
+    actions = [action("a", "A")]
+    assert filter_actions(None, "movies", actions, True, {"docs": 0, "bytes": 0}) == (actions, {})
+
+
+def test_rejected_document_resent_on_next_run(store):
+    """Документ, который ES не принял, не пропускается по хэшу при следующем запуске"""
+    state = State(SqliteStorage(":memory:"))
+    docs = [action("a", "A"), action("b", "B")]
+
+    def run(requester: FakeRequester) -> None:
+        def prepare(batch):
+            return filter_actions(store, "movies", batch, True, {"docs": 0, "bytes": 0})
+
+        stream_to_elastic(iter([docs]), lambda: 1, requester, state, "upd_at", "movies", prepare)
+
+    first = FakeRequester(failing={"b"})
+    first.remember_hashes = lambda index_name, hashes: store.remember(index_name, hashes)
+    with pytest.raises(helpers.BulkIndexError):
+        run(first)
+    second = FakeRequester(failing=set())
+    second.remember_hashes = lambda index_name, hashes: store.remember(index_name, hashes)
+    run(second)
+    assert second.sent == ["a", "b"]
+    assert state.get_state("upd_at") == 1
@@ -0,0 +1,125 @@
+import threading
+import time
+from typing import List, Optional
+
+from main import lease_group_job, leased_job, locked_job
+from modules.state_control import LeaseGroup, SqliteStorage, State
+
+
+def test_locked_jobs_do_not_overlap():
+    lock = threading.Lock()
+    running, overlaps = [], []
+
+    def job() -> None:
+        running.append(1)
+        if len(running) > 1:
+            overlaps.append(1)
+        time.sleep(0.01)
+        running.pop()
+
+    jobs = [locked_job(job, lock) for _ in range(2)]
+    threads = [threading.Thread(target=job) for job in jobs for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == []
+
+
+class FakeLease:
+    """Аренда в общем словаре владельцев вместо Redis"""
+
+    def __init__(self, owners: dict, key: str, token: str, log: List[str]) -> None:
+        self.owners, self.key, self.token, self.log = owners, key, token, log
+
+    def acquire(self) -> bool:
+        if self.owners.setdefault(self.key, self.token) != self.token:
+            return False
+        self.log.append(f"acquire {self.key}")
+        return True
+
+    def acquire_wait(self, poll_interval: float = 0.001) -> None:
+        while not self.acquire():
+            time.sleep(poll_interval)
+
+    def keep_alive(self, lost: Optional[threading.Event] = None) -> threading.Event:
+        return threading.Event()
+
+    def release(self) -> None:
+        if self.owners.get(self.key) == self.token:
+            del self.owners[self.key]
+            self.log.append(f"release {self.key}")
+
+
+def test_lease_group_waits_for_held_lease():
+    owners, log = {}, []
+    shard = FakeLease(owners, "film_work:1", "loader", log)
+    assert shard.acquire()
+    group = LeaseGroup([FakeLease(owners, f"film_work:{i}", "nested", log) for i in (1, 0)])
+
+    entered = threading.Event()
+
+    def nested() -> None:
+        with group:
+            entered.set()
+
+    thread = threading.Thread(target=nested)
+    thread.start()
+    # Пока шард загружается, загрузчик персон ждёт
+    assert not entered.wait(0.05)
+    shard.release()
+    thread.join()
+    assert entered.is_set()
+    assert log == [
+        "acquire film_work:1", "acquire film_work:0", "release film_work:1",
+        "acquire film_work:1", "release film_work:0", "release film_work:1",
+    ]
+    assert owners == {}
+
+
+class LosingLease:
+    """Аренда, продлить которую не удаётся"""
+
+    key = "etl:lease:film_work"
+
+    def __init__(self) -> None:
+        self.released = False
+
+    def acquire(self) -> bool:
+        return True
+
+    def acquire_wait(self) -> None:
+        pass
+
+    def keep_alive(self, lost: threading.Event) -> threading.Event:
+        lost.set()
+        return threading.Event()
+
+    def release(self) -> None:
+        self.released = True
+
+
+def test_leased_job_gets_lost_event():
+    received = []
+    lease = LosingLease()
+    job = leased_job(locked_job(received.append, threading.Lock()), lease, State(SqliteStorage(":memory:")))
+    job()
+    assert received[0].is_set()
+    assert lease.released
+
+
+def test_lost_group_lease_stops_job():
+    # Аренда film_work, которую держит загрузчик персон, потеряна - загрузка должна прерваться
+    owners, received = {}, []
+    losing = LosingLease()
+    group = LeaseGroup([FakeLease(owners, "film_work:0", "nested", []), losing])
+    own_lease = FakeLease(owners, "film_work_persons", "nested", [])
+    job = leased_job(lease_group_job(received.append, group), own_lease, State(SqliteStorage(":memory:")))
+    job()
+    assert received[0].is_set()
+    assert losing.released
+    assert owners == {}
+    # Следующий запуск начинается с новым событием
+    group.leases.remove(losing)
+    job()
+    assert not received[1].is_set()
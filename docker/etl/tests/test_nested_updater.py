@@ -0,0 +1,62 @@
+import asyncio
+from typing import List
+
+from async_main import AsyncNestedUpdater, compile_query
+from main import NestedUpdater
+from modules import sql_queries
+from modules.data_representation import NestedRecord
+
+FIELDS = {"actor": "actors", "writer": "writers", "director": "directors"}
+LINKS = [
+    {"fw_id": "film", "id": "p1", "role": "actor"},
+    # Роль, которой нет в документе фильма
+    {"fw_id": "film", "id": "p1", "role": "producer"},
+    {"fw_id": "film", "id": "p1", "role": "director"},
+]
+
+
+class FakeProducer:
+    def generator(self):
+        yield [NestedRecord(id="p1", name="New name")]
+
+
+class AsyncFakeProducer:
+    async def generator(self):
+        yield [NestedRecord(id="p1", name="New name")]
+
+
+class FakePostgres:
+    def query(self, sql_query, params) -> List[dict]:
+        return LINKS
+
+
+class AsyncFakePostgres:
+    async def query(self, sql_query, params) -> List[dict]:
+        return LINKS
+
+
+def test_links_sql_filters_roles():
+    query = sql_queries.nested_links_sql("person_film_work", "person_id", "role", list(FIELDS))
+    text, names = compile_query(query)
+    assert "\"role\" IN ('actor', 'writer', 'director')" in text
+    assert names == ["data_ids"]
+    # У жанров роли нет - и фильтра тоже
+    text, _ = compile_query(sql_queries.nested_links_sql("genre_film_work", "genre_id"))
+    assert " IN (" not in text
+
+
+def test_unknown_role_skipped():
+    updater = NestedUpdater(FakePostgres(), FakeProducer(), sql_query=None, fields=FIELDS, name_key="full_name")
+    [films] = list(updater.generator())
+    assert [entry["field"] for entry in films[0].entries] == ["actors", "directors"]
+
+
+def test_unknown_role_skipped_async():
+    async def run():
+        updater = AsyncNestedUpdater(
+            AsyncFakePostgres(), AsyncFakeProducer(), sql_query=None, fields=FIELDS, name_key="full_name"
+        )
+        return [films async for films in updater.generator()]
+
+    [films] = asyncio.run(run())
+    assert [entry["field"] for entry in films[0].entries] == ["actors", "directors"]
@@ -0,0 +1,100 @@
+import datetime
+from typing import List
+
+import psycopg2
+import pytest
+
+import main
+from main import Producer
+from modules.data_representation import BaseRecord
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class FakeConnection:
+    closed = False
+
+    def __init__(self) -> None:
+        self.rollbacks = 0
+
+    def rollback(self) -> None:
+        self.rollbacks += 1
+
+
+class FakePostgres:
+    """
+    Таблица из rows строк с id = 1..rows и updated_at = id (или updated_at[id - 1]);
+    запрос читается через 'серверный курсор' по ключу (updated_at, id)
+    """
+
+    def __init__(self, rows: int, failures: int = 0, updated_at: List[int] = None) -> None:
+        seconds = updated_at or range(1, rows + 1)
+        self.rows = [
+            BaseRecord(id=i, updated_at=EPOCH + datetime.timedelta(seconds=second))
+            for i, second in zip(range(1, rows + 1), seconds)
+        ]
+        self.failures = failures
+        self.connection = FakeConnection()
+        self.queries: List[datetime.datetime] = []
+        self.open_cursors = 0
+
+    def stream(self, sql_query, params, itersize, data_class):
+        self.queries.append(params["updated_at"])
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.open_cursors += 1
+        try:
+            key = (params["updated_at"], params["last_id"])
+            rows = [row for row in self.rows if (row.updated_at, row.id) > key]
+            yield from rows[:params["limit"]]
+        finally:
+            self.open_cursors -= 1
+
+
+def producer(pg: FakePostgres) -> Producer:
+    return Producer(pg, sql_query=None, sql_values={"updated_at": EPOCH, "last_id": 0, "limit": 100},
+                    data_class=BaseRecord, offset_by="updated_at", produce_field="id", itersize=2, key_field="id")
+
+
+def test_reads_whole_table():
+    pg = FakePostgres(rows=5)
+    assert sum(producer(pg).generator(), []) == [1, 2, 3, 4, 5]
+    # Каждый дочитанный запрос завершает свою транзакцию
+    assert pg.connection.rollbacks == len(pg.queries) == 2
+
+
+def test_cursor_closed_after_max_age(monkeypatch):
+    monkeypatch.setattr(main.conf.sql_settings, "cursor_max_age", 0)
+    pg = FakePostgres(rows=5)
+    batches = []
+    for batch in producer(pg).generator():
+        batches.append(batch)
+        assert pg.open_cursors <= 1
+    assert batches == [[1, 2], [3, 4], [5]]
+    # После каждой полной пачки курсор закрывается, и запрос продолжается с места остановки
+    assert pg.queries[:3] == [EPOCH, EPOCH + datetime.timedelta(seconds=2), EPOCH + datetime.timedelta(seconds=4)]
+
+
+def test_restart_keeps_rows_with_same_updated_at(monkeypatch):
+    monkeypatch.setattr(main.conf.sql_settings, "cursor_max_age", 0)
+    # Курсор закрывается между строками 2 и 3 с одинаковым updated_at
+    pg = FakePostgres(rows=5, updated_at=[1, 2, 2, 2, 3])
+    assert sum(producer(pg).generator(), []) == [1, 2, 3, 4, 5]
+
+
+def test_connection_errors_retried_with_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+    pg = FakePostgres(rows=3, failures=3)
+    assert sum(producer(pg).generator(), []) == [1, 2, 3]
+    assert sleeps == [1, 2, 4]
+
+
+def test_gives_up_after_backoff_max_time(monkeypatch):
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(main.conf.backoff, "max_time", -1)
+    pg = FakePostgres(rows=3, failures=10)
+    with pytest.raises(psycopg2.OperationalError):
+        list(producer(pg).generator())
+    assert len(pg.queries) == 2
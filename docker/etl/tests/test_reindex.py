@@ -0,0 +1,73 @@
+import datetime
+from typing import List
+
+import main
+from modules import sql_queries
+
+REBUILD_STARTED = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakePostgres:
+    def __init__(self, pg_dsl: dict) -> None:
+        pass
+
+    def __enter__(self) -> "FakePostgres":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def query(self, sql_query, params=None) -> List[dict]:
+        assert sql_query in (sql_queries.max_updated_at_sql("person"), sql_queries.max_updated_at_sql("genre"))
+        return [{"updated_at": REBUILD_STARTED}]
+
+
+class FakeHashStore:
+    def __init__(self, log: List[str]) -> None:
+        self.log = log
+
+    def forget_index(self, index_name: str) -> None:
+        self.log.append(f"forget {index_name}")
+
+
+class FakeRequester:
+    def __init__(self) -> None:
+        self.log: List[str] = []
+        self.hash_store = FakeHashStore(self.log)
+
+    def index_replicas(self, index_name: str) -> int:
+        return 1
+
+    def create_index_version(self, alias: str, index_struct: dict, settings: dict) -> str:
+        return f"{alias}_v2"
+
+    def update_index_settings(self, index_name: str, settings: dict) -> None:
+        pass
+
+    def forcemerge(self, index_name: str) -> None:
+        pass
+
+    def switch_alias(self, alias: str, index_name: str) -> None:
+        self.log.append(f"switch {alias}")
+
+
+def test_movies_rebuild_catches_up_nested_updates(monkeypatch):
+    requester = FakeRequester()
+
+    def loader_job(pg_dsl, loader, elastic_requester, state, limit, *args, to_index):
+        name = args[0] if loader is main.persons_or_genres_producer else loader.__name__
+
+        def job() -> None:
+            requester.log.append(f"{name} -> {to_index}")
+            if name != "fw_producer":
+                # Персоны/жанры догружаются с момента начала перестройки, а не с нуля
+                assert state.get_state(f"{name}_upd_at") == REBUILD_STARTED
+
+        return job
+
+    monkeypatch.setattr(main, "PostgresConnection", FakePostgres)
+    monkeypatch.setattr(main, "loader_job", loader_job)
+    main.reindex({}, requester, ["movies"], 100, None)
+
+    catch_up = ["fw_producer -> movies_v2", "person -> movies_v2", "genre -> movies_v2"]
+    assert requester.log == catch_up * 2 + ["switch movies"] + catch_up + ["forget movies_v2", "forget movies"]
@@ -0,0 +1,121 @@
+import threading
+from typing import Dict, Iterator, List
+
+import pytest
+from elasticsearch import exceptions as elastic_exceptions
+from elasticsearch import helpers
+
+from main import RetryingBulkClient, load_to_elastic, stream_to_elastic
+from modules.config import BulkConfig
+from modules.state_control import LeaseLost, SqliteStorage, State
+
+
+class FakeRequester:
+    """Отвечает на действия по одному, как helpers.parallel_bulk с raise_on_error=False"""
+
+    def __init__(self, failing: set) -> None:
+        self.failing = failing
+        self.sent: List[str] = []
+        self.remembered: Dict[str, bytes] = {}
+
+    def stream_bulk(self, actions: Iterator[dict], to_index: str):
+        for action in actions:
+            self.sent.append(action["_id"])
+            result = {"_id": action["_id"], "status": 400 if action["_id"] in self.failing else 200}
+            if action["_id"] in self.failing:
+                result["error"] = "mapper_parsing_exception"
+            yield action["_id"] not in self.failing, {"update": result}
+
+    def remember_hashes(self, to_index: str, hashes: Dict[str, bytes]) -> None:
+        self.remembered.update(hashes)
+
+
+def load(requester: FakeRequester, state: State, batches: List[List[str]]) -> None:
+    produced = []
+
+    def source():
+        for number, batch in enumerate(batches, 1):
+            produced.append(number)
+            yield batch
+
+    def prepare(ids: List[str]):
+        return [{"_id": doc_id} for doc_id in ids], {doc_id: doc_id.encode() for doc_id in ids}
+
+    stream_to_elastic(source(), lambda: produced[-1], requester, state, "upd_at", "movies", prepare)
+
+
+def test_all_batches_acknowledged():
+    requester = FakeRequester(failing=set())
+    state = State(SqliteStorage(":memory:"))
+    load(requester, state, [["a", "b"], [], ["c"]])
+    assert state.get_state("upd_at") == 3
+    assert set(requester.remembered) == {"a", "b", "c"}
+
+
+def test_failure_holds_back_watermark():
+    requester = FakeRequester(failing={"c"})
+    state = State(SqliteStorage(":memory:"))
+    with pytest.raises(helpers.BulkIndexError):
+        load(requester, state, [["a", "b"], ["c", "d"], ["e"]])
+    # Состояние - последней полностью подтверждённой пачки, следующие пачки не отправлялись,
+    # хэши пачки с ошибкой не запомнены
+    assert state.get_state("upd_at") == 1
+    assert requester.sent == ["a", "b", "c", "d"]
+    assert set(requester.remembered) == {"a", "b"}
+
+
+def test_bulk_retried_on_connection_error(monkeypatch):
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+
+    class FlakyClient:
+        transport = object()
+        calls = 0
+
+        def bulk(self, *args, **kwargs):
+            self.calls += 1
+            if self.calls == 1:
+                raise elastic_exceptions.ConnectionError("N/A", "connection refused", None)
+            return {"items": []}
+
+    client = FlakyClient()
+    assert RetryingBulkClient(client).bulk("body") == {"items": []}
+    assert client.calls == 2
+
+
+def test_lost_lease_stops_loading():
+    requester = FakeRequester(failing=set())
+    state = State(SqliteStorage(":memory:"))
+    stop = threading.Event()
+    produced = []
+
+    def source():
+        for number, batch in enumerate([["a"], ["b"], ["c"]], 1):
+            produced.append(number)
+            yield batch
+
+    def prepare(ids):
+        if ids == ["b"]:
+            # Аренда потеряна, пока загружалась вторая пачка
+            stop.set()
+        return [{"_id": doc_id} for doc_id in ids], {}
+
+    with pytest.raises(LeaseLost):
+        stream_to_elastic(source(), lambda: produced[-1], requester, state, "upd_at", "movies", prepare, stop)
+    assert state.get_state("upd_at") == 1
+    assert requester.sent == ["a", "b"]
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_load_to_elastic_with_lost_lease(streaming):
+    requester = FakeRequester(failing=set())
+    requester.bulk_settings = BulkConfig(streaming=streaming)
+    requester.hash_store = None
+    requester.make_bulk_request = lambda to_index, actions: requester.sent.extend(a["_id"] for a in actions)
+    state = State(SqliteStorage(":memory:"))
+    stop = threading.Event()
+    stop.set()
+    with pytest.raises(LeaseLost):
+        load_to_elastic(iter([["a"]]), lambda: 1, requester, state, "upd_at", "movies", "id",
+                        make_actions=lambda ids: [{"_id": doc_id} for doc_id in ids], stop=stop)
+    assert state.get_state("upd_at") is None
+    assert requester.sent == []
@@ -68,3 +68,84 @@ CREATE UNIQUE INDEX IF NOT EXISTS film_work_person_role ON content.person_film_w
     person_id,
     role
 );
+
+
+-- Индексы для выборки связанных кинопроизведений по персоне/жанру (Enricher в ETL):
+-- уникальные индексы выше начинаются с film_work_id и для поиска по person_id/genre_id не подходят
+CREATE INDEX IF NOT EXISTS person_film_work_person ON content.person_film_work(person_id);
+CREATE INDEX IF NOT EXISTS genre_film_work_genre ON content.genre_film_work(genre_id);
+
+-- Индекс для постраничной выборки кинопроизведений по ключу (updated_at, id)
+CREATE INDEX IF NOT EXISTS film_work_updated_at_id ON content.film_work(updated_at, id);
+
+-- Журнал изменений для ETL в режиме CDC (change data capture).
+-- Триггеры на таблицах контента записывают сюда, какие записи изменились,
+-- и отправляют уведомление в канал content_changes. ETL слушает канал
+-- и переиндексирует только затронутые документы
+CREATE TABLE IF NOT EXISTS content.changelog(
+    id bigserial PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    record_id uuid NOT NULL,
+    changed_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Записи, затронутые изменением строки rec таблицы tbl:
+-- для связующих таблиц это кинопроизведение и (для person_film_work) персона
+CREATE OR REPLACE FUNCTION content.changed_records(tbl TEXT, rec JSONB)
+RETURNS TABLE (table_name TEXT, record_id uuid) AS $$
+    SELECT tbl, (rec->>'id')::uuid WHERE tbl IN ('film_work', 'person', 'genre')
+    UNION ALL
+    SELECT 'film_work', (rec->>'film_work_id')::uuid WHERE tbl IN ('person_film_work', 'genre_film_work')
+    UNION ALL
+    SELECT 'person', (rec->>'person_id')::uuid WHERE tbl = 'person_film_work'
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION content.log_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO content.changelog(table_name, record_id)
+        SELECT * FROM content.changed_records(TG_TABLE_NAME, to_jsonb(NEW));
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO content.changelog(table_name, record_id)
+        SELECT * FROM content.changed_records(TG_TABLE_NAME, to_jsonb(OLD));
+    END IF;
+    -- Одинаковые уведомления в рамках транзакции Postgres отправляет один раз
+    PERFORM pg_notify('content_changes', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER film_work_changes AFTER INSERT OR UPDATE OR DELETE ON content.film_work
+    FOR EACH ROW EXECUTE FUNCTION content.log_change();
+CREATE OR REPLACE TRIGGER person_changes AFTER INSERT OR UPDATE OR DELETE ON content.person
+    FOR EACH ROW EXECUTE FUNCTION content.log_change();
+CREATE OR REPLACE TRIGGER genre_changes AFTER INSERT OR UPDATE OR DELETE ON content.genre
+    FOR EACH ROW EXECUTE FUNCTION content.log_change();
+CREATE OR REPLACE TRIGGER person_film_work_changes AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.log_change();
+CREATE OR REPLACE TRIGGER genre_film_work_changes AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.log_change();
+
+-- Изменение состава фильма (связей с персонами и жанрами) обновляет updated_at фильма.
+-- ETL пересобирает такой фильм целиком, поэтому удалённые связи пропадают из документа:
+-- загрузчики персон/жанров в фильмах только обновляют имена и добавляют записи, но не удаляют их.
+-- Фильм обновляется один раз на транзакцию, сколько бы связей в ней ни менялось
+CREATE OR REPLACE FUNCTION content.touch_film_work() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE content.film_work SET updated_at = now()
+        WHERE id = NEW.film_work_id AND updated_at IS DISTINCT FROM now();
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE content.film_work SET updated_at = now()
+        WHERE id = OLD.film_work_id AND updated_at IS DISTINCT FROM now();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER person_film_work_touch AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.touch_film_work();
+CREATE OR REPLACE TRIGGER genre_film_work_touch AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.touch_film_work();
@@ -5,3 +5,10 @@ class APIErrors:
     PERSON_NOT_FOUND = "Person not found"
     GENRE_NOT_FOUND = "Genre not found"
     NO_PERMISSIONS = "You have no permissions"
+    AUTH_UNAVAILABLE = "Authorization service is unavailable"
+    TOO_MANY_IDS = "Too many ids requested"
+    INVALID_CURSOR = "Invalid page cursor"
+    PAGE_OUT_OF_RANGE = "Page is out of range"
+    SNAPSHOT_NOT_FOUND = "Snapshot expired or not found"
+    TOO_MANY_SNAPSHOTS = "Too many open snapshots, close unused ones or retry later"
+    UNKNOWN_FIELDS = "Unknown fields requested"
@@ -1,16 +1,91 @@
 from http import HTTPStatus
-from typing import List
+from typing import List, Optional
 
-import requests
+import orjson
 from api.v1.error_messages import APIErrors
-from core.config import AUTH_URL
-from fastapi import APIRouter, Depends, HTTPException, Query
+from api.v1.params import batch_ids, model_fields, page_cursor, page_snapshot
+from api.v1.responses import (EMPTY_JSON_LIST, NDJSONResponse, RawJSONResponse, cursor_page_response,
+                              snapshot_page_response)
+from core.abstractions import TooManySnapshots
+from db.auth import AuthUnavailable
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from models.film import Film, FilmSmall
+from services.auth import EntitlementService, get_entitlement_service
 from services.film import FilmService, get_film_service
 
 router = APIRouter()
 
 
+# Объявлен раньше '/{film_id}', иначе 'batch' будет принят за ID фильма
+@router.get('/batch',
+            response_model=List[Film],
+            summary="Фильмы по списку ID",
+            description="Вывод нескольких фильмов по списку ID за один запрос. "
+                        "Ненайденные ID и фильмы по подписке без доступа к ним пропускаются",
+            response_description="Полная информация о найденных фильмах",
+            tags=['Информация по ID']
+            )
+async def films_batch(film_ids: List[str] = Depends(batch_ids),
+                      authorization: Optional[str] = Header(None),
+                      film_service: FilmService = Depends(get_film_service),
+                      entitlements: EntitlementService = Depends(get_entitlement_service)
+                      ) -> List[Film]:
+    films = await film_service.get_films_by_ids(film_ids)
+    # Флаг проверяется у каждого фильма. Записи кэша без флага (сохранённые до его появления)
+    # считаются фильмами по подписке, чтобы не отдать их бесплатно
+    parsed = orjson.loads(films)
+    if not any(film.get("subscribe_required", True) for film in parsed):
+        return RawJSONResponse(films)
+    try:
+        allowed = await entitlements.has_subscription(authorization)
+    except AuthUnavailable:
+        allowed = False
+    if not allowed:
+        films = orjson.dumps([film for film in parsed if not film.get("subscribe_required", True)])
+    return RawJSONResponse(films)
+
+
+# Объявлен раньше '/{film_id}', иначе 'export' будет принят за ID фильма
+@router.get('/export',
+            response_class=NDJSONResponse,
+            summary="Выгрузка всех фильмов",
+            description="Все фильмы (с фильтром по жанру) одним ответом в формате NDJSON: "
+                        "по фильму в строке, из одного согласованного снимка индекса. "
+                        "Параметр fields ограничивает выгружаемые поля. "
+                        "Фильмы по подписке выгружаются только подписчикам",
+            response_description="Информация о фильмах, по фильму в строке",
+            tags=['Выгрузка']
+            )
+async def films_export(filter_genre: str = Query(None, alias="filter[genre]"),
+                       fields: Optional[List[str]] = Depends(model_fields(Film)),
+                       authorization: Optional[str] = Header(None),
+                       film_service: FilmService = Depends(get_film_service),
+                       entitlements: EntitlementService = Depends(get_entitlement_service)):
+    try:
+        with_subscription = await entitlements.has_subscription(authorization)
+    except AuthUnavailable:
+        with_subscription = False
+    return NDJSONResponse(film_service.export_films(filter_genre, with_subscription, fields))
+
+
+@router.delete('/snapshot',
+               status_code=HTTPStatus.NO_CONTENT,
+               summary="Закрыть снимок списка фильмов",
+               description="Закрывает снимок, открытый через page[snapshot], не дожидаясь истечения его срока",
+               tags=['Список кинопроизведений']
+               )
+async def film_snapshot_close(snapshot: str = Query(..., alias="page[snapshot]"),
+                              film_service: FilmService = Depends(get_film_service)):
+    try:
+        await film_service.close_film_snapshot(snapshot)
+    except ValueError:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=APIErrors.SNAPSHOT_NOT_FOUND
+        )
+    return Response(status_code=HTTPStatus.NO_CONTENT)
+
+
 # Внедряем FilmService с помощью Depends(get_film_service)
 @router.get('/{film_id}',
             response_model=Film,
@@ -28,7 +103,9 @@ router = APIRouter()
             tags=['Информация по ID']
             )
 async def film_details(film_id: str,
-                       film_service: FilmService = Depends(get_film_service)
+                       authorization: Optional[str] = Header(None),
+                       film_service: FilmService = Depends(get_film_service),
+                       entitlements: EntitlementService = Depends(get_entitlement_service)
                        ) -> Film:
     film = await film_service.get_film_by_id(film_id)
 
@@ -38,31 +115,31 @@ async def film_details(film_id: str,
             detail=APIErrors.FILM_NOT_FOUND
         )
 
-    film_done = Film(uuid=film.uuid,
-                     title=film.title,
-                     imdb_rating=film.imdb_rating,
-                     description=film.description,
-                     genre=film.genre,
-                     actors=film.actors,
-                     writers=film.writers,
-                     directors=film.directors,
-                     subscribe_required=film.subscribe_required)
-
     if film.subscribe_required:
-        data = {'film_title': film.title}
-        resp = requests.get(f'{AUTH_URL}/user/role_check',
-                            body=data)
-        if resp.status_code == HTTPStatus.OK:
-            return film_done
-        else:
-            return APIErrors.NO_PERMISSIONS
+        try:
+            allowed = await entitlements.has_subscription(authorization)
+        except AuthUnavailable:
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail=APIErrors.AUTH_UNAVAILABLE
+            )
+        if not allowed:
+            raise HTTPException(
+                status_code=HTTPStatus.FORBIDDEN,
+                detail=APIErrors.NO_PERMISSIONS
+            )
+    return film
 
 
 @router.get('/',
             response_model=List[FilmSmall],
             summary="Список кинопроизведений",
             description="Список всех произведений "
-                        "(Пагинация по умолчанию - 50 элементов)",
+                        "(Пагинация по умолчанию - 50 элементов). "
+                        "С page[cursor] - курсорная пагинация: курсор следующей страницы "
+                        "приходит в заголовке X-Next-Cursor. "
+                        "С page[snapshot] - страницы одного согласованного снимка, изменения индекса "
+                        "во время обхода в нём не видны: токен следующей страницы приходит в заголовке X-Snapshot",
             response_description="Название и рейтинг фильма",
             tags=['Список кинопроизведений']
             )
@@ -71,26 +148,56 @@ async def film_main(
         page_size: int = Query(50, alias="page[size]"),
         page_number: int = Query(1, alias="page[number]"),
         filter_genre: str = Query(None, alias="filter[genre]"),
+        cursor: Optional[str] = Depends(page_cursor),
+        snapshot: Optional[str] = Depends(page_snapshot),
         film_service: FilmService = Depends(get_film_service)
 ) -> List[FilmSmall]:
+    if snapshot == "":
+        try:
+            data, snapshot = await film_service.open_film_snapshot(sort, page_size, filter_genre)
+        except TooManySnapshots:
+            raise HTTPException(
+                status_code=HTTPStatus.TOO_MANY_REQUESTS,
+                detail=APIErrors.TOO_MANY_SNAPSHOTS
+            )
+        return snapshot_page_response(data, snapshot)
+    if snapshot is not None:
+        try:
+            data, snapshot = await film_service.get_film_snapshot_page(snapshot)
+        except ValueError:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=APIErrors.SNAPSHOT_NOT_FOUND
+            )
+        return snapshot_page_response(data, snapshot)
+    if cursor is not None:
+        try:
+            data, next_cursor = await film_service.get_film_pagination_after(sort,
+                                                                             page_size,
+                                                                             cursor,
+                                                                             filter_genre)
+        except ValueError:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=APIErrors.INVALID_CURSOR
+            )
+        return cursor_page_response(data, next_cursor)
     data = await film_service.get_film_pagination(sort,
                                                   page_size,
                                                   page_number,
                                                   filter_genre)
-    if data:
-        films = [FilmSmall(uuid=film.uuid,
-                           title=film.title,
-                           imdb_rating=film.imdb_rating
-                           ) for film in data]
-    else:
-        films = None
-    return films
+    if data == EMPTY_JSON_LIST:
+        return None
+    # Сервис возвращает готовый JSON-список FilmSmall - отдаём его как есть
+    return RawJSONResponse(data)
 
 
 @router.get('/search/',
             response_model=List[FilmSmall],
             summary="Поиск кинопроизведений",
-            description="Полнотекстовый поиск по кинопроизведениям",
+            description="Полнотекстовый поиск по кинопроизведениям. "
+                        "С page[cursor] - курсорная пагинация: курсор следующей страницы "
+                        "приходит в заголовке X-Next-Cursor",
             response_description="Название и рейтинг фильма",
             tags=['Полнотекстовый поиск']
             )
@@ -98,14 +205,19 @@ async def film_search(
         query: str,
         page_size: int = Query(50, alias="page[size]"),
         page_number: int = Query(1, alias="page[number]"),
+        cursor: Optional[str] = Depends(page_cursor),
         film_service: FilmService = Depends(get_film_service)
 ) -> List[FilmSmall]:
+    if cursor is not None:
+        try:
+            data, next_cursor = await film_service.get_film_search_after(query, page_size, cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=APIErrors.INVALID_CURSOR
+            )
+        return cursor_page_response(data, next_cursor)
     data = await film_service.get_film_search(query, page_size, page_number)
-    if data:
-        films = [FilmSmall(uuid=film.uuid,
-                           title=film.title,
-                           imdb_rating=film.imdb_rating
-                           ) for film in data]
-    else:
-        films = None
-    return films
+    if data == EMPTY_JSON_LIST:
+        return None
+    return RawJSONResponse(data)
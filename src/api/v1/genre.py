@@ -1,15 +1,48 @@
 from http import HTTPStatus
 
 from fastapi import APIRouter, Depends, HTTPException
-from typing import List
+from typing import List, Optional
 
 from services.genre import GenreService, get_genre_service
 from models.genre import Genre
 from api.v1.error_messages import APIErrors
+from api.v1.params import batch_ids, model_fields
+from api.v1.responses import NDJSONResponse, RawJSONResponse
 
 router = APIRouter()
 
 
+# Объявлен раньше '/{genre_id}', иначе 'batch' будет принят за ID жанра
+@router.get("/batch",
+            response_model=List[Genre],
+            summary="Жанры по списку ID",
+            description="Вывод нескольких жанров по списку ID за один запрос. "
+                        "Ненайденные ID пропускаются",
+            response_description="Информация по найденным жанрам",
+            tags=['Информация по ID']
+            )
+async def genres_batch(genre_ids: List[str] = Depends(batch_ids),
+                       genre_service: GenreService = Depends(get_genre_service)
+                       ) -> List[Genre]:
+    genres_data = await genre_service.get_genres_by_ids(genre_ids)
+    return RawJSONResponse(genres_data)
+
+
+# Объявлен раньше '/{genre_id}', иначе 'export' будет принят за ID жанра
+@router.get("/export",
+            response_class=NDJSONResponse,
+            summary="Выгрузка всех жанров",
+            description="Все жанры одним ответом в формате NDJSON: по жанру в строке, "
+                        "из одного согласованного снимка индекса. "
+                        "Параметр fields ограничивает выгружаемые поля",
+            response_description="Информация о жанрах, по жанру в строке",
+            tags=['Выгрузка']
+            )
+async def genres_export(fields: Optional[List[str]] = Depends(model_fields(Genre)),
+                        genre_service: GenreService = Depends(get_genre_service)):
+    return NDJSONResponse(genre_service.export_genres(fields))
+
+
 # Внедряем GenreService с помощью Depends(get_genre_service)
 @router.get("/{genre_id}",
             response_model=Genre,
@@ -41,5 +74,5 @@ async def genre_details(genre_id: str,
             )
 async def genres(genre_service: GenreService = Depends(get_genre_service)) -> List[Genre]:
     genres_data = await genre_service.get_genres()
-    return genres_data
+    return RawJSONResponse(genres_data)
 
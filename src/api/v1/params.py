@@ -0,0 +1,59 @@
+from http import HTTPStatus
+from typing import Callable, List, Optional, Type
+
+from fastapi import HTTPException, Query
+
+from api.v1.error_messages import APIErrors
+from models.base import BaseOrjsonModel
+
+# Максимальное количество id в одном batch-запросе
+BATCH_MAX_IDS = 100
+# Максимальный размер страницы фильмов персонажа
+PERSON_FILMS_MAX_PAGE_SIZE = 100
+# Глубже ES страницы по from/size не отдаёт (index.max_result_window по умолчанию)
+MAX_RESULT_WINDOW = 10000
+
+
+def batch_ids(ids: str = Query(..., description="ID через запятую")) -> List[str]:
+    """Разбирает список id из параметра ids. Повторы убираются, порядок сохраняется"""
+    result = list(dict.fromkeys(data_id.strip() for data_id in ids.split(",") if data_id.strip()))
+    if len(result) > BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=APIErrors.TOO_MANY_IDS
+        )
+    return result
+
+
+def page_cursor(
+        cursor: Optional[str] = Query(None, alias="page[cursor]",
+                                      description="Курсор из заголовка X-Next-Cursor предыдущей страницы. "
+                                                  "Пустое значение - первая страница")
+) -> Optional[str]:
+    """Курсор страницы. Если он передан, page[number] не используется"""
+    return cursor
+
+
+def page_snapshot(
+        snapshot: Optional[str] = Query(None, alias="page[snapshot]",
+                                        description="Токен из заголовка X-Snapshot предыдущей страницы. "
+                                                    "Пустое значение - открыть новый снимок")
+) -> Optional[str]:
+    """Токен страницы согласованного снимка. Если он передан, page[number] и page[cursor] не используются"""
+    return snapshot
+
+
+def model_fields(model: Type[BaseOrjsonModel]) -> Callable[..., Optional[List[str]]]:
+    """Зависимость, разбирающая параметр fields - список полей model через запятую"""
+    def parse(fields: Optional[str] = Query(None, description="Поля через запятую (по умолчанию - все)")
+              ) -> Optional[List[str]]:
+        if fields is None:
+            return None
+        result = list(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+        if not result or any(field not in model.__fields__ for field in result):
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=APIErrors.UNKNOWN_FIELDS
+            )
+        return result
+    return parse
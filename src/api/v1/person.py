@@ -1,15 +1,47 @@
 from http import HTTPStatus
-from typing import List
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 
 from models.person import Person
 from services.person import PersonService, get_person_service, FilmSmall
 from api.v1.error_messages import APIErrors
+from api.v1.params import MAX_RESULT_WINDOW, PERSON_FILMS_MAX_PAGE_SIZE, batch_ids, model_fields, page_cursor
+from api.v1.responses import EMPTY_JSON_LIST, NDJSONResponse, RawJSONResponse, cursor_page_response
 
 router = APIRouter()
 
 
+# Объявлен раньше '/{person_id}', иначе 'batch' будет принят за ID персонажа
+@router.get("/batch",
+            response_model=List[Person],
+            summary="Персонажи по списку ID",
+            description="Информация о нескольких персонажах по списку ID за один запрос. "
+                        "Ненайденные ID пропускаются",
+            response_description="Полная информация о найденных персонажах",
+            tags=['Информация по ID'])
+async def persons_batch(person_ids: List[str] = Depends(batch_ids),
+                        person_service: PersonService = Depends(get_person_service)
+                        ) -> List[Person]:
+    persons = await person_service.get_persons_by_ids(person_ids)
+    return RawJSONResponse(persons)
+
+
+# Объявлен раньше '/{person_id}', иначе 'export' будет принят за ID персонажа
+@router.get("/export",
+            response_class=NDJSONResponse,
+            summary="Выгрузка всех персонажей",
+            description="Все персонажи одним ответом в формате NDJSON: по персонажу в строке, "
+                        "из одного согласованного снимка индекса. "
+                        "Параметр fields ограничивает выгружаемые поля",
+            response_description="Информация о персонажах, по персонажу в строке",
+            tags=['Выгрузка']
+            )
+async def persons_export(fields: Optional[List[str]] = Depends(model_fields(Person)),
+                         person_service: PersonService = Depends(get_person_service)):
+    return NDJSONResponse(person_service.export_persons(fields))
+
+
 @router.get("/{person_id}",
             response_model=Person,
             summary="Персонаж по ID",
@@ -36,35 +68,57 @@ async def person_details(person_id: str,
             response_model=List[Person],
             summary="Поиск персонажей",
             description="Полнотекстовый поиск по персонажам"
-                        " (Пагинация по умолчанию - 50 элементов)",
+                        " (Пагинация по умолчанию - 50 элементов)."
+                        " С page[cursor] - курсорная пагинация: курсор следующей страницы"
+                        " приходит в заголовке X-Next-Cursor",
             response_description="Информация о персонажах",
             tags=['Полнотекстовый поиск']
             )
 async def person_search(query: str,
                         page_size: int = Query(50, alias="page[size]"),
                         page_number: int = Query(1, alias="page[number]"),
+                        cursor: Optional[str] = Depends(page_cursor),
                         person_service: PersonService = Depends(get_person_service)) -> List[Person]:
+    if cursor is not None:
+        try:
+            persons, next_cursor = await person_service.get_person_search_after(query, page_size, cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=APIErrors.INVALID_CURSOR
+            )
+        return cursor_page_response(persons, next_cursor)
     persons = await person_service.get_person_search(
         query,
         page_size,
         page_number
     )
-    return persons
+    return RawJSONResponse(persons)
 
 
 @router.get('/{person_id}/film',
             response_model=List[FilmSmall],
             summary="Список кинопроизведений по ID персонажа",
-            description="Список кинопроизведений определённого персонажа",
-            response_description="Полный список фильмов персонажа",
+            description="Список кинопроизведений определённого персонажа"
+                        " (Пагинация по умолчанию - 50 элементов)",
+            response_description="Список фильмов персонажа",
             tags=['Информация по ID']
             )
 async def person_search(person_id: str,
+                        page_size: int = Query(50, alias="page[size]", ge=1, le=PERSON_FILMS_MAX_PAGE_SIZE),
+                        page_number: int = Query(1, alias="page[number]", ge=1),
                         persons_service: PersonService = Depends(get_person_service)) -> List[FilmSmall]:
-    data = await persons_service.get_films_by_person(person_id)
-    if not data:
+    if page_number * page_size > MAX_RESULT_WINDOW:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=APIErrors.PAGE_OUT_OF_RANGE
+        )
+    data = await persons_service.get_films_by_person(person_id, page_size, page_number)
+    # Пустая первая страница - персонажа нет (или у него нет фильмов),
+    # пустая следующая - фильмы закончились
+    if data == EMPTY_JSON_LIST and page_number == 1:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail=APIErrors.PERSON_NOT_FOUND
         )
-    return data
+    return RawJSONResponse(data)
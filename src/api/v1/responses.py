@@ -0,0 +1,36 @@
+from typing import Optional
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+# Пустой список в том виде, в котором его возвращают сервисы
+EMPTY_JSON_LIST = b"[]"
+# Заголовок с курсором следующей страницы. Его нет, если страница последняя
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Заголовок с токеном следующей страницы снимка. Его нет, если страница последняя (снимок закрыт)
+SNAPSHOT_HEADER = "X-Snapshot"
+
+
+class RawJSONResponse(Response):
+    """
+    Ответ с уже сериализованным JSON: тело отдаётся как есть,
+    без повторной валидации по response_model и сериализации
+    """
+    media_type = "application/json"
+
+
+def cursor_page_response(data: bytes, next_cursor: Optional[str]) -> RawJSONResponse:
+    """Страница курсорной пагинации: тело - JSON-список, курсор следующей страницы - в заголовке"""
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return RawJSONResponse(data, headers=headers)
+
+
+def snapshot_page_response(data: bytes, snapshot: Optional[str]) -> RawJSONResponse:
+    """Страница снимка: тело - JSON-список, токен следующей страницы - в заголовке"""
+    headers = {SNAPSHOT_HEADER: snapshot} if snapshot else None
+    return RawJSONResponse(data, headers=headers)
+
+
+class NDJSONResponse(StreamingResponse):
+    """Поток JSON-объектов по одному в строке"""
+    media_type = "application/x-ndjson"
@@ -1,12 +1,19 @@
 import abc
-from typing import Optional, Any, List, Callable, Type
+import asyncio
+import json
+import logging
+from functools import lru_cache
+from typing import Optional, Any, List, Callable, Type, Dict, Awaitable, Tuple, AsyncIterator
 
+import orjson
 import pydantic
 
 from models.base import BaseOrjsonModel
 
 from fastapi import Depends
 
+logger = logging.getLogger(__name__)
+
 
 class BaseCacheStorage:
     @abc.abstractmethod
@@ -29,6 +36,53 @@ class BaseCacheStorage:
         """Записать данные по ключу"""
         pass
 
+    @abc.abstractmethod
+    async def read_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """Получить данные по списку ключей. Для отсутствующих ключей - None"""
+        pass
+
+    @abc.abstractmethod
+    async def write_many(self, data: Dict[str, Any], expire: int) -> None:
+        """Записать данные по нескольким ключам"""
+        pass
+
+    @abc.abstractmethod
+    async def ttl(self, key: str) -> int:
+        """Оставшееся время жизни ключа в секундах: -1 - без срока, -2 - ключа нет"""
+        pass
+
+    async def read_with_ttl(self, key: str) -> Tuple[Optional[Any], int]:
+        """Данные и оставшееся время жизни (как в ttl) по ключу"""
+        data = await self.read(key)
+        return data, await self.ttl(key) if data is not None else -2
+
+    async def read_many_with_ttl(self, keys: List[str]) -> List[Tuple[Optional[Any], int]]:
+        """Данные и оставшееся время жизни (как в ttl) по списку ключей"""
+        return [(data, await self.ttl(key) if data is not None else -2)
+                for key, data in zip(keys, await self.read_many(keys))]
+
+    async def read_object(self, key: str) -> Optional[Any]:
+        """Получить из кэша уже разобранный объект. Если хранилище этого не умеет - None"""
+        return None
+
+    async def write_object(self, key: str, obj: Any) -> None:
+        """Сохранить разобранный объект рядом с уже записанными по ключу данными"""
+        pass
+
+    @abc.abstractmethod
+    async def lock(self, key: str, expire: int) -> Optional[str]:
+        """Захватить блокировку по ключу. Возвращает токен владельца или None, если она уже занята"""
+        pass
+
+    @abc.abstractmethod
+    async def unlock(self, key: str, token: str) -> None:
+        """Снять блокировку по ключу, если она всё ещё принадлежит владельцу token"""
+        pass
+
+
+class TooManySnapshots(Exception):
+    """Открыто слишком много снимков выборки, новый откроется после закрытия или истечения старых"""
+
 
 class BaseSearchEngine:
     @abc.abstractmethod
@@ -42,27 +96,111 @@ class BaseSearchEngine:
         pass
 
     @abc.abstractmethod
-    async def get(self, record_id: str, scope: str) -> Optional[Any]:
-        """Выполнить запрос к движку по конкретному id"""
+    async def get(self, record_id: str, scope: str, fields: Optional[List[str]] = None) -> Optional[Any]:
+        """Выполнить запрос к движку по конкретному id. fields - какие поля вернуть (по умолчанию все)"""
+        pass
+
+    @abc.abstractmethod
+    async def get_many(self, record_ids: List[str], scope: str,
+                       fields: Optional[List[str]] = None) -> List[Optional[Any]]:
+        """Выполнить запрос к движку по списку id. Для ненайденных id - None"""
         pass
 
     @abc.abstractmethod
-    async def search(self, search_query: Any, scope: str) -> Optional[List[Any]]:
-        """Выполнить запрос на поиск элементов к движку"""
+    async def search(self, search_query: Any, scope: str, fields: Optional[List[str]] = None) -> Optional[List[Any]]:
+        """Выполнить запрос на поиск элементов к движку. fields - какие поля вернуть (по умолчанию все)"""
+        pass
+
+    @abc.abstractmethod
+    async def search_page(self, search_query: Any, scope: str,
+                          fields: Optional[List[str]] = None) -> Tuple[List[Any], Optional[List[Any]]]:
+        """
+        Как search, но вместе с элементами возвращает значения сортировки последнего из них
+        (для продолжения выборки с этого места). Если элементов нет - None.
+        Если движок отверг значения search_after - ValueError
+        """
+        pass
+
+    @abc.abstractmethod
+    async def open_snapshot(self, search_query: Any, scope: str,
+                            fields: Optional[List[str]] = None) -> Tuple[List[Any], str]:
+        """
+        Открыть согласованный снимок выборки: изменения, сделанные после открытия,
+        в нём не видны. Возвращает первую страницу и id снимка для следующих.
+        Если открытых снимков уже слишком много - TooManySnapshots
+        """
+        pass
+
+    @abc.abstractmethod
+    async def snapshot_page(self, snapshot_id: str) -> Tuple[List[Any], str]:
+        """Следующая страница снимка и id для продолжения. Если снимок истёк или не найден - ValueError"""
+        pass
+
+    @abc.abstractmethod
+    async def close_snapshot(self, snapshot_id: str) -> None:
+        """Закрыть снимок, не дожидаясь истечения его срока"""
+        pass
+
+    @abc.abstractmethod
+    def scan(self, search_query: Any, scope: str) -> AsyncIterator[List[Any]]:
+        """Все страницы выборки из одного снимка. Снимок закрывается по окончании"""
         pass
 
 
 class BaseService:
-    def __init__(self, se: BaseSearchEngine, cache: Optional[BaseCacheStorage] = None, expire: int = 60 * 5):
+    """
+    Базовый сервис: читает данные из кэша, а при промахе идёт в поисковый движок.
+
+    Одновременные промахи по одному ключу кэша схлопываются (single-flight):
+    в рамках воркера в движок уходит только один запрос, остальные ждут его результат.
+    Если передан lock_expire, то схлопывание работает и между воркерами - через
+    блокировку в кэше: воркеры, не захватившие её, ждут появления данных в кэше
+    не дольше lock_wait секунд.
+
+    Записи по id (get_by_id) хранятся в кэше сырыми и разобранными (в локальном кэше),
+    результаты поиска (search_raw, search_page_raw) - готовым JSON. Результаты поиска живут
+    в кэше expire + stale секунд. Первые expire секунд они свежие, а после - устаревшие:
+    их сразу отдают клиенту и обновляют в фоне.
+    """
+
+    LOCK_POLL_INTERVAL = 0.05
+
+    def __init__(self,
+                 se: BaseSearchEngine,
+                 cache: Optional[BaseCacheStorage] = None,
+                 expire: int = 60 * 5,
+                 lock_expire: Optional[int] = None,
+                 lock_wait: float = 1,
+                 stale: int = 0):
         self.se = se
         self.cache_service = cache
         self.expire_time = expire
+        self.stale_time = stale
+        self.lock_expire = lock_expire
+        self.lock_wait = lock_wait
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    @lru_cache()
+    def _fields(model: Type[BaseOrjsonModel]) -> List[str]:
+        """
+        Поля модели - из движка запрашиваются только они (фильтр _source).
+        Кэш хранит данные модели, поэтому ключи кэша сервисов должны различаться по модели
+        """
+        return list(model.__fields__)
 
     async def get_by_id(self, data_id: str, model: Type[BaseOrjsonModel], key: str = None) -> Optional[BaseOrjsonModel]:
         if self.cache_service is not None:
-            from_cache = await self._get_data_from_cache(key)
+            from_cache = await self._get_parsed_from_cache(key, model.parse_raw)
             if from_cache is not None:
-                return model.parse_raw(from_cache)
+                return from_cache
+        return await self._single_flight(
+            key,
+            lambda: self._load_by_id(data_id, model, key),
+            model.parse_raw
+        )
+
+    async def _load_by_id(self, data_id: str, model: Type[BaseOrjsonModel], key: str = None) -> Optional[BaseOrjsonModel]:
         from_db = await self._get_by_id_from_db(data_id, model)
         if from_db is None:
             return None
@@ -70,8 +208,69 @@ class BaseService:
             await self._put_data_to_cache(key, from_db)
         return from_db
 
+    async def _single_flight(self, key: Optional[str], load: Callable[[], Awaitable[Any]],
+                             parse: Callable[[Any], Any]) -> Any:
+        """
+        Выполняет load не более одного раза на ключ одновременно.
+        Остальные вызовы с тем же ключом дожидаются уже запущенной задачи.
+        Результат задачи общий, поэтому каждый вызов получает свою копию (см. _copy)
+        """
+        if key is None or self.cache_service is None:
+            return await load()
+        # shield: отмена одного из ожидающих запросов не должна отменять общую задачу
+        return self._copy(await asyncio.shield(self._start_flight(key, load, parse)))
+
+    def _start_flight(self, key: str, load: Callable[[], Awaitable[Any]],
+                      parse: Callable[[Any], Any]) -> asyncio.Future:
+        """Запускает загрузку по ключу или возвращает уже запущенную"""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load_with_lock(key, load, parse))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            task.add_done_callback(self._log_flight_error)
+        return task
+
+    @staticmethod
+    def _log_flight_error(task: asyncio.Future) -> None:
+        # Фоновое обновление никто не ждёт, поэтому ошибку нужно хотя бы залогировать
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error while loading data to cache: %s", task.exception())
+
+    def _revalidate_if_stale(self, key: str, ttl: int, load: Callable[[], Awaitable[Any]],
+                             parse: Callable[[Any], Any]) -> None:
+        """
+        Если данные в кэше устарели (осталось жить не больше stale секунд), запускает
+        их обновление в фоне. ttl читается из кэша вместе с данными, отдельного запроса нет
+        """
+        if self.stale_time and 0 <= ttl <= self.stale_time:
+            self._start_flight(key, load, parse)
+
+    async def _load_with_lock(self, key: str, load: Callable[[], Awaitable[Any]],
+                              parse: Callable[[Any], Any]) -> Any:
+        if self.lock_expire is None:
+            return await load()
+        loop = asyncio.get_event_loop()
+        lock_key = f"{key}::lock"
+        deadline = loop.time() + self.lock_wait
+        while loop.time() < deadline:
+            token = await self.cache_service.lock(lock_key, expire=self.lock_expire)
+            if token is not None:
+                try:
+                    return await load()
+                finally:
+                    # Если загрузка шла дольше lock_expire, блокировку мог захватить другой воркер -
+                    # её снимет только он
+                    await self.cache_service.unlock(lock_key, token)
+            # Данные загружает другой воркер - ждём, когда они появятся в кэше
+            await asyncio.sleep(self.LOCK_POLL_INTERVAL)
+            from_cache = await self._get_parsed_from_cache(key, parse)
+            if from_cache is not None:
+                return from_cache
+        return await load()
+
     async def _get_by_id_from_db(self, data_id: str, model) -> Optional[BaseOrjsonModel]:
-        doc = await self.se.get(scope=model.table_name, record_id=data_id)
+        doc = await self.se.get(scope=model.table_name, record_id=data_id, fields=self._fields(model))
         if doc is None:
             return None
         return model(**doc)
@@ -82,23 +281,177 @@ class BaseService:
             return None
         return data
 
+    async def _get_data_with_ttl(self, key) -> Tuple[Optional[Any], int]:
+        """Данные из кэша и их оставшееся время жизни - одним запросом к кэшу"""
+        data, ttl = await self.cache_service.read_with_ttl(key)
+        if not data:
+            return None, -2
+        return data, ttl
+
+    async def _get_parsed_from_cache(self, key, parse: Callable[[Any], Any]) -> Optional[Any]:
+        """
+        Достаёт из кэша уже разобранный объект, а если его нет - разбирает сырые данные
+        и отдаёт объект кэшу на хранение. Объект в кэше общий для всех запросов,
+        поэтому запрос получает его копию (см. _copy)
+        """
+        obj = await self.cache_service.read_object(key)
+        if obj is not None:
+            return self._copy(obj)
+        data = await self._get_data_from_cache(key)
+        if data is None:
+            return None
+        obj = parse(data)
+        await self.cache_service.write_object(key, obj)
+        return self._copy(obj)
+
+    @staticmethod
+    def _copy(obj: Any) -> Any:
+        """
+        Поверхностная копия модели: запрос может менять и заменять её поля, не затрагивая
+        объект в кэше. Вложенные списки и словари общие - менять их на месте нельзя.
+        Глубокая копия стоит дороже, чем разбор сырых данных заново
+        """
+        if isinstance(obj, BaseOrjsonModel):
+            return obj.copy()
+        return obj
+
     async def _put_data_to_cache(self, key, data: BaseOrjsonModel) -> None:
-        await self.cache_service.write(key, data.json(), expire=self.expire_time)
+        await self.cache_service.write(key, data.json().encode(), expire=self.expire_time)
+        await self.cache_service.write_object(key, self._copy(data))
 
-    async def search_data(self, query: Any, model: Type[BaseOrjsonModel], key: str = None) -> List[BaseOrjsonModel]:
+    async def get_many_raw(self, data_ids: List[str], model: Type[BaseOrjsonModel], keys: List[str]) -> bytes:
+        """
+        Получить записи по списку id: одним запросом к кэшу по ключам keys и одним запросом
+        к движку - только за теми id, которых в кэше не оказалось.
+        Возвращает JSON-массив найденных записей в порядке data_ids
+        """
+        found: Dict[str, bytes] = {}
         if self.cache_service is not None:
-            from_cache = await self._get_data_from_cache(key)
+            from_cache = await self.cache_service.read_many(keys)
+            found = {data_id: data for data_id, data in zip(data_ids, from_cache) if data}
+        missing = [(data_id, key) for data_id, key in zip(data_ids, keys) if data_id not in found]
+        if missing:
+            docs = await self.se.get_many([data_id for data_id, _ in missing], scope=model.table_name,
+                                          fields=self._fields(model))
+            to_cache = {}
+            for (data_id, key), doc in zip(missing, docs):
+                if doc is None:
+                    continue
+                found[data_id] = to_cache[key] = model(**doc).json().encode()
+            if self.cache_service is not None and to_cache:
+                await self.cache_service.write_many(to_cache, expire=self.expire_time)
+        return b"[" + b",".join(found[data_id] for data_id in data_ids if data_id in found) + b"]"
+
+    async def search_raw(self, query: Any, model: Type[BaseOrjsonModel], key: str = None) -> bytes:
+        """
+        Результаты поиска - готовый JSON-массив из моделей model в виде bytes.
+        В кэше лежит этот же JSON, поэтому при попадании в кэш ничего не разбирается
+        и не валидируется - байты можно сразу отдавать клиенту
+        """
+        def load() -> Awaitable[bytes]:
+            return self._load_raw(query, model, key)
+
+        if self.cache_service is not None:
+            from_cache, ttl = await self._get_data_with_ttl(key)
             if from_cache is not None:
-                return [model.parse_raw(_data) for _data in model.__config__.json_loads(from_cache)]
-        from_db = await self._get_object_from_db(query, model)
+                self._revalidate_if_stale(key, ttl, load, bytes)
+                return from_cache
+        return await self._single_flight(key, load, bytes)
+
+    async def search_page_raw(self, query: Any, model: Type[BaseOrjsonModel],
+                              key: str = None) -> Tuple[bytes, Optional[List[Any]]]:
+        """
+        Как search_raw, но вместе с JSON-массивом возвращает значения сортировки
+        последнего элемента страницы - по ним строится курсор следующей страницы
+        (None, если страница последняя). В кэше они лежат первой строкой перед самим массивом
+        """
+        def load() -> Awaitable[Tuple[bytes, Optional[List[Any]]]]:
+            return self._load_page_raw(query, model, key)
+
         if self.cache_service is not None:
-            await self._put_objects_to_cache(key, from_db, model)
-        return from_db
+            from_cache, ttl = await self._get_data_with_ttl(key)
+            if from_cache is not None:
+                self._revalidate_if_stale(key, ttl, load, self._split_page)
+                return self._split_page(from_cache)
+        return await self._single_flight(key, load, self._split_page)
+
+    @staticmethod
+    def _split_page(data: bytes) -> Tuple[bytes, Optional[List[Any]]]:
+        last_sort, page = data.split(b"\n", 1)
+        return page, json.loads(last_sort)
 
-    async def _get_object_from_db(self, query, model):
-        doc = await self.se.search(scope=model.table_name, search_query=query)
-        list_object = [model(**x) for x in doc]
-        return list_object
+    async def _load_page_raw(self, query: Any, model: Type[BaseOrjsonModel],
+                             key: str = None) -> Tuple[bytes, Optional[List[Any]]]:
+        docs, last_sort = await self.se.search_page(scope=model.table_name, search_query=query,
+                                                    fields=self._fields(model))
+        # Неполная страница - последняя, продолжать выборку не с чего
+        if len(docs) < query.get("size", 10):
+            last_sort = None
+        data = orjson.dumps([model(**doc).dict() for doc in docs])
+        if self.cache_service is not None:
+            # json, а не orjson: значения сортировки бывают +-Infinity
+            await self.cache_service.write(key, json.dumps(last_sort).encode() + b"\n" + data,
+                                           expire=self.expire_time + self.stale_time)
+        return data, last_sort
+
+    async def open_snapshot_raw(self, query: Any, model: Type[BaseOrjsonModel]) -> Tuple[bytes, Optional[str]]:
+        """
+        Первая страница выборки из согласованного снимка и токен следующей страницы.
+        Токен None - страница последняя, снимок уже закрыт. Страницы снимка не кэшируются:
+        каждая читается один раз
+        """
+        docs, snapshot_id = await self.se.open_snapshot(scope=model.table_name, search_query=query,
+                                                        fields=self._fields(model))
+        return await self._snapshot_result(docs, snapshot_id, query.get("size", 10), model)
+
+    async def snapshot_page_raw(self, token: str, model: Type[BaseOrjsonModel]) -> Tuple[bytes, Optional[str]]:
+        """Следующая страница снимка по токену. Неверный или истёкший токен - ValueError"""
+        page_size, snapshot_id = self._parse_snapshot_token(token)
+        docs, snapshot_id = await self.se.snapshot_page(snapshot_id)
+        return await self._snapshot_result(docs, snapshot_id, page_size, model)
+
+    async def close_snapshot(self, token: str) -> None:
+        _, snapshot_id = self._parse_snapshot_token(token)
+        await self.se.close_snapshot(snapshot_id)
+
+    async def _snapshot_result(self, docs: List[Any], snapshot_id: str, page_size: int,
+                               model: Type[BaseOrjsonModel]) -> Tuple[bytes, Optional[str]]:
+        data = orjson.dumps([model(**doc).dict() for doc in docs])
+        if len(docs) < page_size:
+            await self.se.close_snapshot(snapshot_id)
+            return data, None
+        # Размер страницы нужен, чтобы узнать последнюю страницу, не запрашивая следующую
+        return data, f"{page_size}:{snapshot_id}"
 
-    async def _put_objects_to_cache(self, key, data, model):
-        await self.cache_service.write(key, model.__config__.json_dumps(data, default=model.json), expire=self.expire_time)
+    @staticmethod
+    def _parse_snapshot_token(token: str) -> Tuple[int, str]:
+        page_size, _, snapshot_id = token.partition(":")
+        if not snapshot_id:
+            raise ValueError("Invalid snapshot token")
+        return int(page_size), snapshot_id
+
+    async def export_ndjson(self, query: Any, model: Type[BaseOrjsonModel],
+                            fields: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+        """
+        Все записи выборки из одного снимка в формате NDJSON: по объекту в строке с полями
+        fields (по умолчанию - все поля model). Из движка запрашиваются только эти поля,
+        а данные отдаются по странице снимка за раз, так что память не зависит от размера индекса.
+        Моделью записи не валидируются: в индекс они попадают уже проверенными строгой схемой
+        """
+        defaults = {name: field.default for name, field in model.__fields__.items()
+                    if fields is None or name in fields}
+        query = dict(query, _source=list(defaults))
+        dumps = orjson.dumps
+        async for docs in self.se.scan(scope=model.table_name, search_query=query):
+            yield b"".join(
+                dumps({name: doc.get(name, default) for name, default in defaults.items()}) + b"\n"
+                for doc in docs
+            )
+
+    async def _load_raw(self, query: Any, model: Type[BaseOrjsonModel], key: str = None) -> bytes:
+        docs = await self.se.search(scope=model.table_name, search_query=query, fields=self._fields(model))
+        # Валидация моделью происходит один раз - при загрузке из движка
+        data = orjson.dumps([model(**doc).dict() for doc in docs])
+        if self.cache_service is not None:
+            await self.cache_service.write(key, data, expire=self.expire_time + self.stale_time)
+        return data
@@ -13,12 +13,40 @@ PROJECT_NAME = os.getenv('PROJECT_NAME', 'Read-only API для онлайн-ки
 REDIS_HOST = os.getenv('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 
+# Блокировка в Redis для схлопывания промахов кэша между воркерами.
+# Если CACHE_LOCK_EXPIRE не задан, запросы схлопываются только внутри воркера
+CACHE_LOCK_EXPIRE = int(os.getenv('CACHE_LOCK_EXPIRE', 0)) or None
+CACHE_LOCK_WAIT = float(os.getenv('CACHE_LOCK_WAIT', 1))
+
+# Локальный кэш воркера перед Redis. При CACHE_L1_MAX_ENTRIES=0 не используется
+CACHE_L1_MAX_ENTRIES = int(os.getenv('CACHE_L1_MAX_ENTRIES', 1000))
+CACHE_L1_MAX_BYTES = int(os.getenv('CACHE_L1_MAX_BYTES', 32 * 1024 * 1024))
+CACHE_L1_EXPIRE = int(os.getenv('CACHE_L1_EXPIRE', 30))
+
 # Настройки Elasticsearch
 ELASTIC_HOST = os.getenv('ELASTIC_HOST', '127.0.0.1')
 ELASTIC_PORT = int(os.getenv('ELASTIC_PORT', 9200))
+# Сколько живёт снимок выборки (scroll) без обращений к нему
+SNAPSHOT_KEEP_ALIVE = os.getenv('SNAPSHOT_KEEP_ALIVE', '1m')
+# Сколько снимков (page[snapshot]) воркер держит открытыми одновременно, сверх - 429.
+# Каждый scroll держит ресурсы ES, а брошенный освобождает их только через SNAPSHOT_KEEP_ALIVE
+SNAPSHOT_MAX_OPEN = int(os.getenv('SNAPSHOT_MAX_OPEN', 50))
+# Размер страницы при выгрузке всего индекса (NDJSON)
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 1000))
 
 # Корень проекта
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 # Сервис авторизации
-AUTH_URL = os.getenv("AUTH_URL", "127.0.0.1:5000")
\ No newline at end of file
+AUTH_URL = os.getenv("AUTH_URL", "127.0.0.1:5000")
+# Таймаут запроса к сервису авторизации и размер пула соединений воркера
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", 1))
+AUTH_POOL_SIZE = int(os.getenv("AUTH_POOL_SIZE", 100))
+# После AUTH_BREAKER_FAILURES ошибок подряд запросы к сервису авторизации
+# не отправляются AUTH_BREAKER_RESET секунд
+AUTH_BREAKER_FAILURES = int(os.getenv("AUTH_BREAKER_FAILURES", 5))
+AUTH_BREAKER_RESET = float(os.getenv("AUTH_BREAKER_RESET", 10))
+# Сколько секунд помнить результат проверки роли пользователя
+AUTH_CACHE_EXPIRE = int(os.getenv("AUTH_CACHE_EXPIRE", 30))
+# Роль, открывающая доступ к фильмам по подписке
+AUTH_SUBSCRIBER_ROLE = os.getenv("AUTH_SUBSCRIBER_ROLE", "subscriber")
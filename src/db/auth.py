@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+from http import HTTPStatus
+from typing import Optional
+
+import aiohttp
+
+from core import config
+
+logger = logging.getLogger(__name__)
+
+
+class AuthUnavailable(Exception):
+    """Сервис авторизации не ответил или circuit breaker разомкнут"""
+
+
+class CircuitBreaker:
+    """
+    Размыкается после failures ошибок подряд: следующие reset_timeout секунд
+    запросы не выполняются. Затем пропускается один пробный запрос - при успехе
+    breaker замыкается, при ошибке снова размыкается.
+    """
+
+    def __init__(self, failures: int, reset_timeout: float):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.trial = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.trial = False
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            if self.opened_at is None:
+                logger.warning("Auth service circuit breaker opened after %s failures", self.failures)
+            self.opened_at = time.monotonic()
+
+
+class AuthClient:
+    """
+    Асинхронный клиент сервиса авторизации с общим пулом соединений воркера.
+    Проверка роли не блокирует цикл событий, а при недоступности сервиса
+    (таймаут, ошибка, 5xx) быстро завершается исключением AuthUnavailable
+    """
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.url = config.AUTH_URL if "://" in config.AUTH_URL else f"http://{config.AUTH_URL}"
+        self.breaker = CircuitBreaker(config.AUTH_BREAKER_FAILURES, config.AUTH_BREAKER_RESET)
+
+    async def connect(self) -> None:
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config.AUTH_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(total=config.AUTH_TIMEOUT),
+        )
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    async def check_role(self, token: str, role: str) -> bool:
+        """Есть ли у владельца токена роль role"""
+        if not self.breaker.allow():
+            raise AuthUnavailable("circuit breaker is open")
+        try:
+            async with self.session.get(f"{self.url}/user/role_check",
+                                        params={"role": role},
+                                        headers={"Authorization": token}) as response:
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.breaker.failure()
+            raise AuthUnavailable(repr(e)) from e
+        if status >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            self.breaker.failure()
+            raise AuthUnavailable(f"auth service responded with {status}")
+        self.breaker.success()
+        return status == HTTPStatus.OK
+
+
+auth_client = AuthClient()
+
+
+# Функция понадобится при внедрении зависимостей
+async def get_auth_client() -> AuthClient:
+    return auth_client
@@ -1,7 +1,101 @@
+from typing import Optional, Any, List, Dict, Tuple
+
+from core import config
 from core.abstractions import BaseCacheStorage
+from db.memory import MemoryCache
 from db.redis import RedisCache
 
-cache: BaseCacheStorage = RedisCache()
+
+class TwoTierCache(BaseCacheStorage):
+    """
+    Двухуровневый кэш: локальный кэш воркера (L1) перед общим кэшем (L2, Redis).
+
+    Чтение сначала идёт в L1, при промахе - в L2, и найденное кладётся в L1.
+    Запись идёт в оба уровня. Время жизни записи в L1 не превышает его собственного TTL,
+    поэтому изменения из L2 доходят до воркера не позже, чем через этот TTL.
+    """
+
+    def __init__(self, local: MemoryCache, shared: BaseCacheStorage):
+        self.local = local
+        self.shared = shared
+
+    async def connect(self) -> None:
+        await self.local.connect()
+        await self.shared.connect()
+
+    async def close(self) -> None:
+        await self.local.close()
+        await self.shared.close()
+
+    async def read(self, key: str) -> Optional[Any]:
+        data, _ = await self.read_with_ttl(key)
+        return data
+
+    async def read_with_ttl(self, key: str) -> Tuple[Optional[Any], int]:
+        data, expire = await self.local.read_with_ttl(key)
+        if data is not None:
+            return data, expire
+        # Данные и TTL из L2 - одним запросом
+        data, expire = await self.shared.read_with_ttl(key)
+        if data is None:
+            return None, -2
+        # В L1 запись должна умереть не позже, чем в L2
+        local_expire = self.local.expire_time if expire == -1 else expire
+        if local_expire > 0:
+            await self.local.write(key, data, expire=local_expire)
+        return data, expire
+
+    async def write(self, key: str, data: Any, expire: int) -> None:
+        await self.shared.write(key, data, expire=expire)
+        await self.local.write(key, data, expire=expire)
+
+    async def read_many(self, keys: List[str]) -> List[Optional[Any]]:
+        result = await self.local.read_many(keys)
+        missing = [i for i, data in enumerate(result) if data is None]
+        if not missing:
+            return result
+        from_shared = await self.shared.read_many_with_ttl([keys[i] for i in missing])
+        for i, (data, expire) in zip(missing, from_shared):
+            result[i] = data
+            if data is None:
+                continue
+            # Как и в read: в L1 запись должна умереть не позже, чем в L2
+            if expire == -1:
+                expire = self.local.expire_time
+            if expire > 0:
+                await self.local.write(keys[i], data, expire=expire)
+        return result
+
+    async def write_many(self, data: Dict[str, Any], expire: int) -> None:
+        await self.shared.write_many(data, expire=expire)
+        await self.local.write_many(data, expire=expire)
+
+    async def ttl(self, key: str) -> int:
+        expire = await self.local.ttl(key)
+        if expire != -2:
+            return expire
+        return await self.shared.ttl(key)
+
+    async def read_object(self, key: str) -> Optional[Any]:
+        return await self.local.read_object(key)
+
+    async def write_object(self, key: str, obj: Any) -> None:
+        await self.local.write_object(key, obj)
+
+    async def lock(self, key: str, expire: int) -> Optional[str]:
+        return await self.shared.lock(key, expire)
+
+    async def unlock(self, key: str, token: str) -> None:
+        await self.shared.unlock(key, token)
+
+
+if config.CACHE_L1_MAX_ENTRIES:
+    cache: BaseCacheStorage = TwoTierCache(
+        MemoryCache(config.CACHE_L1_MAX_ENTRIES, config.CACHE_L1_MAX_BYTES, config.CACHE_L1_EXPIRE),
+        RedisCache()
+    )
+else:
+    cache: BaseCacheStorage = RedisCache()
 
 
 # Функция понадобится при внедрении зависимостей
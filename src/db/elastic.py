@@ -1,13 +1,28 @@
-from typing import Optional, List, Any
-from elasticsearch import AsyncElasticsearch
+import time
+from typing import Optional, List, Any, Tuple, AsyncIterator, Dict
+from elasticsearch import AsyncElasticsearch, NotFoundError, RequestError
 
-from core.abstractions import BaseSearchEngine
+from core.abstractions import BaseSearchEngine, TooManySnapshots
 from core import config
 
+TIME_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def duration_seconds(value: str) -> float:
+    """Длительность в формате ES (500ms, 30s, 1m) в секундах"""
+    for unit in sorted(TIME_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * TIME_UNITS[unit]
+    raise ValueError(f"Unknown time unit: {value}")
+
 
 class AsyncElasticEngine(BaseSearchEngine):
     def __init__(self):
         self.search_engine: Optional[AsyncElasticsearch] = None
+        # Открытые воркером снимки: id scroll -> момент, когда ES закроет его без обращений.
+        # Снимки выгрузки (scan) живут, пока идёт ответ, и здесь не считаются
+        self.snapshots: Dict[str, float] = {}
+        self.snapshot_keep_alive = duration_seconds(config.SNAPSHOT_KEEP_ALIVE)
 
     async def connect(self) -> None:
         self.search_engine = AsyncElasticsearch(hosts=[f'{config.ELASTIC_HOST}:{config.ELASTIC_PORT}'])
@@ -17,13 +32,74 @@ class AsyncElasticEngine(BaseSearchEngine):
     async def close(self) -> None:
         await self.search_engine.close()
 
-    async def get(self, record_id, scope) -> Optional[Any]:
-        data = await self.search_engine.get(index=scope, id=record_id, ignore=[404])
+    async def get(self, record_id, scope, fields=None) -> Optional[Any]:
+        data = await self.search_engine.get(index=scope, id=record_id, ignore=[404], _source_includes=fields)
         if data.get("_source") is None:
             return None
         return data["_source"]
 
-    async def search(self, search_query, scope) -> Optional[List[Any]]:
-        raw_data = await self.search_engine.search(index=scope, body=search_query)
+    async def get_many(self, record_ids, scope, fields=None) -> List[Optional[Any]]:
+        data = await self.search_engine.mget(index=scope, body={"ids": record_ids}, _source_includes=fields)
+        return [doc["_source"] if doc.get("found") else None for doc in data["docs"]]
+
+    async def search(self, search_query, scope, fields=None) -> Optional[List[Any]]:
+        raw_data = await self.search_engine.search(index=scope, body=search_query, _source_includes=fields)
         data = [src["_source"] for src in raw_data["hits"]["hits"]]
         return data
+
+    async def search_page(self, search_query, scope, fields=None) -> Tuple[List[Any], Optional[List[Any]]]:
+        try:
+            raw_data = await self.search_engine.search(index=scope, body=search_query, _source_includes=fields)
+        except RequestError:
+            # Значения search_after из курсора не подходят к полям сортировки (курсор подделан)
+            if "search_after" in search_query:
+                raise ValueError("Invalid cursor")
+            raise
+        hits = raw_data["hits"]["hits"]
+        if not hits:
+            return [], None
+        return [src["_source"] for src in hits], hits[-1].get("sort")
+
+    async def open_snapshot(self, search_query, scope, fields=None) -> Tuple[List[Any], str]:
+        now = time.monotonic()
+        self.snapshots = {snapshot_id: deadline for snapshot_id, deadline in self.snapshots.items()
+                          if deadline > now}
+        if len(self.snapshots) >= config.SNAPSHOT_MAX_OPEN:
+            raise TooManySnapshots()
+        docs, snapshot_id = await self._open_scroll(search_query, scope, fields)
+        self.snapshots[snapshot_id] = now + self.snapshot_keep_alive
+        return docs, snapshot_id
+
+    async def _open_scroll(self, search_query, scope, fields=None) -> Tuple[List[Any], str]:
+        # В ES 7.9 ещё нет point in time, поэтому согласованный снимок - это scroll.
+        # Фильтр _source запоминается в scroll и действует на все его страницы
+        raw_data = await self.search_engine.search(index=scope, body=search_query, _source_includes=fields,
+                                                   scroll=config.SNAPSHOT_KEEP_ALIVE)
+        return [src["_source"] for src in raw_data["hits"]["hits"]], raw_data["_scroll_id"]
+
+    async def snapshot_page(self, snapshot_id) -> Tuple[List[Any], str]:
+        try:
+            raw_data = await self.search_engine.scroll(scroll_id=snapshot_id, scroll=config.SNAPSHOT_KEEP_ALIVE)
+        except (NotFoundError, RequestError):
+            self.snapshots.pop(snapshot_id, None)
+            raise ValueError("Snapshot expired or not found")
+        # Снимок, открытый другим воркером, здесь не учитывается
+        if self.snapshots.pop(snapshot_id, None) is not None:
+            self.snapshots[raw_data["_scroll_id"]] = time.monotonic() + self.snapshot_keep_alive
+        return [src["_source"] for src in raw_data["hits"]["hits"]], raw_data["_scroll_id"]
+
+    async def close_snapshot(self, snapshot_id) -> None:
+        self.snapshots.pop(snapshot_id, None)
+        try:
+            await self.search_engine.clear_scroll(scroll_id=snapshot_id, ignore=[404])
+        except RequestError:
+            raise ValueError("Snapshot not found")
+
+    async def scan(self, search_query, scope) -> AsyncIterator[List[Any]]:
+        docs, snapshot_id = await self._open_scroll(search_query, scope)
+        try:
+            while docs:
+                yield docs
+                docs, snapshot_id = await self.snapshot_page(snapshot_id)
+        finally:
+            await self.close_snapshot(snapshot_id)
@@ -0,0 +1,136 @@
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Any, Dict, List, Tuple
+
+from core.abstractions import BaseCacheStorage
+
+
+@dataclass
+class MemoryCacheEntry:
+    data: Any
+    # Момент вытеснения записи из локального кэша
+    expire_at: float
+    # Момент окончания жизни самих данных (может быть позже expire_at)
+    deadline: float
+    size: int
+    obj: Any = None
+
+
+class MemoryCache(BaseCacheStorage):
+    """
+    Ограниченный LRU-кэш с TTL в памяти процесса (своя копия в каждом воркере gunicorn).
+
+    Размер ограничивается количеством записей и суммарным объёмом данных в байтах,
+    при переполнении вытесняются давно не использованные записи.
+    Кроме сырых данных запись может хранить уже разобранный объект (write_object),
+    чтобы при попадании не тратить время на десериализацию. Его объём оценивается
+    объёмом сырых данных: запись с объектом считается вдвое больше.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, expire: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.expire_time = expire
+        self.size = 0
+        self.entries: OrderedDict[str, MemoryCacheEntry] = OrderedDict()
+        # Ключ блокировки -> (момент истечения, токен владельца)
+        self.locks: Dict[str, Tuple[float, str]] = {}
+
+    async def connect(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def _get_entry(self, key: str) -> Optional[MemoryCacheEntry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expire_at <= time.monotonic():
+            self._delete(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _delete(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    async def read(self, key: str) -> Optional[Any]:
+        entry = self._get_entry(key)
+        return None if entry is None else entry.data
+
+    @staticmethod
+    def _data_size(data: Any) -> int:
+        # Строки считаются в байтах UTF-8, а не в символах
+        return len(data.encode()) if isinstance(data, str) else len(data)
+
+    def _evict(self) -> None:
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+
+    async def write(self, key: str, data: Any, expire: int) -> None:
+        size = self._data_size(data)
+        self._delete(key)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        self.entries[key] = MemoryCacheEntry(
+            data=data,
+            expire_at=now + min(expire, self.expire_time),
+            deadline=now + expire,
+            size=size
+        )
+        self.size += size
+        self._evict()
+
+    async def read_many(self, keys: List[str]) -> List[Optional[Any]]:
+        return [await self.read(key) for key in keys]
+
+    async def write_many(self, data: Dict[str, Any], expire: int) -> None:
+        for key, value in data.items():
+            await self.write(key, value, expire)
+
+    async def ttl(self, key: str) -> int:
+        entry = self._get_entry(key)
+        if entry is None:
+            return -2
+        return int(entry.deadline - time.monotonic())
+
+    async def read_with_ttl(self, key: str) -> Tuple[Optional[Any], int]:
+        entry = self._get_entry(key)
+        if entry is None:
+            return None, -2
+        return entry.data, int(entry.deadline - time.monotonic())
+
+    async def read_object(self, key: str) -> Optional[Any]:
+        entry = self._get_entry(key)
+        return None if entry is None else entry.obj
+
+    async def write_object(self, key: str, obj: Any) -> None:
+        entry = self._get_entry(key)
+        if entry is None:
+            return
+        if entry.obj is None:
+            extra = self._data_size(entry.data)
+            entry.size += extra
+            self.size += extra
+        entry.obj = obj
+        self._evict()
+
+    async def lock(self, key: str, expire: int) -> Optional[str]:
+        now = time.monotonic()
+        if key in self.locks and self.locks[key][0] > now:
+            return None
+        token = uuid.uuid4().hex
+        self.locks[key] = (now + expire, token)
+        return token
+
+    async def unlock(self, key: str, token: str) -> None:
+        if key in self.locks and self.locks[key][1] == token:
+            del self.locks[key]
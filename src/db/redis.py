@@ -1,10 +1,20 @@
-from typing import Optional, Any
+import uuid
+from typing import Optional, Any, List, Dict, Tuple
 
 from aioredis import Redis, create_redis_pool
 from core.abstractions import BaseCacheStorage
 
 from core import config
 
+# Удаление блокировки, только если в ней всё ещё токен владельца: проверка и удаление
+# выполняются в Redis атомарно
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 
 class RedisCache(BaseCacheStorage):
     def __init__(self):
@@ -21,3 +31,46 @@ class RedisCache(BaseCacheStorage):
 
     async def write(self, key: str, data: Any, expire: int) -> None:
         await self.storage.set(key=key, value=data, expire=expire)
+
+    async def read_many(self, keys: List[str]) -> List[Optional[Any]]:
+        if not keys:
+            return []
+        return await self.storage.mget(*keys)
+
+    async def write_many(self, data: Dict[str, Any], expire: int) -> None:
+        # Все SET EX уходят в Redis одной пачкой
+        pipe = self.storage.pipeline()
+        for key, value in data.items():
+            pipe.set(key=key, value=value, expire=expire)
+        await pipe.execute()
+
+    async def ttl(self, key: str) -> int:
+        return await self.storage.ttl(key)
+
+    async def read_with_ttl(self, key: str) -> Tuple[Optional[Any], int]:
+        # GET и TTL - одной пачкой, за один обмен с Redis
+        pipe = self.storage.pipeline()
+        pipe.get(key)
+        pipe.ttl(key)
+        data, ttl = await pipe.execute()
+        return data, ttl
+
+    async def read_many_with_ttl(self, keys: List[str]) -> List[Tuple[Optional[Any], int]]:
+        if not keys:
+            return []
+        # GET и TTL всех ключей уходят в Redis одной пачкой
+        pipe = self.storage.pipeline()
+        for key in keys:
+            pipe.get(key)
+            pipe.ttl(key)
+        result = await pipe.execute()
+        return list(zip(result[::2], result[1::2]))
+
+    async def lock(self, key: str, expire: int) -> Optional[str]:
+        token = uuid.uuid4().hex
+        if await self.storage.set(key=key, value=token, expire=expire, exist=Redis.SET_IF_NOT_EXIST):
+            return token
+        return None
+
+    async def unlock(self, key: str, token: str) -> None:
+        await self.storage.eval(UNLOCK_SCRIPT, keys=[key], args=[token])
@@ -5,6 +5,7 @@ from socket import gaierror
 
 from api.v1 import film, genre, person
 from core import config
+from db.auth import auth_client
 from db.search_engine import search_engine
 from db.cache import cache
 
@@ -35,6 +36,7 @@ async def startup():
     # Поэтому логика подключения происходит в асинхронной функции
     await cache.connect()
     await search_engine.connect()
+    await auth_client.connect()
 
 
 @app.on_event('shutdown')
@@ -42,6 +44,7 @@ async def shutdown():
     # Отключаемся от баз при выключении сервера
     await cache.close()
     await search_engine.close()
+    await auth_client.close()
 
 
 # Подключаем роутер к серверу, указав префикс /v1/film
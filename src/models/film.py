@@ -17,3 +17,4 @@ class Film(FilmSmall):
     actors: Optional[List[dict]] = None
     writers: Optional[List[dict]] = None
     directors: Optional[List[dict]] = None
+    subscribe_required: bool = False
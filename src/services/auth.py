@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+from functools import lru_cache
+from typing import Dict, Optional
+
+from fastapi import Depends
+
+from core import config
+from core.abstractions import BaseCacheStorage
+from db.auth import AuthClient, get_auth_client
+from db.cache import get_cache
+from services.cache_key_generator import generate_key
+
+ALLOWED = b"1"
+DENIED = b"0"
+
+
+class EntitlementService:
+    """
+    Проверка ролей пользователя с кэшированием результата на expire секунд.
+
+    Ключ кэша - хэш токена и роль, так что сам токен в кэш не попадает.
+    Одновременные проверки одного токена схлопываются в один запрос к сервису авторизации
+    """
+
+    def __init__(self, client: AuthClient, cache: BaseCacheStorage, expire: int):
+        self.client = client
+        self.cache_service = cache
+        self.expire_time = expire
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def has_subscription(self, token: Optional[str]) -> bool:
+        """Открыты ли владельцу токена фильмы по подписке. Без токена - нет"""
+        if not token:
+            return False
+        return await self.has_role(token, config.AUTH_SUBSCRIBER_ROLE)
+
+    async def has_role(self, token: str, role: str) -> bool:
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        key = generate_key("auth", {"token": token_hash, "role": role})
+        from_cache = await self.cache_service.read(key)
+        if from_cache is not None:
+            return from_cache == ALLOWED
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._check(key, token, role))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield: отмена одного из ожидающих запросов не должна отменять общую проверку
+        return await asyncio.shield(task)
+
+    async def _check(self, key: str, token: str, role: str) -> bool:
+        allowed = await self.client.check_role(token, role)
+        await self.cache_service.write(key, ALLOWED if allowed else DENIED, expire=self.expire_time)
+        return allowed
+
+
+@lru_cache()
+def get_entitlement_service(
+        client: AuthClient = Depends(get_auth_client),
+        cache: BaseCacheStorage = Depends(get_cache),
+) -> EntitlementService:
+    return EntitlementService(client, cache, expire=config.AUTH_CACHE_EXPIRE)
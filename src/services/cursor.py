@@ -0,0 +1,45 @@
+import base64
+import json
+from typing import List, Optional
+
+# Последнее поле сортировки: uuid уникален, поэтому порядок полностью определён
+# и search_after не пропускает и не повторяет документы с равными значениями сортировки
+TIE_BREAKER = {"uuid": "asc"}
+
+
+def encode_cursor(sort_values: Optional[List]) -> Optional[str]:
+    """Непрозрачный курсор из значений сортировки. Нет значений (страница последняя) - нет курсора"""
+    if sort_values is None:
+        return None
+    # json, а не orjson: значения сортировки ES бывают +-Infinity (для документов без поля)
+    data = json.dumps(sort_values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_length: int) -> Optional[List]:
+    """
+    Значения сортировки из курсора для search_after. Пустой курсор - первая страница (None).
+    Если курсор повреждён или выдан для другой сортировки - ValueError.
+    Типы значений проверяются только грубо (скаляры): несовпадение типа с полем сортировки
+    обнаруживает ES, и движок тоже отвечает на это ValueError
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != sort_length:
+        raise ValueError("Invalid cursor")
+    if not all(value is None or isinstance(value, (str, int, float)) for value in values):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def apply_cursor(body: dict, sort: List[dict], cursor: str) -> dict:
+    """Сортировка с uuid в конце и search_after из курсора вместо from"""
+    body["sort"] = sort + [TIE_BREAKER]
+    search_after = decode_cursor(cursor, len(body["sort"]))
+    if search_after is not None:
+        body["search_after"] = search_after
+    return body
@@ -1,50 +1,34 @@
 from functools import lru_cache
-from typing import Optional, List, Dict
+from typing import Optional, List, Tuple, AsyncIterator
 
 from fastapi import Depends
 
+from core import config
 from core.abstractions import BaseCacheStorage, BaseSearchEngine, BaseService
 from db.cache import get_cache
 from db.search_engine import get_search_engine
-from models.film import Film
+from models.film import Film, FilmSmall
 from services.cache_key_generator import generate_key
+from services.cursor import apply_cursor, encode_cursor
 
 FILM_CACHE_EXPIRE_IN_SECONDS = 60 * 5  # 5 минут
+# Сколько ещё отдавать устаревшие результаты поиска, пока они обновляются в фоне
+FILM_CACHE_STALE_IN_SECONDS = 60 * 5  # 5 минут
 
 
 class FilmService(BaseService):
 
-    # Функция подготовки body для поиска по фильмам с пагинацией
+    # Функция подготовки body для поиска по фильмам с пагинацией.
+    # Возвращает готовый JSON-список FilmSmall
     async def get_film_search(
             self,
             query: str,
             page_size: int,
-            page_number: int) -> List[Film]:
+            page_number: int) -> bytes:
         body = {
             'size': page_size,
             'from': (page_number - 1) * page_size,
-            'query': {
-                "bool": {
-                    "should": [
-                        {
-                            "match": {
-                                "title": {
-                                    "query": query,
-                                    "fuzziness": "auto"
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "description": {
-                                    "query": query,
-                                    "fuzziness": "auto"
-                                }
-                            }
-                        }
-                    ]
-                }
-            }
+            'query': self._search_query(query)
         }
         # Здесь формируется ключ для кеширования запроса в AbstractCache
         params = {
@@ -52,23 +36,44 @@ class FilmService(BaseService):
             "query": query,
             "page_size": page_size,
             "page_number": page_number,
+            "model": FilmSmall.__name__,
         }
         key = generate_key("movies", params)
-        doc = await self.search_data(body, Film, key)
-        return doc
+        return await self.search_raw(body, FilmSmall, key)
+
+    # Поиск по фильмам с курсорной пагинацией (search_after): стоимость страницы
+    # не зависит от её глубины. Возвращает JSON-список FilmSmall и курсор следующей страницы
+    async def get_film_search_after(
+            self,
+            query: str,
+            page_size: int,
+            cursor: str) -> Tuple[bytes, Optional[str]]:
+        body = {
+            'size': page_size,
+            'query': self._search_query(query)
+        }
+        apply_cursor(body, [{"_score": {"order": "desc"}}], cursor)
+        params = {
+            "method": "films_search_after",
+            "query": query,
+            "page_size": page_size,
+            "cursor": cursor,
+            "model": FilmSmall.__name__,
+        }
+        key = generate_key("movies", params)
+        data, last_sort = await self.search_page_raw(body, FilmSmall, key)
+        return data, encode_cursor(last_sort)
 
     # Функция подготовки body для получения отсортированных фильмов
-    #        по рейтингу с возможностью фильтрации по жанрам (с пагинацией)
+    #        по рейтингу с возможностью фильтрации по жанрам (с пагинацией).
+    #        Возвращает готовый JSON-список FilmSmall
     async def get_film_pagination(self,
                                   sort: str,
                                   page_size: int,
                                   page_number: int,
                                   filter_genre: str
-                                  ) -> List[Film]:
-        order_value = 'asc'
-        if sort.startswith('-'):
-            sort = sort[1:]
-            order_value = 'desc'
+                                  ) -> bytes:
+        sort, order_value = self._parse_sort(sort)
         body = {
             'size': page_size,
             'from': (page_number - 1) * page_size,
@@ -79,22 +84,7 @@ class FilmService(BaseService):
             }
         }
         if filter_genre:
-            body['query'] = {
-                'bool': {
-                    'filter': {
-                        'nested': {
-                            'path': 'genre',
-                            'query': {
-                                'bool': {
-                                    'must': {
-                                        'match': {'genre.name': filter_genre}
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            }
+            body['query'] = self._genre_filter(filter_genre)
 
         params = {
             "method": "films",
@@ -102,21 +92,152 @@ class FilmService(BaseService):
             "order": order_value,
             "page_size": page_size,
             "page_number": page_number,
-            "filter_by": filter_genre
+            "filter_by": filter_genre,
+            "model": FilmSmall.__name__,
+        }
+        key = generate_key("movies", params)
+        return await self.search_raw(body, FilmSmall, key)
+
+    # То же, что get_film_pagination, но с курсорной пагинацией (search_after).
+    #        Возвращает JSON-список FilmSmall и курсор следующей страницы
+    async def get_film_pagination_after(self,
+                                        sort: str,
+                                        page_size: int,
+                                        cursor: str,
+                                        filter_genre: str
+                                        ) -> Tuple[bytes, Optional[str]]:
+        sort, order_value = self._parse_sort(sort)
+        body = {'size': page_size}
+        if filter_genre:
+            body['query'] = self._genre_filter(filter_genre)
+        apply_cursor(body, [{sort: {'order': order_value}}], cursor)
+
+        params = {
+            "method": "films_after",
+            "sort_by": sort,
+            "order": order_value,
+            "page_size": page_size,
+            "cursor": cursor,
+            "filter_by": filter_genre,
+            "model": FilmSmall.__name__,
         }
         key = generate_key("movies", params)
-        doc = await self.search_data(body, Film, key)
-        return doc
+        data, last_sort = await self.search_page_raw(body, FilmSmall, key)
+        return data, encode_cursor(last_sort)
+
+    # Список фильмов из согласованного снимка индекса: правки ETL во время обхода
+    #        не дают повторов и пропусков. Возвращает первую страницу (JSON-список FilmSmall)
+    #        и токен следующей
+    async def open_film_snapshot(self,
+                                 sort: str,
+                                 page_size: int,
+                                 filter_genre: str
+                                 ) -> Tuple[bytes, Optional[str]]:
+        sort, order_value = self._parse_sort(sort)
+        body = {
+            'size': page_size,
+            'sort': {
+                sort: {
+                    'order': order_value
+                }
+            }
+        }
+        if filter_genre:
+            body['query'] = self._genre_filter(filter_genre)
+        return await self.open_snapshot_raw(body, FilmSmall)
+
+    async def get_film_snapshot_page(self, snapshot: str) -> Tuple[bytes, Optional[str]]:
+        return await self.snapshot_page_raw(snapshot, FilmSmall)
+
+    async def close_film_snapshot(self, snapshot: str) -> None:
+        await self.close_snapshot(snapshot)
+
+    # Выгрузка всех фильмов (с фильтром по жанру) в NDJSON из одного снимка индекса,
+    #        только поля fields (по умолчанию - все поля Film).
+    #        Фильмы по подписке попадают в выгрузку только при with_subscription
+    def export_films(self,
+                     filter_genre: str,
+                     with_subscription: bool,
+                     fields: Optional[List[str]] = None
+                     ) -> AsyncIterator[bytes]:
+        query = self._genre_filter(filter_genre) if filter_genre else {'bool': {}}
+        if not with_subscription:
+            query['bool']['must_not'] = {'term': {'subscribe_required': True}}
+        # Порядок выгрузке не важен, а _doc - самая дешёвая сортировка для scroll
+        body = {
+            'size': config.EXPORT_PAGE_SIZE,
+            'sort': ['_doc'],
+            'query': query
+        }
+        return self.export_ndjson(body, Film, fields)
+
+    @staticmethod
+    def _parse_sort(sort: str) -> Tuple[str, str]:
+        if sort.startswith('-'):
+            return sort[1:], 'desc'
+        return sort, 'asc'
+
+    @staticmethod
+    def _search_query(query: str) -> dict:
+        return {
+            "bool": {
+                "should": [
+                    {
+                        "match": {
+                            "title": {
+                                "query": query,
+                                "fuzziness": "auto"
+                            }
+                        }
+                    },
+                    {
+                        "match": {
+                            "description": {
+                                "query": query,
+                                "fuzziness": "auto"
+                            }
+                        }
+                    }
+                ]
+            }
+        }
+
+    @staticmethod
+    def _genre_filter(filter_genre: str) -> dict:
+        return {
+            'bool': {
+                'filter': {
+                    'nested': {
+                        'path': 'genre',
+                        'query': {
+                            'bool': {
+                                'must': {
+                                    'match': {'genre.name': filter_genre}
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
 
     # get_by_id возвращает объект фильма. Он опционален, так как фильм может отсутствовать в базе
     async def get_film_by_id(self, film_id: str) -> Optional[Film]:
-        key = generate_key("movies", {"by_id": film_id})
+        key = generate_key("movies", {"by_id": film_id, "model": Film.__name__})
         return await self.get_by_id(film_id, Film, key=key)
 
+    async def get_films_by_ids(self, film_ids: List[str]) -> bytes:
+        keys = [generate_key("movies", {"by_id": film_id, "model": Film.__name__}) for film_id in film_ids]
+        return await self.get_many_raw(film_ids, Film, keys)
+
 
 @lru_cache()
 def get_film_service(
         cache: BaseCacheStorage = Depends(get_cache),
         se: BaseSearchEngine = Depends(get_search_engine),
 ) -> FilmService:
-    return FilmService(se, cache, expire=FILM_CACHE_EXPIRE_IN_SECONDS)
+    return FilmService(se, cache,
+                       expire=FILM_CACHE_EXPIRE_IN_SECONDS,
+                       lock_expire=config.CACHE_LOCK_EXPIRE,
+                       lock_wait=config.CACHE_LOCK_WAIT,
+                       stale=FILM_CACHE_STALE_IN_SECONDS)
@@ -1,8 +1,9 @@
 from functools import lru_cache
-from typing import Optional, List
+from typing import Optional, List, AsyncIterator
 
 from fastapi import Depends
 
+from core import config
 from core.abstractions import BaseCacheStorage, BaseSearchEngine, BaseService
 from db.cache import get_cache
 from db.search_engine import get_search_engine
@@ -10,11 +11,13 @@ from models.genre import Genre
 from services.cache_key_generator import generate_key
 
 GENRE_CACHE_EXPIRE_IN_SECONDS = 60 * 5  # 5 минут
+# Сколько ещё отдавать устаревшие результаты поиска, пока они обновляются в фоне
+GENRE_CACHE_STALE_IN_SECONDS = 60 * 5  # 5 минут
 
 
 class GenreService(BaseService):
 
-    async def get_genres(self) -> List[Genre]:
+    async def get_genres(self) -> bytes:
         body = {
             "size": 50,
             "query": {
@@ -23,18 +26,35 @@ class GenreService(BaseService):
         }
         params = {
             "method": "all_genres",
+            "model": Genre.__name__,
         }
         key = generate_key("genres", params)
-        return await self.search_data(body, Genre, key=key)
+        return await self.search_raw(body, Genre, key=key)
 
     async def get_genre_by_id(self, genre_id: str) -> Optional[Genre]:
-        key = generate_key("genres", {"by_id": genre_id})
+        key = generate_key("genres", {"by_id": genre_id, "model": Genre.__name__})
         return await self.get_by_id(genre_id, Genre, key=key)
 
+    async def get_genres_by_ids(self, genre_ids: List[str]) -> bytes:
+        keys = [generate_key("genres", {"by_id": genre_id, "model": Genre.__name__}) for genre_id in genre_ids]
+        return await self.get_many_raw(genre_ids, Genre, keys)
+
+    def export_genres(self, fields: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+        # Выгрузка всех жанров в NDJSON из одного снимка индекса, только поля fields
+        body = {
+            "size": config.EXPORT_PAGE_SIZE,
+            "sort": ["_doc"]
+        }
+        return self.export_ndjson(body, Genre, fields)
+
 
 @lru_cache()
 def get_genre_service(
         cache: BaseCacheStorage = Depends(get_cache),
         search_engine: BaseSearchEngine = Depends(get_search_engine),
 ) -> GenreService:
-    return GenreService(search_engine, cache, expire=GENRE_CACHE_EXPIRE_IN_SECONDS)
+    return GenreService(search_engine, cache,
+                        expire=GENRE_CACHE_EXPIRE_IN_SECONDS,
+                        lock_expire=config.CACHE_LOCK_EXPIRE,
+                        lock_wait=config.CACHE_LOCK_WAIT,
+                        stale=GENRE_CACHE_STALE_IN_SECONDS)
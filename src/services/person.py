@@ -1,25 +1,33 @@
 from functools import lru_cache
-from typing import Optional, List
+from typing import Optional, List, Tuple, AsyncIterator
 
 from fastapi import Depends
 
+from core import config
 from core.abstractions import BaseCacheStorage, BaseSearchEngine, BaseService
 from db.cache import get_cache
 from db.search_engine import get_search_engine
 from models.film import FilmSmall
 from models.person import Person
 from services.cache_key_generator import generate_key
+from services.cursor import apply_cursor, encode_cursor
 
 PERSON_CACHE_EXPIRE_IN_SECONDS = 60 * 5  # 5 минут
+# Сколько ещё отдавать устаревшие результаты поиска, пока они обновляются в фоне
+PERSON_CACHE_STALE_IN_SECONDS = 60 * 5  # 5 минут
 
 
 class PersonService(BaseService):
 
     async def get_person_by_id(self, person_id: str) -> Optional[Person]:
-        key = generate_key("persons", {"by_id": person_id})
+        key = generate_key("persons", {"by_id": person_id, "model": Person.__name__})
         return await self.get_by_id(person_id, Person, key=key)
 
-    async def get_person_search(self, query: str, page_size: int, page_number: int) -> List[Person]:
+    async def get_persons_by_ids(self, person_ids: List[str]) -> bytes:
+        keys = [generate_key("persons", {"by_id": person_id, "model": Person.__name__}) for person_id in person_ids]
+        return await self.get_many_raw(person_ids, Person, keys)
+
+    async def get_person_search(self, query: str, page_size: int, page_number: int) -> bytes:
         body = {
             "size": page_size,
             "from": (page_number - 1) * page_size,
@@ -37,60 +45,75 @@ class PersonService(BaseService):
             "query": query,
             "page_size": page_size,
             "page_number": page_number,
+            "model": Person.__name__,
         }
         key = generate_key("persons", params)
-        persons = await self.search_data(body, Person, key=key)
-        return persons
+        return await self.search_raw(body, Person, key=key)
 
-    async def get_films_by_person(self, person_id):
+    async def get_person_search_after(self, query: str, page_size: int, cursor: str) -> Tuple[bytes, Optional[str]]:
+        # Курсорная пагинация (search_after): глубокие страницы стоят столько же, сколько первая
         body = {
-            "size": 100,
+            "size": page_size,
+            "query": {
+                "match": {
+                    "full_name": {
+                        "query": query,
+                        "fuzziness": "auto"
+                    }
+                }
+            }
+        }
+        apply_cursor(body, [{"_score": {"order": "desc"}}], cursor)
+        params = {
+            "method": "person_search_after",
+            "query": query,
+            "page_size": page_size,
+            "cursor": cursor,
+            "model": Person.__name__,
+        }
+        key = generate_key("persons", params)
+        data, last_sort = await self.search_page_raw(body, Person, key=key)
+        return data, encode_cursor(last_sort)
+
+    async def get_films_by_person(self, person_id: str, page_size: int, page_number: int) -> bytes:
+        # Фильмы персоны берутся из её film_ids (terms lookup в индексе persons):
+        # ES сам читает список id и ищет по нему фильмы, без трёх nested запросов.
+        # Порядок - порядок документов в индексе, он же был у nested запроса
+        body = {
+            "size": page_size,
+            "from": (page_number - 1) * page_size,
+            "sort": ["_doc"],
             "query": {
                 "bool": {
-                    "should": [
-                        {
-                            "nested": {
-                                "path": "actors",
-                                "query": {
-                                    "bool": {
-                                        "filter": [{"term": {"actors.uuid": person_id}}]
-                                    }
-                                }
-                            }
-                        },
-                        {
-                            "nested": {
-                                "path": "writers",
-                                "query": {
-                                    "bool": {
-                                        "filter": [{"term": {"writers.uuid": person_id}}]
-                                    }
-                                }
-                            }
-                        },
-                        {
-                            "nested": {
-                                "path": "directors",
-                                "query": {
-                                    "bool": {
-                                        "filter": [
-                                            {"term": {"directors.uuid": person_id}}]
-                                    }
-                                }
+                    "filter": {
+                        "terms": {
+                            "uuid": {
+                                "index": Person.table_name,
+                                "id": person_id,
+                                "path": "film_ids"
                             }
                         }
-                    ]
+                    }
                 }
             }
         }
         params = {
             "method": "films_by_person",
             "person_id": person_id,
+            "page_size": page_size,
+            "page_number": page_number,
+            "model": FilmSmall.__name__,
         }
         key = generate_key("persons", params)
+        return await self.search_raw(body, FilmSmall, key=key)
 
-        films = await self.search_data(body, FilmSmall, key=key)
-        return films
+    def export_persons(self, fields: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+        # Выгрузка всех персон в NDJSON из одного снимка индекса, только поля fields
+        body = {
+            "size": config.EXPORT_PAGE_SIZE,
+            "sort": ["_doc"]
+        }
+        return self.export_ndjson(body, Person, fields)
 
 
 @lru_cache()
@@ -98,4 +121,8 @@ def get_person_service(
         cache: BaseCacheStorage = Depends(get_cache),
         search_engine: BaseSearchEngine = Depends(get_search_engine),
 ) -> PersonService:
-    return PersonService(search_engine, cache, expire=PERSON_CACHE_EXPIRE_IN_SECONDS)
+    return PersonService(search_engine, cache,
+                         expire=PERSON_CACHE_EXPIRE_IN_SECONDS,
+                         lock_expire=config.CACHE_LOCK_EXPIRE,
+                         lock_wait=config.CACHE_LOCK_WAIT,
+                         stale=PERSON_CACHE_STALE_IN_SECONDS)
@@ -0,0 +1,121 @@
+"""
+Проверка доступа к фильмам по подписке под конкурентной нагрузкой на локальной
+заглушке сервиса авторизации (отвечает через AUTH_DELAY секунд).
+
+Одновременно выполняются PREMIUM_REQUESTS проверок роли от USERS пользователей
+и FREE_REQUESTS "бесплатных" запросов, которым авторизация не нужна. Для последних
+измеряется задержка - насколько их тормозят проверки соседей в том же воркере:
+ - sync: requests.get прямо в обработчике (как было), блокирует цикл событий;
+ - async: AuthClient на aiohttp с общим пулом соединений, без кэша;
+ - async+cache: EntitlementService - кэш проверок и схлопывание одновременных.
+
+Запуск из корня репозитория: python tests/benchmarks/auth_check.py
+"""
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from typing import Awaitable, Callable, List
+
+import requests
+from aiohttp import web
+
+AUTH_DELAY = 0.02
+PREMIUM_REQUESTS = 200
+FREE_REQUESTS = 200
+USERS = 10
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+PORT = free_port()
+os.environ["AUTH_URL"] = f"http://127.0.0.1:{PORT}"
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from db.auth import AuthClient  # noqa: E402
+from db.memory import MemoryCache  # noqa: E402
+from services.auth import EntitlementService  # noqa: E402
+
+
+async def role_check(request: web.Request) -> web.Response:
+    await asyncio.sleep(AUTH_DELAY)
+    if request.headers.get("Authorization", "").startswith("subscriber"):
+        return web.Response()
+    return web.Response(status=403)
+
+
+def run_stub_server(started: threading.Event) -> None:
+    """Заглушка работает в своём потоке и цикле событий, чтобы блокирующий клиент её не останавливал"""
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get("/user/role_check", role_check)
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", PORT).start())
+    started.set()
+    loop.run_forever()
+
+
+async def run(check: Callable[[str], Awaitable[bool]]) -> None:
+    free_latencies: List[float] = []
+
+    async def premium(i: int) -> None:
+        await check(f"subscriber-{i % USERS}")
+
+    async def free() -> None:
+        # Имитация обработчика без авторизации: несколько переключений цикла событий.
+        # Задержка считается от поступления запроса, то есть включает ожидание цикла
+        for _ in range(5):
+            await asyncio.sleep(0)
+        free_latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(max(PREMIUM_REQUESTS, FREE_REQUESTS)):
+        if i < PREMIUM_REQUESTS:
+            tasks.append(premium(i))
+        if i < FREE_REQUESTS:
+            tasks.append(free())
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    quantiles = statistics.quantiles(free_latencies, n=100)
+    print(f"  {PREMIUM_REQUESTS / elapsed:8.1f} premium req/s, "
+          f"free p50 {quantiles[49]:8.2f} ms, p95 {quantiles[94]:8.2f} ms")
+
+
+async def main() -> None:
+    url = f"{os.environ['AUTH_URL']}/user/role_check"
+    session = requests.Session()
+
+    async def sync_check(token: str) -> bool:
+        return session.get(url, params={"role": "subscriber"},
+                           headers={"Authorization": token}).status_code == 200
+
+    print("sync:")
+    await run(sync_check)
+
+    client = AuthClient()
+    await client.connect()
+    try:
+        print("async:")
+        await run(lambda token: client.check_role(token, "subscriber"))
+
+        entitlements = EntitlementService(client, MemoryCache(1000, 1024 * 1024, 30), expire=30)
+        print("async+cache:")
+        await run(lambda token: entitlements.has_role(token, "subscriber"))
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    server_started = threading.Event()
+    threading.Thread(target=run_stub_server, args=(server_started,), daemon=True).start()
+    server_started.wait()
+    asyncio.run(main())
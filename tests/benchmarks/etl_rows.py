@@ -0,0 +1,99 @@
+"""
+Сравнение стоимости превращения строк курсора Postgres в действия bulk запроса ES
+на 100 000 строк film_work:
+ - old: строка как словарь (DictCursor/namedtuple._asdict), dataclass по именованным
+   аргументам и elastic_format с перебором dataclasses.fields() на каждый объект;
+ - new: dataclass со __slots__, собранный из кортежа позиционно (row_loader),
+   и elastic_format по заранее вычисленному соответствию полей (es_document).
+
+Запуск из корня репозитория: python tests/benchmarks/etl_rows.py
+"""
+import datetime
+import os
+import sys
+import timeit
+import uuid
+from dataclasses import dataclass, field, fields
+from typing import List
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "docker", "etl", "src"))
+
+from modules.data_representation import FilmWork, row_loader  # noqa: E402
+
+ROWS = 100_000
+REPEAT = 3
+
+# Колонки в порядке fw_full_sql_query
+columns = [
+    "fw_id", "imdb_rating", "title", "description", "updated_at", "genre", "actors", "writers", "directors"
+]
+now = datetime.datetime.now(datetime.timezone.utc)
+rows = [
+    (
+        str(uuid.uuid4()),
+        7.5,
+        f"Film {i}",
+        "Description " * 20,
+        now,
+        [{"uuid": "g1", "name": "Comedy"}],
+        [{"uuid": f"a{j}", "full_name": f"Actor {j}"} for j in range(5)],
+        [{"uuid": "w1", "full_name": "Writer"}],
+        [{"uuid": "d1", "full_name": "Director"}],
+    )
+    for i in range(ROWS)
+]
+
+
+# FilmWork до изменения
+@dataclass
+class OldFilmWork:
+    fw_id: uuid.UUID = field(default=None)
+    imdb_rating: float = field(default=None)
+    title: str = field(default=None)
+    description: str = field(default=None)
+    genre: List = field(default_factory=list)
+    actors: List = field(default_factory=list)
+    writers: List = field(default_factory=list)
+    directors: List = field(default_factory=list)
+    updated_at: datetime.datetime = field(default=None)
+    subscribe_required: bool = field(default=False)
+
+    def elastic_format(self) -> dict:
+        di = {}
+        for model_field in fields(self):
+            f_name = model_field.name
+            if f_name == "genres":
+                f_name = "genre"
+            if f_name == "fw_id":
+                f_name = "uuid"
+            if f_name == "updated_at":
+                continue
+            di[f_name] = getattr(self, model_field.name)
+        return di
+
+
+def build_actions(objects: list) -> List[dict]:
+    # То же, что ElasticRequester.build_actions для upsert
+    return [
+        {"_op_type": "update", "_id": obj.fw_id, "doc": obj.elastic_format(), "retry_on_conflict": 3,
+         "doc_as_upsert": True}
+        for obj in objects
+    ]
+
+
+def old_path() -> List[dict]:
+    objects = [OldFilmWork(**dict(zip(columns, row))) for row in rows]
+    return build_actions(objects)
+
+
+def new_path() -> List[dict]:
+    load = row_loader(FilmWork, columns)
+    objects = [load(row) for row in rows]
+    return build_actions(objects)
+
+
+if __name__ == "__main__":
+    assert old_path() == new_path()
+    for name, func in (("old", old_path), ("new", new_path)):
+        best = min(timeit.repeat(func, number=1, repeat=REPEAT))
+        print(f"{name}: {best:.3f} s на {ROWS} строк ({ROWS / best:.0f} строк/с)")
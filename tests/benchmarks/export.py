@@ -0,0 +1,110 @@
+"""
+Пропускная способность выгрузки фильмов в NDJSON (BaseService.export_ndjson) на DOCS
+синтетических фильмах, отдаваемых поддельным scroll по EXPORT_PAGE_SIZE:
+ - validated: каждая запись проходит через Film(**doc).dict(), как в первой версии выгрузки;
+ - projected: _source, ограниченный полями модели, без валидации (текущая выгрузка);
+ - projected_small: то же с fields=uuid,title,imdb_rating - движок отдаёт только эти поля.
+Для каждого способа выводятся записей в секунду, объём ответа и пик памяти (tracemalloc).
+
+С флагом --live то же самое измеряется на живом ES (ELASTIC_HOST/ELASTIC_PORT, индекс movies) -
+тогда в результат входит и сокращение чтения и передачи _source на стороне ES.
+
+Запуск из корня репозитория: python tests/benchmarks/export.py [--live]
+"""
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+from typing import AsyncIterator, List, Optional, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+import orjson  # noqa: E402
+
+from core import config  # noqa: E402
+from core.abstractions import BaseService  # noqa: E402
+from models.film import Film  # noqa: E402
+
+DOCS = 50_000
+SMALL_FIELDS = ["uuid", "title", "imdb_rating"]
+
+
+def make_doc(i: int) -> dict:
+    return {
+        "uuid": f"00000000-0000-0000-0000-{i:012d}",
+        "title": f"Film {i}",
+        "imdb_rating": 7.5,
+        "description": "Description " * 20,
+        "subscribe_required": False,
+        "genre": [{"uuid": "g1", "name": "Comedy"}],
+        "actors": [{"uuid": f"a{j}", "full_name": f"Actor {j}"} for j in range(10)],
+        "writers": [{"uuid": "w1", "full_name": "Writer"}],
+        "directors": [{"uuid": "d1", "full_name": "Director"}],
+    }
+
+
+class FakeScrollEngine:
+    """Отдаёт синтетические документы страницами, учитывая _source запроса"""
+
+    def __init__(self, docs: List[dict]):
+        self.docs = docs
+
+    async def scan(self, search_query: dict, scope: str) -> AsyncIterator[List[dict]]:
+        source = search_query.get("_source")
+        size = search_query["size"]
+        for start in range(0, len(self.docs), size):
+            page = self.docs[start:start + size]
+            if source is not None:
+                page = [{name: doc[name] for name in source if name in doc} for doc in page]
+            yield page
+            await asyncio.sleep(0)
+
+
+class ValidatedExportService(BaseService):
+    """Выгрузка с валидацией каждой записи моделью и полным _source"""
+
+    async def export_ndjson(self, query, model, fields: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+        async for docs in self.se.scan(scope=model.table_name, search_query=query):
+            yield b"".join(orjson.dumps(model(**doc).dict()) + b"\n" for doc in docs)
+
+
+async def export(service: BaseService, fields: Optional[List[str]]) -> Tuple[int, int]:
+    query = {"size": config.EXPORT_PAGE_SIZE, "sort": ["_doc"]}
+    count = size = 0
+    async for chunk in service.export_ndjson(query, Film, fields):
+        count += chunk.count(b"\n")
+        size += len(chunk)
+    return count, size
+
+
+async def measure(name: str, service: BaseService, fields: Optional[List[str]]) -> None:
+    start = time.perf_counter()
+    count, size = await export(service, fields)
+    elapsed = time.perf_counter() - start
+    # Память - отдельным проходом: tracemalloc сильно замедляет выполнение
+    tracemalloc.start()
+    await export(service, fields)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<16} {count / elapsed:10.0f} docs/s  {size / 2 ** 20:7.1f} MB  peak {peak / 2 ** 20:6.1f} MB")
+
+
+async def main(live: bool) -> None:
+    if live:
+        from db.elastic import AsyncElasticEngine
+        engine = AsyncElasticEngine()
+        await engine.connect()
+    else:
+        engine = FakeScrollEngine([make_doc(i) for i in range(DOCS)])
+    try:
+        await measure("validated", ValidatedExportService(engine), None)
+        await measure("projected", BaseService(engine), None)
+        await measure("projected_small", BaseService(engine), SMALL_FIELDS)
+    finally:
+        if live:
+            await engine.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main("--live" in sys.argv))
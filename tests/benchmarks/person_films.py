@@ -0,0 +1,103 @@
+"""
+Сравнение задержки выборки фильмов персоны на живом ES (индексы movies и persons):
+ - nested: bool.should из трёх nested запросов по actors/writers/directors;
+ - terms_lookup: terms по uuid со списком id из film_ids документа персоны
+   (ES сам читает film_ids, один запрос от API);
+ - get_mget: документ персоны и mget фильмов по его film_ids (два запроса).
+
+Для каждого способа выводятся p50 и p95 по REPEAT запросам для каждой персоны.
+Адрес ES берётся из ELASTIC_HOST/ELASTIC_PORT.
+
+Запуск из корня репозитория: python tests/benchmarks/person_films.py
+"""
+import asyncio
+import os
+import statistics
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from elasticsearch import AsyncElasticsearch
+
+ELASTIC_HOST = os.getenv("ELASTIC_HOST", "127.0.0.1")
+ELASTIC_PORT = int(os.getenv("ELASTIC_PORT", 9200))
+PERSONS = 20
+REPEAT = 50
+PAGE_SIZE = 50
+
+
+def nested_body(person_id: str) -> dict:
+    return {
+        "size": PAGE_SIZE,
+        "query": {
+            "bool": {
+                "should": [
+                    {"nested": {"path": role, "query": {"term": {f"{role}.uuid": person_id}}}}
+                    for role in ("actors", "writers", "directors")
+                ]
+            }
+        }
+    }
+
+
+def terms_lookup_body(person_id: str) -> dict:
+    return {
+        "size": PAGE_SIZE,
+        "sort": ["_doc"],
+        "query": {
+            "bool": {
+                "filter": {
+                    "terms": {"uuid": {"index": "persons", "id": person_id, "path": "film_ids"}}
+                }
+            }
+        }
+    }
+
+
+async def nested(es: AsyncElasticsearch, person_id: str) -> None:
+    await es.search(index="movies", body=nested_body(person_id))
+
+
+async def terms_lookup(es: AsyncElasticsearch, person_id: str) -> None:
+    await es.search(index="movies", body=terms_lookup_body(person_id))
+
+
+async def get_mget(es: AsyncElasticsearch, person_id: str) -> None:
+    person = await es.get(index="persons", id=person_id, _source=["film_ids"])
+    film_ids = person["_source"]["film_ids"][:PAGE_SIZE]
+    if film_ids:
+        await es.mget(index="movies", body={"ids": film_ids})
+
+
+async def measure(es: AsyncElasticsearch,
+                  method: Callable[[AsyncElasticsearch, str], Awaitable[None]],
+                  person_ids: List[str]) -> List[float]:
+    timings = []
+    for person_id in person_ids:
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            await method(es, person_id)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+async def main() -> None:
+    es = AsyncElasticsearch(hosts=[f"{ELASTIC_HOST}:{ELASTIC_PORT}"])
+    try:
+        persons = await es.search(index="persons", body={"size": PERSONS, "_source": False})
+        person_ids = [hit["_id"] for hit in persons["hits"]["hits"]]
+
+        results: Dict[str, List[float]] = {}
+        for method in (nested, terms_lookup, get_mget):
+            # Прогрев кэшей ES, чтобы первый способ не был в худшем положении
+            await measure(es, method, person_ids[:1])
+            results[method.__name__] = await measure(es, method, person_ids)
+    finally:
+        await es.close()
+
+    for name, timings in results.items():
+        quantiles = statistics.quantiles(timings, n=100)
+        print(f"{name:<14} p50 {quantiles[49]:7.2f} ms   p95 {quantiles[94]:7.2f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
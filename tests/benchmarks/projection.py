@@ -0,0 +1,86 @@
+"""
+Стоимость страницы из 50 FilmSmall при полном _source и при фильтре _source по полям модели:
+ - full: ES отдаёт документ целиком (описание, жанры, актёры, сценаристы, режиссёры),
+   лишнее отбрасывается уже при сборке FilmSmall;
+ - projected: ES отдаёт только uuid, title и imdb_rating (_source_includes).
+Выводится размер ответа ES и время разбора ответа клиентом и сборки моделей
+на синтетических документах.
+
+С флагом --live дополнительно измеряются p50/p95 поиска на живом ES
+(ELASTIC_HOST/ELASTIC_PORT, индекс movies) - вместе с чтением _source и передачей по сети.
+
+Запуск из корня репозитория: python tests/benchmarks/projection.py [--live]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+import orjson  # noqa: E402
+
+from models.film import FilmSmall  # noqa: E402
+
+PAGE_SIZE = 50
+NUMBER = 2000
+REPEAT = 200
+FIELDS = list(FilmSmall.__fields__)
+
+
+def make_doc(i: int) -> dict:
+    return {
+        "uuid": f"00000000-0000-0000-0000-{i:012d}",
+        "title": f"Film {i}",
+        "imdb_rating": 7.5,
+        "description": "Description " * 20,
+        "subscribe_required": False,
+        "genre": [{"uuid": "g1", "name": "Comedy"}],
+        "actors": [{"uuid": f"a{j}", "full_name": f"Actor {j}"} for j in range(10)],
+        "writers": [{"uuid": "w1", "full_name": "Writer"}],
+        "directors": [{"uuid": "d1", "full_name": "Director"}],
+    }
+
+
+def es_response(projected: bool) -> bytes:
+    docs = [make_doc(i) for i in range(PAGE_SIZE)]
+    if projected:
+        docs = [{name: doc[name] for name in FIELDS} for doc in docs]
+    hits = [{"_index": "movies", "_id": doc["uuid"], "_score": 1.0, "_source": doc} for doc in docs]
+    return orjson.dumps({"took": 1, "hits": {"total": {"value": PAGE_SIZE}, "hits": hits}})
+
+
+def handle(raw: bytes) -> bytes:
+    # Как в клиенте ES и BaseService._load_raw: разбор ответа, сборка моделей, сериализация
+    data = json.loads(raw)
+    return orjson.dumps([FilmSmall(**hit["_source"]).dict() for hit in data["hits"]["hits"]])
+
+
+async def live() -> None:
+    from elasticsearch import AsyncElasticsearch
+
+    es = AsyncElasticsearch(hosts=[f"{os.getenv('ELASTIC_HOST', '127.0.0.1')}:{os.getenv('ELASTIC_PORT', 9200)}"])
+    body = {"size": PAGE_SIZE, "sort": {"imdb_rating": {"order": "desc"}}}
+    try:
+        for name, fields in (("full", None), ("projected", FIELDS)):
+            timings = []
+            for _ in range(REPEAT):
+                start = time.perf_counter()
+                await es.search(index="movies", body=body, _source_includes=fields)
+                timings.append((time.perf_counter() - start) * 1000)
+            quantiles = statistics.quantiles(timings, n=100)
+            print(f"live {name:<10} p50 {quantiles[49]:6.2f} ms  p95 {quantiles[94]:6.2f} ms")
+    finally:
+        await es.close()
+
+
+if __name__ == "__main__":
+    for name, projected in (("full", False), ("projected", True)):
+        raw = es_response(projected)
+        seconds = timeit.timeit(lambda: handle(raw), number=NUMBER)
+        print(f"{name:<10} {len(raw) / 1024:7.1f} KB per page  {seconds / NUMBER * 1e6:8.1f} us per page")
+    if "--live" in sys.argv:
+        asyncio.run(live())
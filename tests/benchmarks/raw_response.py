@@ -0,0 +1,67 @@
+"""
+Сравнение стоимости ответа со страницей из 50 фильмов при попадании в кэш:
+ - old: разбор кэша (json_loads + parse_raw), сборка FilmSmall в роутере,
+   валидация по response_model и сериализация в ORJSONResponse;
+ - raw: готовые байты из кэша отдаются через RawJSONResponse.
+
+Запуск из корня репозитория: python tests/benchmarks/raw_response.py
+"""
+import asyncio
+import os
+import sys
+import timeit
+from typing import List
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+import orjson  # noqa: E402
+from fastapi.responses import ORJSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+
+from api.v1.responses import RawJSONResponse  # noqa: E402
+from models.film import Film, FilmSmall  # noqa: E402
+
+PAGE_SIZE = 50
+NUMBER = 2000
+
+docs = [
+    {
+        "uuid": f"00000000-0000-0000-0000-{i:012d}",
+        "title": f"Film {i}",
+        "imdb_rating": 7.5,
+        "description": "Description " * 20,
+        "genre": [{"uuid": "g1", "name": "Comedy"}],
+        "actors": [{"uuid": f"a{j}", "full_name": f"Actor {j}"} for j in range(10)],
+        "writers": [{"uuid": "w1", "full_name": "Writer"}],
+        "directors": [{"uuid": "d1", "full_name": "Director"}],
+    }
+    for i in range(PAGE_SIZE)
+]
+films = [Film(**doc) for doc in docs]
+# Формат кэша до изменения: JSON-массив из JSON-строк моделей
+old_cached = Film.__config__.json_dumps(films, default=Film.json).encode()
+raw_cached = orjson.dumps([FilmSmall(**doc).dict() for doc in docs])
+
+response_field = create_response_field(name="response", type_=List[FilmSmall])
+loop = asyncio.new_event_loop()
+
+
+def old_path() -> bytes:
+    data = [Film.parse_raw(item) for item in Film.__config__.json_loads(old_cached)]
+    small = [FilmSmall(uuid=f.uuid, title=f.title, imdb_rating=f.imdb_rating) for f in data]
+    content = loop.run_until_complete(
+        serialize_response(field=response_field, response_content=small, is_coroutine=True)
+    )
+    return ORJSONResponse(content).body
+
+
+def raw_path() -> bytes:
+    return RawJSONResponse(raw_cached).body
+
+
+if __name__ == "__main__":
+    assert orjson.loads(old_path()) == orjson.loads(raw_path())
+    for name, func in (("old", old_path), ("raw", raw_path)):
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+        print(f"{name}: {seconds / NUMBER * 1e6:.1f} us/request")
@@ -57,6 +57,25 @@ def make_get_request(session):
     return inner
 
 
+@pytest.fixture
+def make_ndjson_request(session):
+    async def inner(method: str, params: dict = None) -> HTTPResponse:
+        params = params or {}
+        url = '{protocol}://{service_url}/api/v{api_version}/{method}'.format(
+            protocol=test_settings.service_protocol,
+            service_url=test_settings.service_url,
+            api_version=test_settings.api_version,
+            method=method
+        )
+        async with session.get(url, params=params) as response:
+            return HTTPResponse(
+                body=[json.loads(line) async for line in response.content],
+                headers=response.headers,
+                status=response.status,
+            )
+    return inner
+
+
 def read_json_file(file_path):
     with open(file_path) as json_file:
         json_data = json.load(json_file)
@@ -18,6 +18,62 @@ async def test_get_all_films_data(make_get_request, expected_json_response):
     assert response.body == expected_json_response
 
 
+async def test_get_all_films_data_by_cursor(make_get_request):
+    film_ids = []
+    params = {'page[size]': 30, 'page[cursor]': ''}
+    while True:
+        response = await make_get_request('film/', params)
+        assert response.status == HTTPStatus.OK
+        film_ids.extend(film['uuid'] for film in response.body)
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        params['page[cursor]'] = response.headers['X-Next-Cursor']
+    assert len(film_ids) == 100
+    assert len(set(film_ids)) == 100
+
+
+async def test_get_films_data_by_invalid_cursor(make_get_request):
+    response = await make_get_request('film/', {'page[cursor]': 'not-a-cursor'})
+    assert response.status == HTTPStatus.BAD_REQUEST
+    assert response.body['detail'] == 'Invalid page cursor'
+
+
+async def test_get_films_data_by_cursor_of_wrong_type(make_get_request):
+    # Курсор корректный по форме, но вместо рейтинга в нём строка - ES отвергает search_after
+    response = await make_get_request('film/', {'page[cursor]': 'WyJub3QtYS1yYXRpbmciLCJ1dWlkIl0'})
+    assert response.status == HTTPStatus.BAD_REQUEST
+    assert response.body['detail'] == 'Invalid page cursor'
+
+
+async def test_get_all_films_data_by_snapshot(make_get_request, expected_json_response):
+    films = []
+    params = {'page[size]': 30, 'page[snapshot]': ''}
+    while True:
+        response = await make_get_request('film/', params)
+        assert response.status == HTTPStatus.OK
+        films.extend(response.body)
+        if 'X-Snapshot' not in response.headers:
+            break
+        params['page[snapshot]'] = response.headers['X-Snapshot']
+    assert len(films) == 100
+    assert films == expected_json_response
+
+
+async def test_export_films(make_ndjson_request):
+    response = await make_ndjson_request('film/export')
+    assert response.status == HTTPStatus.OK
+    assert response.headers['Content-Type'].startswith('application/x-ndjson')
+    assert len(response.body) == 100
+    assert len({film['uuid'] for film in response.body}) == 100
+
+
+async def test_export_films_fields(make_ndjson_request):
+    response = await make_ndjson_request('film/export', {'fields': 'uuid,title'})
+    assert response.status == HTTPStatus.OK
+    assert len(response.body) == 100
+    assert all(set(film) == {'uuid', 'title'} for film in response.body)
+
+
 async def test_get_films_data_by_filter_comedy_and_sort_asc(make_get_request, expected_json_response):
     response = await make_get_request('film/?sort=imdb_rating&filter[genre]=comedy')
     assert response.status == HTTPStatus.OK
@@ -28,14 +84,14 @@ async def test_get_films_data_by_filter_comedy_and_sort_asc(make_get_request, ex
 async def test_get_film_data_by_id_1(make_get_request, expected_json_response):
     response = await make_get_request('film/2a090dde-f688-46fe-a9f4-b781a985275e')
     assert response.status == HTTPStatus.OK
-    assert len(response.body) == 8
+    assert len(response.body) == 9
     assert response.body == expected_json_response
 
 
 async def test_get_film_data_by_id_2(make_get_request, expected_json_response):
     response = await make_get_request('film/935e418d-09f3-4de4-8ce3-c31f31580b12')
     assert response.status == HTTPStatus.OK
-    assert len(response.body) == 8
+    assert len(response.body) == 9
     assert response.body == expected_json_response
 
 
@@ -44,3 +100,12 @@ async def test_get_film_data_by_unknown_id(make_get_request):
     assert response.status == HTTPStatus.NOT_FOUND
     assert len(response.body) == 1
     assert response.body['detail'] == 'Film not found'
+
+
+async def test_get_films_data_by_ids(make_get_request):
+    film_ids = ['935e418d-09f3-4de4-8ce3-c31f31580b12',
+                'ead9b449-734b-4878-86f1-1e4c96a28bba',
+                '2a090dde-f688-46fe-a9f4-b781a985275e']
+    response = await make_get_request('film/batch', {'ids': ','.join(film_ids)})
+    assert response.status == HTTPStatus.OK
+    assert [film['uuid'] for film in response.body] == [film_ids[0], film_ids[2]]
@@ -32,3 +32,26 @@ async def test_get_genre_data_by_unknown_id(make_get_request):
     assert len(response.body) == 1
     assert response.body['detail'] == 'Genre not found'
 
+
+
+async def test_get_genres_data_by_ids(make_get_request):
+    genre_ids = ['63c24835-34d3-4279-8d81-3c5f4ddb0cdc',
+                 'f39d7b6d-aef2-40b1-aaf0-cf05432gv43g4',
+                 'f39d7b6d-aef2-40b1-aaf0-cf05e7048011']
+    response = await make_get_request('genre/batch', {'ids': ','.join(genre_ids)})
+    assert response.status == HTTPStatus.OK
+    assert [genre['uuid'] for genre in response.body] == [genre_ids[0], genre_ids[2]]
+
+
+async def test_export_genres(make_ndjson_request, make_get_request):
+    response = await make_ndjson_request('genre/export')
+    genres = await make_get_request('genre/')
+    assert response.status == HTTPStatus.OK
+    assert sorted(response.body, key=lambda genre: genre['uuid']) == \
+        sorted(genres.body, key=lambda genre: genre['uuid'])
+
+
+async def test_export_genres_unknown_fields(make_get_request):
+    response = await make_get_request('genre/export', {'fields': 'uuid,rating'})
+    assert response.status == HTTPStatus.BAD_REQUEST
+    assert response.body['detail'] == 'Unknown fields requested'
@@ -18,6 +18,40 @@ async def test_get_person_films_data_by_id(make_get_request, expected_json_respo
     assert response.body == expected_json_response
 
 
+async def test_get_person_films_pagination(make_get_request):
+    first = await make_get_request('person/26e83050-29ef-4163-a99d-b546cac208f8/film',
+                                   {'page[size]': 5, 'page[number]': 1})
+    second = await make_get_request('person/26e83050-29ef-4163-a99d-b546cac208f8/film',
+                                    {'page[size]': 5, 'page[number]': 2})
+    last = await make_get_request('person/26e83050-29ef-4163-a99d-b546cac208f8/film',
+                                  {'page[size]': 5, 'page[number]': 3})
+    assert first.status == HTTPStatus.OK
+    assert second.status == HTTPStatus.OK
+    assert len(first.body) == 5
+    assert len(second.body) == 2
+    assert not {film['uuid'] for film in first.body} & {film['uuid'] for film in second.body}
+    assert last.status == HTTPStatus.OK
+    assert last.body == []
+
+
+@pytest.mark.parametrize('params', [
+    {'page[size]': 0},
+    {'page[size]': 101},
+    {'page[number]': 0},
+    {'page[number]': -1},
+])
+async def test_get_person_films_invalid_page(make_get_request, params):
+    response = await make_get_request('person/26e83050-29ef-4163-a99d-b546cac208f8/film', params)
+    assert response.status == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+async def test_get_person_films_page_beyond_result_window(make_get_request):
+    response = await make_get_request('person/26e83050-29ef-4163-a99d-b546cac208f8/film',
+                                      {'page[size]': 100, 'page[number]': 101})
+    assert response.status == HTTPStatus.BAD_REQUEST
+    assert response.body['detail'] == 'Page is out of range'
+
+
 async def test_get_person_data_by_unknown_id(make_get_request):
     response = await make_get_request('person/a5a8f573-3cee-4ccc-8a2b-91cb9aaaaaaa')
     assert response.status == HTTPStatus.NOT_FOUND
@@ -25,3 +59,18 @@ async def test_get_person_data_by_unknown_id(make_get_request):
     assert response.body['detail'] == 'Person not found'
 
 
+
+
+async def test_get_persons_data_by_ids(make_get_request, expected_json_response):
+    person_ids = ['a5a8f573-3cee-4ccc-8a2b-91cb9aaaaaaa',
+                  'a5a8f573-3cee-4ccc-8a2b-91cb9f55250a']
+    response = await make_get_request('person/batch', {'ids': ','.join(person_ids)})
+    assert response.status == HTTPStatus.OK
+    assert response.body == expected_json_response
+
+
+async def test_export_persons_fields(make_ndjson_request):
+    response = await make_ndjson_request('person/export', {'fields': 'uuid,full_name'})
+    assert response.status == HTTPStatus.OK
+    assert len(response.body) == 100
+    assert all(set(person) == {'uuid', 'full_name'} for person in response.body)
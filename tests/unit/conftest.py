@@ -0,0 +1,8 @@
+"""
+Модульные тесты сервиса FastAPI, без docker-окружения.
+Запуск из корня репозитория: python -m pytest tests/unit
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "src"))
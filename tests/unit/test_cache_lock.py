@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from core.abstractions import BaseCacheStorage, BaseService
+from db.memory import MemoryCache
+from db.redis import RedisCache
+
+
+async def memory_cache() -> MemoryCache:
+    return MemoryCache(100, 1024 * 1024, 60)
+
+
+async def redis_cache() -> RedisCache:
+    cache = RedisCache()
+    try:
+        await asyncio.wait_for(cache.connect(), timeout=1)
+    except (OSError, asyncio.TimeoutError):
+        pytest.skip("Redis недоступен (REDIS_HOST/REDIS_PORT)")
+    return cache
+
+
+@pytest.fixture(params=[memory_cache, redis_cache], ids=["memory", "redis"])
+def make_cache(request):
+    return request.param
+
+
+def run(make_cache, scenario) -> None:
+    async def inner() -> None:
+        cache = await make_cache()
+        try:
+            await scenario(cache)
+        finally:
+            if isinstance(cache, RedisCache):
+                await cache.storage.delete("test::lock")
+                await cache.close()
+
+    asyncio.run(inner())
+
+
+def test_lock_is_exclusive(make_cache):
+    async def scenario(cache: BaseCacheStorage) -> None:
+        token = await cache.lock("test::lock", expire=10)
+        assert token is not None
+        assert await cache.lock("test::lock", expire=10) is None
+        await cache.unlock("test::lock", token)
+        assert await cache.lock("test::lock", expire=10) is not None
+
+    run(make_cache, scenario)
+
+
+def test_expired_owner_does_not_release_new_lock(make_cache):
+    async def scenario(cache: BaseCacheStorage) -> None:
+        # Первый владелец загружает данные дольше срока блокировки, её захватывает второй
+        first = await cache.lock("test::lock", expire=1)
+        await asyncio.sleep(1.1)
+        second = await cache.lock("test::lock", expire=10)
+        assert second is not None
+        # Первый владелец закончил и снимает свою блокировку - чужая остаётся
+        await cache.unlock("test::lock", first)
+        assert await cache.lock("test::lock", expire=10) is None
+        await cache.unlock("test::lock", second)
+        assert await cache.lock("test::lock", expire=10) is not None
+
+    run(make_cache, scenario)
+
+
+def test_workers_load_once():
+    calls = []
+
+    async def load() -> bytes:
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        await cache.write("test", b"data", expire=60)
+        return b"data"
+
+    async def scenario() -> list:
+        # Воркеры - разные сервисы с общим кэшем, single-flight внутри воркера их не схлопывает
+        workers = [BaseService(None, cache, lock_expire=10, lock_wait=1) for _ in range(3)]
+        return await asyncio.gather(*(worker._load_with_lock("test", load, bytes) for worker in workers))
+
+    cache = MemoryCache(100, 1024 * 1024, 60)
+    assert asyncio.run(scenario()) == [b"data"] * 3
+    assert len(calls) == 1
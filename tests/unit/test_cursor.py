@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+from elasticsearch import RequestError
+
+from db.elastic import AsyncElasticEngine
+from services.cursor import decode_cursor, encode_cursor
+
+
+def test_cursor_roundtrip():
+    values = [7.5, float("-inf"), "uuid"]
+    assert decode_cursor(encode_cursor(values), 3) == values
+
+
+@pytest.mark.parametrize("values", [[{"a": 1}, "uuid"], [[1], "uuid"]])
+def test_cursor_with_non_scalar_values_rejected(values):
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(values), 2)
+
+
+class RejectingElasticsearch:
+    async def search(self, index, body, _source_includes=None) -> dict:
+        raise RequestError(400, "search_phase_execution_exception", {})
+
+
+@pytest.mark.parametrize("query, error", [
+    ({"search_after": ["not-a-number", "uuid"]}, ValueError),
+    ({"query": {}}, RequestError),
+])
+def test_rejected_search_after_is_value_error(query, error):
+    engine = AsyncElasticEngine()
+    engine.search_engine = RejectingElasticsearch()
+    with pytest.raises(error):
+        asyncio.run(engine.search_page(query, "movies"))
@@ -0,0 +1,53 @@
+import asyncio
+from typing import List
+
+import orjson
+import pytest
+
+from api.v1.film import films_batch
+
+FILMS = [
+    {"uuid": "free", "subscribe_required": False},
+    {"uuid": "premium", "subscribe_required": True},
+    # Запись кэша, сохранённая до появления флага
+    {"uuid": "old"},
+    # Подстрока в тексте не должна влиять на проверку
+    {"uuid": "text", "description": '"subscribe_required":true', "subscribe_required": False},
+]
+
+
+class FakeFilmService:
+    def __init__(self, films: List[dict]) -> None:
+        self.films = films
+
+    async def get_films_by_ids(self, film_ids: List[str]) -> bytes:
+        return orjson.dumps([film for film in self.films if film["uuid"] in film_ids])
+
+
+class FakeEntitlements:
+    def __init__(self, allowed: bool) -> None:
+        self.allowed = allowed
+        self.calls = 0
+
+    async def has_subscription(self, token) -> bool:
+        self.calls += 1
+        return self.allowed
+
+
+def batch(film_ids: List[str], entitlements: FakeEntitlements) -> List[str]:
+    response = asyncio.run(films_batch(film_ids, "token", FakeFilmService(FILMS), entitlements))
+    return [film["uuid"] for film in orjson.loads(response.body)]
+
+
+@pytest.mark.parametrize("allowed, expected", [
+    (False, ["free", "text"]),
+    (True, ["free", "premium", "old", "text"]),
+])
+def test_subscription_films_filtered(allowed, expected):
+    assert batch(["free", "premium", "old", "text"], FakeEntitlements(allowed)) == expected
+
+
+def test_free_films_skip_auth():
+    entitlements = FakeEntitlements(False)
+    assert batch(["free", "text"], entitlements) == ["free", "text"]
+    assert entitlements.calls == 0
@@ -0,0 +1,61 @@
+import asyncio
+
+from core.abstractions import BaseService
+from db.memory import MemoryCache
+from models.film import Film
+
+
+def test_size_counts_bytes():
+    async def scenario() -> None:
+        cache = MemoryCache(100, 1024, 60)
+        await cache.write("text", "фильм", expire=60)
+        assert cache.size == len("фильм".encode())
+        # Разобранный объект увеличивает учтённый объём записи
+        await cache.write_object("text", object())
+        assert cache.size == 2 * len("фильм".encode())
+
+    asyncio.run(scenario())
+
+
+def test_object_size_causes_eviction():
+    async def scenario() -> None:
+        cache = MemoryCache(100, 120, 60)
+        await cache.write("old", b"x" * 50, expire=60)
+        await cache.write("new", b"x" * 50, expire=60)
+        await cache.write_object("new", object())
+        assert await cache.read("old") is None
+        assert await cache.read("new") is not None
+
+    asyncio.run(scenario())
+
+
+def test_cached_objects_are_copied():
+    async def scenario() -> None:
+        cache = MemoryCache(100, 1024 * 1024, 60)
+        service = BaseService(None, cache)
+        film = Film(uuid="1", title="Film")
+        await service._put_data_to_cache("film", film)
+        film.title = "Changed by loader"
+        first = await service._get_parsed_from_cache("film", Film.parse_raw)
+        first.title = "Changed by request"
+        second = await service._get_parsed_from_cache("film", Film.parse_raw)
+        assert second.title == "Film"
+        assert second is not first
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_waiters_get_copies():
+    async def load() -> Film:
+        await asyncio.sleep(0.01)
+        return Film(uuid="1", title="Film")
+
+    async def scenario() -> None:
+        service = BaseService(None, MemoryCache(100, 1024 * 1024, 60))
+        first, second = await asyncio.gather(*(service._single_flight("film", load, Film.parse_raw)
+                                               for _ in range(2)))
+        assert first is not second
+        first.title = "Changed by request"
+        assert second.title == "Film"
+
+    asyncio.run(scenario())
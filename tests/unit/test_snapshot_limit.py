@@ -0,0 +1,73 @@
+import asyncio
+import itertools
+
+import pytest
+
+from core import config
+from core.abstractions import TooManySnapshots
+from db.elastic import AsyncElasticEngine, duration_seconds
+
+
+class FakeElasticsearch:
+    """scroll отдаёт одну и ту же страницу под тем же id"""
+
+    def __init__(self) -> None:
+        self.ids = itertools.count()
+        self.cleared = []
+
+    async def search(self, index, body, _source_includes=None, scroll=None) -> dict:
+        return {"_scroll_id": f"scroll-{next(self.ids)}", "hits": {"hits": [{"_source": {}}]}}
+
+    async def scroll(self, scroll_id, scroll) -> dict:
+        return {"_scroll_id": scroll_id, "hits": {"hits": []}}
+
+    async def clear_scroll(self, scroll_id, ignore) -> None:
+        self.cleared.append(scroll_id)
+
+
+@pytest.fixture
+def engine(monkeypatch) -> AsyncElasticEngine:
+    monkeypatch.setattr(config, "SNAPSHOT_MAX_OPEN", 2)
+    engine = AsyncElasticEngine()
+    engine.search_engine = FakeElasticsearch()
+    return engine
+
+
+def test_duration_seconds():
+    assert duration_seconds("1m") == 60
+    assert duration_seconds("30s") == 30
+    assert duration_seconds("500ms") == 0.5
+
+
+def test_open_snapshots_limited(engine):
+    async def scenario() -> None:
+        _, first = await engine.open_snapshot({}, "movies")
+        await engine.open_snapshot({}, "movies")
+        with pytest.raises(TooManySnapshots):
+            await engine.open_snapshot({}, "movies")
+        # Закрытый снимок освобождает место
+        await engine.close_snapshot(first)
+        await engine.open_snapshot({}, "movies")
+
+    asyncio.run(scenario())
+
+
+def test_expired_snapshots_not_counted(engine):
+    async def scenario() -> None:
+        await engine.open_snapshot({}, "movies")
+        await engine.open_snapshot({}, "movies")
+        # Брошенные снимки ES закрыл сам по истечении срока
+        engine.snapshots = {snapshot_id: 0 for snapshot_id in engine.snapshots}
+        await engine.open_snapshot({}, "movies")
+
+    asyncio.run(scenario())
+
+
+def test_scan_not_limited(engine):
+    async def scenario() -> None:
+        await engine.open_snapshot({}, "movies")
+        await engine.open_snapshot({}, "movies")
+        pages = [docs async for docs in engine.scan({}, "movies")]
+        assert len(pages) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import asyncio
+
+from core.abstractions import BaseService
+from db.memory import MemoryCache
+from models.film import FilmSmall
+
+
+class CountingCache(MemoryCache):
+    """Локальный кэш, считающий обращения, как если бы это был Redis"""
+
+    def __init__(self) -> None:
+        super().__init__(100, 1024 * 1024, 3600)
+        self.calls = []
+
+    async def read_with_ttl(self, key):
+        self.calls.append("read_with_ttl")
+        return await super().read_with_ttl(key)
+
+    async def ttl(self, key):
+        self.calls.append("ttl")
+        return await super().ttl(key)
+
+
+class FakeEngine:
+    def __init__(self) -> None:
+        self.searches = 0
+
+    async def search(self, scope, search_query, fields=None):
+        self.searches += 1
+        return [{"uuid": "1", "title": f"Film v{self.searches}"}]
+
+
+def run(expire: int, stale: int):
+    async def scenario():
+        engine, cache = FakeEngine(), CountingCache()
+        service = BaseService(engine, cache, expire=expire, stale=stale)
+        await cache.write("films", b'[{"uuid":"1","title":"Film v0"}]', expire=expire + stale)
+        data = await service.search_raw({}, FilmSmall, "films")
+        # Дать фоновому обновлению завершиться
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return data, engine.searches, cache.calls, await cache.read("films")
+
+    return asyncio.run(scenario())
+
+
+def test_fresh_hit_is_one_cache_request():
+    data, searches, calls, _ = run(expire=60, stale=60)
+    assert data == b'[{"uuid":"1","title":"Film v0"}]'
+    assert searches == 0
+    assert calls == ["read_with_ttl"]
+
+
+def test_stale_hit_is_served_and_refreshed():
+    data, searches, calls, cached = run(expire=0, stale=60)
+    assert data == b'[{"uuid":"1","title":"Film v0"}]'
+    assert searches == 1
+    assert "ttl" not in calls
+    assert b"Film v1" in cached
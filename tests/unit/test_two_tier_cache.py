@@ -0,0 +1,19 @@
+import asyncio
+
+from db.cache import TwoTierCache
+from db.memory import MemoryCache
+
+
+def test_read_many_keeps_shared_ttl():
+    async def scenario() -> None:
+        shared = MemoryCache(100, 1024 * 1024, 3600)
+        await shared.write("long", b"1", expire=100)
+        await shared.write("short", b"2", expire=5)
+        local = MemoryCache(100, 1024 * 1024, 30)
+        cache = TwoTierCache(local, shared)
+        assert await cache.read_many(["long", "short", "missing"]) == [b"1", b"2", None]
+        # В L1 запись живёт не дольше собственного TTL L1 и не дольше, чем в L2
+        assert 25 <= local.entries["long"].expire_at - local.entries["short"].expire_at <= 26
+        assert await local.read("missing") is None
+
+    asyncio.run(scenario())